@@ -0,0 +1,64 @@
+# Time it takes to turn a reprex's outputs into markdown, for outputs that are
+# 100k+ lines long. No code is run: the outputs are made up, so this only
+# measures the formatter.
+#
+# usage: python benchmarks/bench_format.py [n_lines] [n_runs]
+import statistics
+import sys
+import time
+
+from reprexpy.reprex import _format_reprex
+
+# a colored IPython traceback frame
+FRAME = (
+    '\x1b[0;32mCell In[4], line 1\x1b[0m, in \x1b[0;36mf\x1b[0;34m(n)\x1b[0m\n'
+    '\x1b[0;32m----> 1\x1b[0m \x1b[38;5;28;01mdef\x1b[39;00m '
+    '\x1b[38;5;21mf\x1b[39m(n): \x1b[38;5;28;01mreturn\x1b[39;00m f(n \x1b'
+    '[38;5;241m+\x1b[39m \x1b[38;5;241m1\x1b[39m)\n'
+)
+
+
+def _get_cases(n_lines):
+    text = ''.join('{}\n'.format(i) for i in range(n_lines))
+    return {
+        'stream': [{'output_type': 'stream', 'name': 'stdout', 'text': text}],
+        'many streams': [
+            {'output_type': 'stream', 'name': name, 'text': text[:1000]}
+            for _ in range(n_lines // 100) for name in ['stdout', 'stderr']
+        ],
+        'execute_result': [{
+            'output_type': 'execute_result', 'data': {'text/plain': text},
+            'metadata': {}, 'execution_count': 1
+        }],
+        'traceback': [{
+            'output_type': 'error', 'ename': 'RecursionError', 'evalue': '',
+            'traceback': [
+                '\x1b[0;31m' + '-' * 75 + '\x1b[0m',
+                '\x1b[0;31mRecursionError\x1b[0m                '
+                'Traceback (most recent call last)'
+            ] + [FRAME] * (n_lines // 2) + [
+                '\x1b[0;31mRecursionError\x1b[0m: maximum recursion depth '
+                'exceeded'
+            ]
+        }],
+    }
+
+
+def main(n_lines=200000, n=5):
+    cells = [['print(x)']]
+    for label, outputs in _get_cases(n_lines).items():
+        times = []
+        for _ in range(n):
+            start = time.perf_counter()
+            _format_reprex(
+                cells * len(outputs), [[i] for i in outputs], venue='gh',
+                comment='#>', si=False, advertise=False
+            )
+            times.append(time.perf_counter() - start)
+        print('{:<16} median {:7.3f}s   min {:7.3f}s   max {:7.3f}s'.format(
+            label, statistics.median(times), min(times), max(times)
+        ))
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,55 @@
+# Import-time regression check for `import reprexpy`, based on
+# `python -X importtime`. Exits with a non-zero status if the (best of n)
+# cumulative import time goes over the budget, or if importing reprexpy drags in
+# one of its heavy dependencies.
+#
+# usage: python benchmarks/bench_import_time.py [budget_ms] [n_runs]
+import re
+import subprocess
+import sys
+
+HEAVY_DEPENDENCIES = [
+    'nbconvert', 'nbformat', 'nbclient', 'jupyter_client', 'zmq', 'requests',
+    'pyperclip', 'asttokens', 'IPython', 'stdlib_list',
+]
+
+
+def _time_import(module):
+    # -X importtime writes one line per module to stderr, e.g.:
+    # import time:       311 |      53244 | reprexpy
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    pattern = r'import time:\s+\d+ \|\s+(\d+) \| {}$'.format(re.escape(module))
+    match = re.search(pattern, proc.stderr, flags=re.MULTILINE)
+    return int(match.group(1)) / 1000
+
+
+def _get_heavy_imports(module):
+    code = (
+        'import sys, {}; print(" ".join(i for i in {!r} if i in sys.modules))'
+        .format(module, HEAVY_DEPENDENCIES)
+    )
+    proc = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.PIPE,
+        universal_newlines=True, check=True
+    )
+    return proc.stdout.split()
+
+
+def main(budget_ms=150, n=5):
+    times = [_time_import('reprexpy') for _ in range(n)]
+    best = min(times)
+    print('import reprexpy: best {:.1f}ms, worst {:.1f}ms (budget {}ms)'.format(
+        best, max(times), budget_ms
+    ))
+    heavy = _get_heavy_imports('reprexpy')
+    if heavy:
+        print('import reprexpy also imports: ' + ', '.join(heavy))
+    if best > budget_ms or heavy:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
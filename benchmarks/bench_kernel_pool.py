@@ -0,0 +1,47 @@
+# Per-render latency of reprex() with and without a warm KernelPool, for each
+# of the kernel-based engines.
+#
+# usage: python benchmarks/bench_kernel_pool.py [n_renders]
+import contextlib
+import io
+import statistics
+import sys
+import time
+
+from reprexpy import reprex
+from reprexpy.kernel_pool import KernelPool
+
+CODE = 'x = [3, 2]\nx.append(5)\nprint(x)'
+
+
+def _time_renders(n, **kwargs):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            reprex(CODE, **kwargs)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _report(label, times):
+    print('{:<28} median {:7.3f}s   min {:7.3f}s   max {:7.3f}s'.format(
+        label, statistics.median(times), min(times), max(times)
+    ))
+
+
+def main(n=5):
+    for engine in ['nbconvert', 'client']:
+        _report(engine + ': fresh kernel', _time_renders(n, engine=engine))
+        with KernelPool(size=1, max_runs=None) as pool:
+            # the first render pays for starting the pool's kernel
+            _report(engine + ': pool (cold)', _time_renders(
+                1, kernel_pool=pool, engine=engine
+            ))
+            _report(engine + ': pool (warm)', _time_renders(
+                n, kernel_pool=pool, engine=engine
+            ))
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
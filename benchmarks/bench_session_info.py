@@ -0,0 +1,120 @@
+# Time it takes to look up the distributions in a made-up environment with 1000+
+# installed distributions (half of which don't have a top_level.txt, so their
+# modules have to be inferred from their RECORD files):
+#
+# - mapping imported modules to the distributions that provide them, with the
+#   lazy index that SessionInfo uses vs. indexing every distribution up front
+#   (which is what SessionInfo used to do, and what
+#   importlib.metadata.packages_distributions() does)
+# - environment_fingerprint(), for the whole environment and scoped to a
+#   reprex's imports (of modules with the same names as their distributions,
+#   and with other names), vs. reading every distribution's name and version out of
+#   its metadata (which is what the render cache used to do)
+#
+# usage: python benchmarks/bench_session_info.py [n_dists] [n_runs]
+import importlib.metadata
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from reprexpy.session_info import _DistributionIndex, environment_fingerprint
+
+# the number of files listed in each made-up distribution's RECORD
+FILES_PER_DIST = 200
+
+
+# distribution pkgN provides a package that's also named pkgN if N is even, or
+# modN (which the distribution declares in its top_level.txt) if N is odd
+def _make_dist(site_dir, i):
+    name = 'pkg{}'.format(i)
+    mod = 'mod{}'.format(i) if i % 2 else name
+    os.makedirs(os.path.join(site_dir, mod))
+    with open(os.path.join(site_dir, mod, '__init__.py'), 'w'):
+        pass
+    info_dir = os.path.join(site_dir, '{}-1.0.dist-info'.format(name))
+    os.makedirs(info_dir)
+    with open(os.path.join(info_dir, 'METADATA'), 'w') as f:
+        f.write('Metadata-Version: 2.1\nName: {}\nVersion: 1.0\n'.format(name))
+    records = ['{}/__init__.py,,'.format(mod)] + [
+        '{}/sub{}.py,,'.format(mod, j) for j in range(FILES_PER_DIST)
+    ]
+    with open(os.path.join(info_dir, 'RECORD'), 'w') as f:
+        f.write('\n'.join(records) + '\n')
+    if i % 2:
+        with open(os.path.join(info_dir, 'top_level.txt'), 'w') as f:
+            f.write(mod + '\n')
+
+
+def _lookup_lazy(site_dir, mods):
+    index = _DistributionIndex(importlib.metadata.distributions(path=[site_dir]))
+    return {i: index.lookup(i) for i in mods}
+
+
+# what SessionInfo used to do: read the name, version and (declared or
+# inferred) modules of every distribution, then scan them for each module
+def _lookup_eager(site_dir, mods):
+    all_dist_info = []
+    for dist in importlib.metadata.distributions(path=[site_dir]):
+        top_level = dist.read_text('top_level.txt')
+        if top_level:
+            dist_mods = top_level.splitlines()
+        else:
+            dist_mods = {
+                i.parts[0] for i in dist.files or []
+                if i.suffix in ('.py', '.pyi') and len(i.parts) > 1
+            }
+        all_dist_info.append(
+            (dist.metadata.get('Name', ''), dist.version, dist_mods)
+        )
+    return {
+        i: next(((j, k) for j, k, l in all_dist_info if i in l), (None, None))
+        for i in mods
+    }
+
+
+# what the render cache used to key on
+def _fingerprint_from_metadata():
+    return sorted(
+        (i.metadata.get('Name', ''), i.version)
+        for i in importlib.metadata.distributions()
+    )
+
+
+def _report(label, func, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    print('{:<26} median {:7.3f}s   min {:7.3f}s   max {:7.3f}s'.format(
+        label, statistics.median(times), min(times), max(times)
+    ))
+
+
+def main(n_dists=1000, n=5):
+    with tempfile.TemporaryDirectory() as site_dir:
+        for i in range(n_dists):
+            _make_dist(site_dir, i)
+        sys.path.insert(0, site_dir)
+        # a typical reprex imports a handful of packages
+        mods = ['pkg{}'.format(i) for i in range(0, n_dists, n_dists // 5)]
+        other_mods = [
+            'mod{}'.format(i) for i in range(1, n_dists, n_dists // 5)
+        ]
+        assert _lookup_lazy(site_dir, mods) == _lookup_eager(site_dir, mods)
+        print('{} distributions, {} modules'.format(n_dists, len(mods)))
+        _report('lazy index', lambda: _lookup_lazy(site_dir, mods), n)
+        _report('eager index', lambda: _lookup_eager(site_dir, mods), n)
+        _report('fingerprint', environment_fingerprint, n)
+        for label, scope in [('same', mods), ('other', other_mods)]:
+            source = '\n'.join('import {}'.format(i) for i in scope)
+            _report('fingerprint, {} names'.format(label), lambda: (
+                environment_fingerprint(source)
+            ), n)
+        _report('fingerprint, metadata', _fingerprint_from_metadata, n)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,61 @@
+# Time it takes to split a script into cells (one per top-level statement), for
+# scripts with 10k+ statements, using ast end positions vs. asttokens.
+#
+# usage: python benchmarks/bench_split.py [n_statements] [n_runs]
+import statistics
+import sys
+import time
+
+from reprexpy.reprex import (
+    _get_statement_ends_from_tokens, _split_input_into_cells
+)
+
+# a mix of simple and compound statements, comments and blank lines
+CHUNK = '''\
+x_{0} = [{0}, {0} + 1]  # a comment
+print(x_{0})
+
+def f_{0}(a, b=(1,
+                2)):
+    return a + b[0]
+
+if x_{0}:
+    y_{0} = """a
+    multi-line string"""
+'''
+
+
+def _get_script(n_statements):
+    # each chunk has 5 top-level statements
+    return ''.join(CHUNK.format(i) for i in range(n_statements // 5))
+
+
+def _split_with_asttokens(code_str):
+    ends = sorted(set(_get_statement_ends_from_tokens(code_str)))
+    code_lines = code_str.splitlines()
+    return [code_lines[i:j] for i, j in zip([0] + ends[:-1], ends)]
+
+
+def _report(label, func, code_str, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        func(code_str)
+        times.append(time.perf_counter() - start)
+    print('{:<10} median {:7.3f}s   min {:7.3f}s   max {:7.3f}s'.format(
+        label, statistics.median(times), min(times), max(times)
+    ))
+
+
+def main(n_statements=20000, n=5):
+    code_str = _get_script(n_statements)
+    assert _split_input_into_cells(code_str) == _split_with_asttokens(code_str)
+    print('{} statements, {} lines'.format(
+        n_statements, code_str.count('\n')
+    ))
+    _report('ast', _split_input_into_cells, code_str, n)
+    _report('asttokens', _split_with_asttokens, code_str, n)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,216 @@
+# Times each stage of rendering a reprex separately: source splitting, output
+# formatting, block grouping, image handling, SessionInfo() and (with --live)
+# kernel startup and per-cell execution. Reprexes are generated at several
+# sizes, and their outputs are replayed by a fake engine, so every stage except
+# the live ones runs deterministically, without Jupyter or the network.
+#
+# usage: python benchmarks/bench_stages.py [--live] [n_runs]
+import base64
+import contextlib
+import io
+import os
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import unittest.mock
+import zlib
+
+from reprexpy.engines import ExecutionEngine, ExecutionSession, _get_engine
+from reprexpy.images import DataURISink, DirectorySink
+from reprexpy.reprex import (
+    _fill_url_cache, _format_code_block, _get_code_block_start_stops,
+    _get_setup_code, _render, _split_input_into_cells
+)
+
+# number of cells in each of the generated reprexes
+SIZES = {'small': 10, 'medium': 100, 'large': 1000}
+
+
+def _make_png(seed, size=64):
+    # a (valid) grayscale png whose pixels depend on seed
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + \
+            struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+
+    rows = b''.join(
+        b'\x00' + bytes((seed + x * y) % 256 for x in range(size))
+        for y in range(size)
+    )
+    ihdr = struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + \
+        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+# a reprex with n_cells statements, along with the outputs that running it
+# would produce. most cells print a few lines, and every 10th cell makes a plot,
+# every 25th returns a value and every 50th raises an error.
+def _make_reprex(n_cells, lines_per_output=5):
+    cells = []
+    outputs = []
+    for i in range(n_cells):
+        if i % 10 == 9:
+            cells.append(['plt.plot([{}, 1]); plt.show()'.format(i)])
+            png = base64.b64encode(_make_png(i)).decode('ascii')
+            outputs.append([{
+                'output_type': 'display_data', 'metadata': {},
+                'data': {'image/png': png, 'text/plain': '<Figure>'}
+            }])
+        elif i % 50 == 49:
+            cells.append(['# raises an error', 'x_{} = 1 / 0'.format(i)])
+            outputs.append([{
+                'output_type': 'error', 'ename': 'ZeroDivisionError',
+                'evalue': 'division by zero', 'traceback': [
+                    '-' * 75,
+                    'ZeroDivisionError     Traceback (most recent call last)',
+                    'Cell In[{}], line 2\n----> 2 x_{} = 1 / 0'.format(i, i),
+                    'ZeroDivisionError: division by zero'
+                ]
+            }])
+        elif i % 25 == 24:
+            cells.append(['x_{}'.format(i)])
+            outputs.append([{
+                'output_type': 'execute_result', 'metadata': {},
+                'data': {'text/plain': repr(list(range(i)))},
+                'execution_count': i
+            }])
+        else:
+            cells.append(['for j in range({}):'.format(lines_per_output),
+                          '    print("line", j, {})'.format(i)])
+            outputs.append([{
+                'output_type': 'stream', 'name': 'stdout',
+                'text': ''.join(
+                    'line {} {}\n'.format(j, i) for j in range(lines_per_output)
+                )
+            }])
+    code_str = '\n'.join(x for i in cells for x in i)
+    return code_str, cells, outputs
+
+
+class _FakeSession(ExecutionSession):
+
+    def __init__(self, outputs):
+        self._outputs = outputs
+
+    def close(self):
+        pass
+
+    def _execute(self, code, store_history, timeout=None):
+        # cells that weren't recorded (e.g., the setup code) have no outputs
+        return self._outputs.get(code, [])
+
+
+# an engine that replays recorded outputs instead of running any code
+class FakeEngine(ExecutionEngine):
+
+    def __init__(self, cells, outputs):
+        self.outputs = {'\n'.join(i): j for i, j in zip(cells, outputs)}
+
+    def session(self, kernel_name=None, kernel_pool=None):
+        return _FakeSession(self.outputs)
+
+
+def _time(func, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _report(label, times):
+    print('{:<36} median {:8.4f}s   min {:8.4f}s   max {:8.4f}s'.format(
+        label, statistics.median(times), min(times), max(times)
+    ))
+
+
+def _bench_offline_stages(n):
+    for size, n_cells in SIZES.items():
+        code_str, cells, outputs = _make_reprex(n_cells)
+        text_outputs = [
+            [j for j in i if j['output_type'] != 'display_data']
+            for i in outputs
+        ]
+
+        _report('split ({})'.format(size), _time(
+            lambda: _split_input_into_cells(code_str), n
+        ))
+        _report('format ({})'.format(size), _time(
+            lambda: _format_code_block(
+                cells, text_outputs, venue='gh', comment='#>'
+            ), n
+        ))
+        _report('group ({})'.format(size), _time(
+            lambda: _get_code_block_start_stops(outputs, si=False), n
+        ))
+        _report('images, data uri ({})'.format(size), _time(
+            lambda: _fill_url_cache(outputs, {}, image_sink=DataURISink()), n
+        ))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            _report('images, directory ({})'.format(size), _time(
+                lambda: _fill_url_cache(
+                    outputs, {}, image_sink=DirectorySink(tmp_dir)
+                ), n
+            ))
+
+        engine = FakeEngine(cells, outputs)
+        _report('render, fake engine ({})'.format(size), _time(
+            lambda: _render(
+                code_str, venue='gh', kernel_name=None, comment='#>',
+                si=False, advertise=False, engine=engine,
+                image_sink=DataURISink()
+            ), n
+        ))
+
+
+def _bench_session_info(n):
+    import IPython.core.interactiveshell
+    from reprexpy import SessionInfo
+
+    shell = IPython.core.interactiveshell.InteractiveShell.instance()
+    code = 'import numpy\nimport matplotlib.pyplot as plt\nimport IPython'
+    with contextlib.redirect_stdout(io.StringIO()):
+        shell.run_cell(code, store_history=True)
+    # SessionInfo() persists the distributions it looks up in reprexpy's cache
+    # directory, which shouldn't be the user's real one
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            unittest.mock.patch.dict(
+                os.environ, {'REPREXPY_CACHE_DIR': cache_dir}
+            ):
+        _report('SessionInfo()', _time(SessionInfo, n))
+        # a long-lived kernel, with a long input history
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(5000):
+                shell.run_cell('x_{} = {}'.format(i, i), store_history=True)
+        _report('SessionInfo(), 5000 cells run', _time(SessionInfo, n))
+
+
+def _bench_live_stages(n):
+    setup_code = _get_setup_code()
+    for name in ['shell', 'client', 'nbconvert']:
+        engine = _get_engine(name)
+        _report('kernel startup ({})'.format(name), _time(
+            lambda: engine.session().close(), n
+        ))
+        with engine.session() as session:
+            for cell in setup_code:
+                session.execute(cell)
+            _report('execute a cell ({})'.format(name), _time(
+                lambda: session.execute(['x = 1']), n * 10
+            ))
+
+
+def main(n=5, live=False):
+    _bench_offline_stages(n)
+    _bench_session_info(n)
+    if live:
+        _bench_live_stages(n)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    live = '--live' in args
+    main(*[int(i) for i in args if i != '--live'], live=live)
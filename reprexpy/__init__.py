@@ -1,5 +1,8 @@
 # In retrospect, it was pretty dumb to have a module and a function both named
 # reprex, and exporting the public-facing functions like I do here. I'm keeping
 # the API as-is for now, to reduce the chances of breaking people's code.
-from reprexpy.reprex import reprex, reprex_ex
+from reprexpy.reprex import areprex, reprex, reprex_ex, reprex_iter
 from reprexpy.session_info import SessionInfo
+from reprexpy.kernel_pool import KernelPool
+from reprexpy.batch import reprex_many
+from reprexpy.watch import watch
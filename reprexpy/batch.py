@@ -0,0 +1,143 @@
+import collections
+import concurrent.futures
+import multiprocessing.util
+import os
+import traceback
+
+from reprexpy.kernel_pool import KernelPool
+from reprexpy.reprex import _get_source_code, _render
+
+
+BatchResult = collections.namedtuple(
+    'BatchResult', ['index', 'source', 'output', 'error']
+)
+BatchResult.__doc__ = r"""The result of rendering one reprex in a batch.
+
+Attributes
+----------
+index : int
+    The position of the reprex in the ``sources`` passed to ``reprex_many()``.
+source : str or os.PathLike
+    The source that was rendered, exactly as it was passed in.
+output : str
+    The rendered reprex, or ``None`` if rendering failed.
+error : str
+    The traceback of the error that stopped the reprex from being rendered, or
+    ``None`` if rendering succeeded.
+"""
+
+
+# each worker process renders all of its reprexes in a single, long-lived kernel
+_worker_pool = None
+
+
+def _init_worker():
+    global _worker_pool
+    _worker_pool = KernelPool(size=1)
+    # worker processes exit without running atexit handlers, so the kernel has
+    # to be shut down by a multiprocessing finalizer instead
+    multiprocessing.util.Finalize(
+        _worker_pool, _worker_pool.shutdown, exitpriority=10
+    )
+
+
+def _render_one(index, source, render_args):
+    try:
+        if isinstance(source, os.PathLike):
+            code_str = _get_source_code(None, source)
+        else:
+            code_str = source
+        out = _render(code_str, kernel_pool=_worker_pool, **render_args)
+        return BatchResult(index, source, out, None)
+    except Exception:  # pylint: disable=broad-except
+        return BatchResult(index, source, None, traceback.format_exc())
+
+
+# the executor is only created once the caller starts consuming results, so
+# worker processes aren't left running if the iterator is never consumed
+def _iter_results(sources, workers, render_args):
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker
+    ) as executor:
+        futures = [
+            executor.submit(_render_one, index, source, render_args)
+            for index, source in enumerate(sources)
+        ]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            # don't keep rendering if the caller stops consuming results early
+            for future in futures:
+                future.cancel()
+
+
+def reprex_many(sources, workers=None, as_completed=False, venue='gh',
+                kernel_name=None, comment='#>', si=False, advertise=False,
+                cache=None, engine=None, image_sink=None, figure_format=None,
+                dpi=None, optimize_png=False, timeout=None, budget=None,
+                stop_on_error=False):
+    r"""Render many reprexes in parallel.
+
+    Fans the reprexes out across a pool of worker processes, each of which runs
+    its reprexes in its own IPython kernel. The kernel is reset between
+    reprexes (see :py:class:`reprexpy.kernel_pool.KernelPool`), so each reprex
+    still starts from a clean namespace. Unlike ``reprex()``, ``reprex_many()``
+    doesn't print progress messages and doesn't touch the clipboard.
+
+    Parameters
+    ----------
+    sources : iterable of str or os.PathLike
+        The reprexes to render. Strings are always treated as code, even if
+        they look like file paths. Only ``os.PathLike`` objects (e.g.,
+        ``pathlib.Path('my-reprex.py')``) are read as files containing code.
+    workers : int, optional
+        Number of worker processes (and hence kernels) to use. Defaults to the
+        number of CPUs on the machine.
+    as_completed : bool, optional
+        Do you want the results as they finish rendering, rather than all at
+        once and in the same order as ``sources``?
+    venue, kernel_name, comment, si, advertise, cache, engine, image_sink
+        See :py:func:`reprexpy.reprex.reprex`. These apply to every reprex in
+        the batch.
+    figure_format, dpi, optimize_png, timeout, budget, stop_on_error
+        See :py:func:`reprexpy.reprex.reprex`. A reprex that times out still
+        gives its kernel back to the worker, since timeouts interrupt cells
+        rather than killing the kernel.
+
+    Returns
+    -------
+    list of BatchResult or iterator of BatchResult
+        A list of results in the same order as ``sources`` or, if
+        ``as_completed=True``, an iterator that yields results as soon as they
+        are ready (rendering starts when you start consuming the iterator). An
+        error in one reprex doesn't stop the others from rendering: it's
+        reported in the ``error`` field of that reprex's result.
+
+    Examples
+    --------
+
+    >>> import pathlib
+    >>> import reprexpy
+    >>> results = reprexpy.reprex_many(
+    ...     ['x = 1\nx', pathlib.Path(reprexpy.reprex_ex('error.py'))],
+    ...     workers=2
+    ... )
+    >>> print(results[0].output)
+    ```python
+    x = 1
+    x
+    #> 1
+    ```
+    """
+    render_args = {
+        'venue': venue, 'kernel_name': kernel_name, 'comment': comment,
+        'si': si, 'advertise': advertise, 'cache': cache, 'engine': engine,
+        'image_sink': image_sink, 'figure_format': figure_format, 'dpi': dpi,
+        'optimize_png': optimize_png, 'timeout': timeout, 'budget': budget,
+        'stop_on_error': stop_on_error
+    }
+    results = _iter_results(sources, workers, render_args)
+    if as_completed:
+        return results
+    return sorted(results, key=lambda result: result.index)
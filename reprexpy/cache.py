@@ -0,0 +1,465 @@
+import ast
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from reprexpy.kernel_pool import _get_kernel_spec_manager
+from reprexpy.session_info import (
+    _get_interpreter_fingerprint, environment_fingerprint
+)
+
+
+def _get_default_cache_dir(*parts):
+    base = os.environ.get('REPREXPY_CACHE_DIR')
+    if not base:
+        if sys.platform == 'win32':
+            root = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+        else:
+            root = os.environ.get(
+                'XDG_CACHE_HOME',
+                os.path.join(os.path.expanduser('~'), '.cache')
+            )
+        base = os.path.join(root, 'reprexpy')
+    return os.path.join(base, *parts)
+
+
+# calls whose results change from one run to the next. a call matches if its
+# dotted name (e.g., `datetime.datetime.now`) ends with one of these names.
+_NONDETERMINISTIC_CALLS = {
+    'time.time', 'time.time_ns', 'time.perf_counter', 'time.monotonic',
+    'time.localtime', 'time.ctime', 'datetime.now', 'datetime.today',
+    'datetime.utcnow', 'date.today', 'os.urandom', 'os.getpid', 'uuid.uuid1',
+    'uuid.uuid4',
+}
+_NONDETERMINISTIC_MODULES = {'random', 'secrets'}
+
+
+def _get_dotted_name(node):
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+        return '.'.join(reversed(parts))
+    return None
+
+
+# maps the names that the code's imports bind to the dotted names of the modules
+# (or module attributes) they refer to, e.g., `from time import time as t`
+# binds `t` to `time.time`
+def _get_import_aliases(tree):
+    aliases = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    aliases[alias.asname] = alias.name
+                else:
+                    top = alias.name.split('.')[0]
+                    aliases[top] = top
+        elif isinstance(node, ast.ImportFrom) and node.module and \
+                not node.level:
+            for alias in node.names:
+                aliases[alias.asname or alias.name] = \
+                    '{}.{}'.format(node.module, alias.name)
+    return aliases
+
+
+def _is_deterministic(code_str):
+    try:
+        tree = ast.parse(code_str)
+    except SyntaxError:
+        # the render will just show the syntax error, which is deterministic
+        return True
+    aliases = _get_import_aliases(tree)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom):
+            if (node.module or '').split('.')[0] in _NONDETERMINISTIC_MODULES:
+                return False
+        elif isinstance(node, ast.Call):
+            name = _get_dotted_name(node.func)
+            if name is None:
+                continue
+            # resolve the name that the call starts with to what was imported
+            # under that name
+            first, _, rest = name.partition('.')
+            if first in aliases:
+                name = aliases[first] + ('.' + rest if rest else '')
+            segments = name.split('.')
+            if _NONDETERMINISTIC_MODULES.intersection(segments[:-1]):
+                return False
+            if any(
+                name == i or name.endswith('.' + i)
+                for i in _NONDETERMINISTIC_CALLS
+            ):
+                return False
+    return True
+
+
+def _get_kernelspec_info(kernel_name):
+    import jupyter_client.kernelspec
+
+    try:
+        spec = _get_kernel_spec_manager().get_kernel_spec(
+            kernel_name or 'python3'
+        )
+    except jupyter_client.kernelspec.NoSuchKernel:
+        return {'name': kernel_name}
+    return {
+        'name': kernel_name, 'argv': spec.argv, 'language': spec.language,
+        'env': spec.env
+    }
+
+
+# the python interpreter that a kernelspec's argv runs. like jupyter_client,
+# a bare `python` means this interpreter.
+def _get_kernel_executable(argv):
+    this_python = {
+        'python', 'python{}'.format(sys.version_info[0]),
+        'python{}.{}'.format(*sys.version_info[:2])
+    }
+    return sys.executable if argv[0] in this_python else argv[0]
+
+
+# a digest of the environment that the kernel runs code in, or None if it
+# can't be determined. the default kernel runs in this interpreter's
+# environment, while a named kernel's interpreter (which may be in another
+# virtualenv) is asked for its sys.path.
+def _get_environment_key(kernel_name, kernelspec):
+    if kernel_name is None:
+        return environment_fingerprint()
+    if not kernelspec.get('argv') or kernelspec.get('language') != 'python':
+        return None
+    executable = _get_kernel_executable(kernelspec['argv'])
+    if executable == sys.executable:
+        return environment_fingerprint()
+    return _get_interpreter_fingerprint(executable)
+
+
+# engine_key and image_sink_key are the engine's and image sink's
+# _get_cache_key(). setup_code is the code that's run before the reprex (which
+# holds its plot settings).
+def _get_render_key(code_str, venue, kernel_name, comment, si, advertise,
+                    engine_key=None, image_sink_key=None, setup_code=None,
+                    stop_on_error=False):
+    kernelspec = _get_kernelspec_info(kernel_name)
+    environment = _get_environment_key(kernel_name, kernelspec)
+    if environment is None:
+        # renders can't be told apart from renders in an outdated environment
+        return None
+    key = {
+        'code': code_str, 'venue': venue, 'comment': comment, 'si': si,
+        'advertise': advertise, 'kernelspec': kernelspec,
+        'environment': environment, 'engine': engine_key,
+        'image_sink': image_sink_key, 'setup_code': setup_code,
+        'stop_on_error': stop_on_error,
+    }
+    # session info and advertisements both include today's date
+    if si or advertise:
+        key['date'] = datetime.date.today().isoformat()
+    key = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class RenderCache:
+    r"""An on-disk cache of rendered reprexes.
+
+    Rendering a reprex that hasn't changed since it was last rendered is
+    wasted effort: the kernel runs the same code and plots are uploaded again.
+    Pass a ``RenderCache`` to ``reprex()`` and the rendered reprex will be
+    looked up in the cache before any code is run. Entries are keyed on a hash
+    of the reprex's source code, the rendering options (``venue``,
+    ``comment``, ``si``, ``advertise``, and the plot settings), the engine and
+    kernelspec that would be used to run the code, the image sink that plots
+    are sent to, and the Python environment (the interpreter and the installed
+    distributions) that the kernel runs in. Reprexes run in a kernel whose
+    interpreter can't be inspected (e.g., a kernel for another language) are
+    never cached.
+
+    Reprexes that call obviously nondeterministic functions (e.g.,
+    ``time.time()``, ``datetime.datetime.now()``, or anything in the ``random``
+    module) are never cached, and neither are reprexes that timed out.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The directory to store the cache in. Defaults to a ``renders``
+        directory inside reprexpy's cache directory (``~/.cache/reprexpy`` on
+        Linux/macOS, or the directory given by the ``REPREXPY_CACHE_DIR``
+        environment variable).
+    max_size : int, optional
+        The total size (in bytes) that the cache can grow to. The least
+        recently used entries are evicted once the cache grows past this size.
+    max_age : float, optional
+        The number of seconds an entry is valid for. ``None`` (the default)
+        means entries never expire.
+
+    Examples
+    --------
+
+    >>> import reprexpy
+    >>> from reprexpy.cache import RenderCache
+    >>> cache = RenderCache()
+    >>> out = reprexpy.reprex('x = 1\nx', cache=cache)  # runs the code
+    >>> out = reprexpy.reprex('x = 1\nx', cache=cache)  # hits the cache
+    """
+
+    _RESCAN_INTERVAL = 100
+
+    def __init__(self, directory=None, max_size=100 * 2 ** 20, max_age=None):
+        self.directory = directory or _get_default_cache_dir('renders')
+        self.max_size = max_size
+        self.max_age = max_age
+        # the cache's size as of the last time the directory was scanned, plus
+        # the sizes of the entries put since then. the directory is only
+        # scanned (and entries evicted) once this crosses max_size, or every
+        # _RESCAN_INTERVAL puts (to pick up entries put by other processes).
+        self._size_estimate = None
+        self._puts_since_scan = 0
+
+    def get(self, key):
+        r"""Look up a cache entry.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+
+        Returns
+        -------
+        dict
+            The entry (with ``markdown`` and ``outputs`` items), or ``None`` if
+            there's no valid entry for ``key``.
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, encoding='utf-8') as fi:
+                entry = json.load(fi)
+        except (OSError, ValueError):
+            return None
+        if self.max_age is not None and \
+                time.time() - entry['created'] > self.max_age:
+            self._remove(path)
+            return None
+        # bump the entry's mtime, which is what LRU eviction goes off of
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, markdown, outputs):
+        r"""Add an entry to the cache.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+        markdown : str
+            The rendered reprex.
+        outputs : list
+            The raw outputs of each of the reprex's cells.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {
+            'created': time.time(), 'markdown': markdown, 'outputs': outputs
+        }
+        # write to a temp file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fo:
+                json.dump(entry, fo)
+                size = fo.tell()
+            os.replace(tmp_path, self._get_path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+        self._puts_since_scan += 1
+        if self._size_estimate is None or \
+                self._puts_since_scan >= self._RESCAN_INTERVAL:
+            self._evict()
+        else:
+            self._size_estimate += size
+            if self._size_estimate > self.max_size:
+                self._evict()
+
+    def clear(self):
+        r"""Remove all entries from the cache."""
+        for path, _, _ in self._list_entries():
+            self._remove(path)
+        self._size_estimate = None
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _list_entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._list_entries(), key=lambda i: i[1])
+        total = sum(i[2] for i in entries)
+        for path, _, size in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+        self._size_estimate = total
+        self._puts_since_scan = 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ImageCache:
+    r"""An on-disk record of the URLs that plots have been uploaded to.
+
+    Re-rendering a reprex that makes plots would normally upload the same
+    images again. Image sinks that upload plots (e.g.,
+    :py:class:`reprexpy.images.ImgurSink`) look each plot up in an
+    ``ImageCache`` before uploading it, and reuse the URL that a byte-identical
+    image was uploaded to before (by the same sink) if there is one. The cache
+    is an SQLite database, keyed on a hash of the decoded PNG data.
+
+    Parameters
+    ----------
+    path : str, optional
+        The path to the database. Defaults to ``images.sqlite3`` inside
+        reprexpy's cache directory (see :py:class:`RenderCache`).
+    max_entries : int, optional
+        The number of URLs the cache can hold. The least recently used entries
+        are evicted once the cache grows past this size.
+    max_age : float, optional
+        The number of seconds an entry is valid for (30 days by default, since
+        uploaded images may eventually be deleted). ``None`` means entries
+        never expire.
+    """
+
+    def __init__(self, path=None, max_entries=10000,
+                 max_age=30 * 24 * 60 * 60):
+        self.path = path or _get_default_cache_dir('images.sqlite3')
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    def get_many(self, namespace, digests):
+        r"""Look the URLs of several images up.
+
+        Parameters
+        ----------
+        namespace : str
+            Identifies the sink that uploaded the images.
+        digests : list of str
+            The SHA-256 digests of the images' (decoded) PNG data.
+
+        Returns
+        -------
+        dict
+            Maps the digests that are in the cache to their URLs.
+        """
+        digests = list(set(digests))
+        if not digests:
+            return {}
+        import sqlite3
+
+        now = time.time()
+        min_created = 0 if self.max_age is None else now - self.max_age
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    'SELECT digest, url FROM images WHERE namespace = ? AND '
+                    'created >= ? AND digest IN ({})'.format(
+                        ', '.join('?' * len(digests))
+                    ),
+                    [namespace, min_created] + digests
+                ).fetchall()
+                conn.executemany(
+                    'UPDATE images SET used = ? '
+                    'WHERE namespace = ? AND digest = ?',
+                    [(now, namespace, i[0]) for i in rows]
+                )
+        except (OSError, sqlite3.Error):
+            # a broken cache just means that images get uploaded again
+            return {}
+        return dict(rows)
+
+    def put(self, namespace, digest, url):
+        r"""Record the URL that an image was uploaded to.
+
+        Parameters
+        ----------
+        namespace : str
+            Identifies the sink that uploaded the image.
+        digest : str
+            The SHA-256 digest of the image's (decoded) PNG data.
+        url : str
+            The image's URL.
+        """
+        import sqlite3
+
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                    (namespace, digest, url, now, now)
+                )
+                self._evict(conn, now)
+        except (OSError, sqlite3.Error):
+            pass
+
+    def clear(self):
+        r"""Remove all entries from the cache."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM images')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            # commits the transaction (or rolls it back if there's an error)
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS images (namespace TEXT, '
+                    'digest TEXT, url TEXT, created REAL, used REAL, '
+                    'PRIMARY KEY (namespace, digest))'
+                )
+                yield conn
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now):
+        if self.max_age is not None:
+            conn.execute(
+                'DELETE FROM images WHERE created < ?', (now - self.max_age,)
+            )
+        conn.execute(
+            'DELETE FROM images WHERE rowid IN (SELECT rowid FROM images '
+            'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,)
+        )
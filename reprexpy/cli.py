@@ -0,0 +1,314 @@
+import argparse
+import functools
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+# the largest render request (in bytes) that the server will read
+_MAX_REQUEST_BYTES = 16 * 2 ** 20
+
+# the exit status of `reprexpy render` when the server is too busy to take the
+# render (EX_TEMPFAIL, i.e., try again later)
+_EXIT_BUSY = 75
+
+# the reprex() options that a render request can set
+_RENDER_DEFAULTS = {
+    'venue': 'gh', 'kernel_name': None, 'comment': '#>', 'si': False,
+    'advertise': False, 'timeout': None, 'budget': None,
+    'stop_on_error': False,
+}
+
+
+def _get_default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'reprexpy.sock')
+    from reprexpy.cache import _get_default_cache_dir
+    return _get_default_cache_dir('reprexpy.sock')
+
+
+# reads one JSON request (a line holding the code to render plus any of
+# _RENDER_DEFAULTS) and writes back one JSON response: either the rendered
+# markdown or an error
+class _RenderHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline(_MAX_REQUEST_BYTES + 1)
+        try:
+            if len(line) > _MAX_REQUEST_BYTES:
+                raise ValueError('The request is too large')
+            request = json.loads(line.decode('utf-8'))
+            code_str = request.pop('code')
+            unknown = set(request) - set(_RENDER_DEFAULTS)
+            if unknown:
+                raise ValueError(
+                    'Unknown option(s): {}'.format(', '.join(sorted(unknown)))
+                )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._respond({'error': 'Bad request: {}'.format(e)})
+            return
+
+        # renders that can't even be queued are turned away, rather than
+        # letting requests pile up behind the kernels
+        if not self.server.slots.acquire(blocking=False):
+            self._respond({
+                'error': 'The server is busy ({} renders are running or '
+                         'waiting). Try again later.'.format(
+                             self.server.max_queue),
+                'busy': True
+            })
+            return
+        try:
+            options = dict(_RENDER_DEFAULTS, **request)
+            out = self.server.render(code_str, options)
+        except Exception:  # pylint: disable=broad-except
+            self._respond({'error': traceback.format_exc()})
+        else:
+            self._respond({'markdown': out})
+        finally:
+            self.server.slots.release()
+
+    def _respond(self, response):
+        try:
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError:
+            # the client went away
+            pass
+
+
+# renders reprexes sent over a unix socket, in a pool of warm kernels. each
+# connection is handled in its own thread, and waits for a free kernel in the
+# pool. at most max_queue renders can be running or waiting at once. the class
+# is built on first use, since socketserver.UnixStreamServer doesn't exist on
+# platforms without unix domain sockets (i.e., windows).
+@functools.lru_cache(maxsize=None)
+def _get_render_server_class():
+    if not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit('`reprexpy serve` needs unix domain sockets')
+
+    class _RenderServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+
+        daemon_threads = True
+
+        def __init__(self, socket_path, kernel_pool, max_queue, cache=None,
+                     image_sink=None):
+            super().__init__(
+                socket_path, _RenderHandler, bind_and_activate=False
+            )
+            self.kernel_pool = kernel_pool
+            self.max_queue = max_queue
+            self.slots = threading.BoundedSemaphore(max_queue)
+            self.cache = cache
+            self.image_sink = image_sink
+            try:
+                self.server_bind()
+                # anyone who can connect can run code as this user
+                os.chmod(socket_path, 0o600)
+                self.server_activate()
+            except BaseException:
+                self.server_close()
+                raise
+
+        def render(self, code_str, options):
+            from reprexpy.reprex import _render
+
+            return _render(
+                code_str, kernel_pool=self.kernel_pool, cache=self.cache,
+                image_sink=self.image_sink, **options
+            )
+
+    return _RenderServer
+
+
+# removes a socket that was left behind by a server that didn't exit cleanly.
+# fails if a server is still listening on it.
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+    else:
+        raise SystemExit(
+            'A reprexpy server is already listening on {}'.format(socket_path)
+        )
+    finally:
+        sock.close()
+
+
+def _serve_command(args):
+    from reprexpy.cache import RenderCache
+    from reprexpy.kernel_pool import KernelPool
+
+    server_class = _get_render_server_class()
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+    _remove_stale_socket(args.socket)
+
+    cache = None if args.no_cache else RenderCache()
+    with KernelPool(size=args.kernels) as pool:
+        pool.start()
+        server = server_class(
+            args.socket, pool, max_queue=args.max_queue or 4 * args.kernels,
+            cache=cache, image_sink=args.image_sink
+        )
+        # exit cleanly (removing the socket) when asked to stop
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        print('Serving reprexes on {}'.format(args.socket), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.socket)
+    return 0
+
+
+def _render_with_server(socket_path, code_str, options):
+    request = json.dumps(dict(options, code=code_str)).encode('utf-8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as f:
+            f.write(request + b'\n')
+            f.flush()
+            response = f.readline()
+    if not response:
+        return {'error': 'The server closed the connection'}
+    return json.loads(response.decode('utf-8'))
+
+
+def _render_command(args):
+    if args.file == '-':
+        code_str = sys.stdin.read()
+    else:
+        try:
+            with open(args.file) as fi:
+                code_str = fi.read()
+        except OSError as e:
+            print(
+                'Could not read {}: {}'.format(args.file, e), file=sys.stderr
+            )
+            return 1
+    if not hasattr(socket, 'AF_UNIX'):
+        print('`reprexpy render` needs unix domain sockets', file=sys.stderr)
+        return 1
+    options = {
+        'venue': args.venue, 'comment': args.comment, 'si': args.si,
+        'advertise': args.advertise, 'timeout': args.timeout,
+    }
+    try:
+        response = _render_with_server(args.socket, code_str, options)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(
+            'No reprexpy server is listening on {}. Start one with '
+            '`reprexpy serve`.'.format(args.socket), file=sys.stderr
+        )
+        return 1
+    if 'error' in response:
+        print(response['error'], file=sys.stderr)
+        return _EXIT_BUSY if response.get('busy') else 1
+    print(response['markdown'])
+    return 0
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='reprexpy', description='Render reproducible examples of Python '
+        'code, using a long-lived server that keeps kernels warm.'
+    )
+    parser.add_argument(
+        '--socket', default=_get_default_socket_path(),
+        help='the unix socket that the server listens on '
+        '(default: %(default)s)'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve = commands.add_parser('serve', help='start a render server')
+    serve.add_argument(
+        '--kernels', type=int, default=2,
+        help='the number of kernels to keep warm (default: %(default)s)'
+    )
+    serve.add_argument(
+        '--max-queue', type=int, default=None,
+        help='the number of renders that can be running or waiting at once, '
+        'beyond which renders are turned away (default: 4 per kernel)'
+    )
+    serve.add_argument(
+        '--image-sink', choices=['imgur', 'data-uri'], default=None,
+        help='where to send plots (default: imgur)'
+    )
+    serve.add_argument(
+        '--no-cache', action='store_true',
+        help="don't look renders up in (or add them to) the render cache"
+    )
+    serve.set_defaults(func=_serve_command)
+
+    render = commands.add_parser(
+        'render', help='render a reprex using a running server'
+    )
+    render.add_argument(
+        'file', nargs='?', default='-',
+        help='the file that holds the reprex (default: read from stdin)'
+    )
+    render.add_argument('--venue', choices=['gh', 'so', 'sx'], default='gh')
+    render.add_argument('--comment', default='#>')
+    render.add_argument('--si', action='store_true', help='add session info')
+    render.add_argument('--advertise', action='store_true')
+    render.add_argument(
+        '--timeout', type=float, default=None,
+        help='the number of seconds that each statement can run for'
+    )
+    render.set_defaults(func=_render_command)
+    return parser
+
+
+def main(argv=None):
+    r"""Run the ``reprexpy`` command line tool.
+
+    ``reprexpy serve`` starts a long-lived server that keeps a pool of warm
+    kernels (see :py:class:`reprexpy.kernel_pool.KernelPool`) and the render
+    cache behind a unix domain socket. ``reprexpy render [file]`` sends a
+    reprex (from ``file``, or from stdin) to the server and prints the
+    rendered markdown, so editors and shell pipelines don't pay for starting
+    a kernel on every render. When more renders are running or waiting than
+    the server allows (``--max-queue``), ``render`` fails with exit status 75
+    and can be retried later.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        The command line arguments. Defaults to ``sys.argv[1:]``.
+
+    Returns
+    -------
+    int
+        The exit status.
+
+    Examples
+    --------
+
+    .. code-block:: console
+
+        $ reprexpy serve --kernels 2 &
+        $ echo 'x = 1; x' | reprexpy render
+        ```python
+        x = 1; x
+        #> 1
+        ```
+    """
+    args = _get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,813 @@
+import collections
+import contextlib
+import functools
+import inspect
+import math
+import os
+import queue
+import sys
+import time
+import uuid
+
+from reprexpy.kernel_pool import _RESET_CODE, _get_kernel_spec_manager
+
+
+# the default caps on how many lines of text output are kept for a single cell
+# and for a whole session
+_MAX_OUTPUT_LINES = 1000
+_MAX_TOTAL_OUTPUT_LINES = 10000
+
+
+# text that only keeps its first and last few lines (max_lines in total) as it's
+# written to. the lines in between are replaced by a single marker line.
+class _ElidedText:
+
+    def __init__(self, max_lines):
+        self._n_head = (max_lines + 1) // 2
+        self._head = []
+        self._tail = collections.deque(maxlen=max_lines // 2)
+        self._partial = ''
+        self.n_omitted = 0
+
+    def write(self, text):
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._add_line(line)
+
+    # finishes the last line written (if it's unfinished), so the next write
+    # starts a new line
+    def end_line(self):
+        if self._partial:
+            self.write('\n')
+
+    def _add_line(self, line):
+        if len(self._head) < self._n_head:
+            self._head.append(line)
+            return
+        if len(self._tail) == self._tail.maxlen:
+            self.n_omitted += 1
+        self._tail.append(line)
+
+    @property
+    def n_lines(self):
+        return len(self._head) + len(self._tail) + bool(self.n_omitted)
+
+    def getvalue(self):
+        ends_with_newline = not self._partial
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = ''
+        lines = list(self._head)
+        if self.n_omitted:
+            lines.append('... {} line{} omitted ...'.format(
+                self.n_omitted, '' if self.n_omitted == 1 else 's'
+            ))
+        lines.extend(self._tail)
+        text = '\n'.join(lines)
+        return text + '\n' if lines and ends_with_newline else text
+
+
+# the outputs of one cell, which are capped at max_lines lines of text as they
+# arrive (so a cell that prints a lot doesn't use a lot of memory).
+# consecutive writes to the same stream are merged into one output. plots
+# don't count towards the cap, and neither do tracebacks (which IPython
+# already keeps short). text that arrives once the cap is used up is only
+# counted, and is replaced by a single marker at the end of the cell's outputs.
+class _BoundedOutputs:
+
+    def __init__(self, max_lines):
+        self.max_lines = max_lines
+        self.n_lines = 0
+        self._outputs = []
+        self._stream = None
+        self._stream_text = None
+        self._overflow = _ElidedText(0)
+        self._overflow_source = None
+
+    def add(self, output):
+        if output['output_type'] == 'stream':
+            if self._stream is not None and \
+                    self._stream['name'] == output['name']:
+                self._stream_text.write(output['text'])
+                return
+            self._close_stream()
+            if not self._lines_left():
+                self._omit(output['name'], output['text'])
+                return
+            self._stream = output
+            self._stream_text = _ElidedText(self._lines_left())
+            self._stream_text.write(output['text'])
+            # the text is put back (elided) once the stream is closed
+            output['text'] = ''
+        else:
+            self._close_stream()
+            if output['output_type'] == 'execute_result' and \
+                    'text/plain' in output['data']:
+                if not self._lines_left():
+                    self._omit(None, output['data']['text/plain'] + '\n')
+                    return
+                text = _ElidedText(self._lines_left())
+                text.write(output['data']['text/plain'])
+                output['data']['text/plain'] = text.getvalue()
+                self.n_lines += text.n_lines
+        self._outputs.append(output)
+
+    def clear(self):
+        self._outputs = []
+        self._stream = None
+        self._overflow = _ElidedText(0)
+        self._overflow_source = None
+        self.n_lines = 0
+
+    def finish(self):
+        self._close_stream()
+        marker = self._overflow.getvalue()
+        if marker:
+            self._outputs.append({
+                'output_type': 'stream', 'name': 'stdout', 'text': marker
+            })
+            self.n_lines += self._overflow.n_lines
+            self._overflow = _ElidedText(0)
+        return self._outputs
+
+    def _lines_left(self):
+        return max(0, self.max_lines - self.n_lines)
+
+    def _omit(self, source, text):
+        # a line that one stream left unfinished isn't continued by another
+        if source != self._overflow_source:
+            self._overflow.end_line()
+        self._overflow_source = source
+        self._overflow.write(text)
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream['text'] = self._stream_text.getvalue()
+            self.n_lines += self._stream_text.n_lines
+            self._stream = None
+
+
+# hands out the output caps for each of a session's cells, so that a cell's
+# output is capped at max_lines lines and all of the session's output at
+# max_total_lines lines
+class _OutputLimits:
+
+    def __init__(self, max_lines=_MAX_OUTPUT_LINES,
+                 max_total_lines=_MAX_TOTAL_OUTPUT_LINES):
+        self.max_lines = max_lines
+        self.lines_left = max_total_lines
+
+    def new_cell(self):
+        return _BoundedOutputs(min(self.max_lines, self.lines_left))
+
+    def finish_cell(self, outputs):
+        finished = outputs.finish()
+        self.lines_left = max(0, self.lines_left - outputs.n_lines)
+        return finished
+
+
+# how long to wait for a cell to stop after the kernel has been interrupted
+_INTERRUPT_GRACE = 10
+
+
+def _get_timeout_output(timeout):
+    return {
+        'output_type': 'error', 'ename': 'CellTimeout', 'evalue': '',
+        'traceback': ['[timed out after {:g}s]'.format(round(timeout, 1))]
+    }
+
+
+def _is_timeout_output(output):
+    return output['output_type'] == 'error' and output['ename'] == 'CellTimeout'
+
+
+# replace the KeyboardInterrupt that interrupting a cell causes with a note that
+# the cell timed out
+def _mark_timed_out(outputs, timeout):
+    outputs = [
+        i for i in outputs
+        if not (i['output_type'] == 'error' and
+                i['ename'] == 'KeyboardInterrupt')
+    ]
+    return outputs + [_get_timeout_output(timeout)]
+
+
+class ExecutionSession:
+    r"""A running Python session that a reprex's code is executed in.
+
+    Sessions are created by an :py:class:`ExecutionEngine`. Subclasses must
+    implement ``_execute()`` and ``close()``. Sessions can be used as context
+    managers, in which case they're closed when the ``with`` block exits.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, statement_chunk, timeout=None):
+        r"""Run one chunk of code (i.e., one cell) in the session.
+
+        Parameters
+        ----------
+        statement_chunk : list of str
+            The lines of code to run.
+        timeout : float, optional
+            Number of seconds the code can run for. If it runs for longer, it's
+            interrupted (the session itself is kept alive), and the outputs it
+            produced up to that point are returned, followed by an ``'error'``
+            output whose ``ename`` is ``'CellTimeout'``. ``None`` means the
+            engine's own timeout applies (which aborts the reprex).
+
+        Returns
+        -------
+        list of dict
+            The outputs that running the code produced, in the format that
+            nbformat uses for code cell outputs (i.e., dicts whose
+            ``output_type`` is one of ``'stream'``, ``'execute_result'``,
+            ``'display_data'`` or ``'error'``). Text output that's longer than
+            the engine allows is cut down to its first and last lines, with
+            a ``... N lines omitted ...`` line in between.
+        """
+        return self._execute(
+            '\n'.join(statement_chunk), store_history=True, timeout=timeout
+        )
+
+    def reset(self):
+        r"""Clear the session's namespace and input history."""
+        self._execute(_RESET_CODE, store_history=False)
+
+    def close(self):
+        r"""Shut the session down."""
+        raise NotImplementedError
+
+    def _execute(self, code, store_history, timeout=None):
+        raise NotImplementedError
+
+
+class ExecutionEngine:
+    r"""Base class for the engines that run a reprex's code.
+
+    ``reprex()`` hands the cells of a reprex to an engine, which runs them in a
+    fresh Python session and returns their outputs. Subclasses must implement
+    ``session()``.
+    """
+
+    def session(self, kernel_name=None, kernel_pool=None):
+        r"""Start a new session.
+
+        Parameters
+        ----------
+        kernel_name : str, optional
+            The name of the kernel to run code in (for engines that use
+            kernels).
+        kernel_pool : reprexpy.kernel_pool.KernelPool, optional
+            A pool of warm kernels to take the kernel from (for engines that
+            use kernels).
+
+        Returns
+        -------
+        ExecutionSession
+        """
+        raise NotImplementedError
+
+    def run(self, statement_chunks, kernel_name=None, kernel_pool=None):
+        r"""Run a list of cells in a fresh session.
+
+        Parameters
+        ----------
+        statement_chunks : list of list of str
+            The cells to run.
+        kernel_name, kernel_pool
+            See ``session()``.
+
+        Returns
+        -------
+        list of list of dict
+            The outputs of each cell (see ``ExecutionSession.execute()``).
+        """
+        with self.session(kernel_name, kernel_pool) as session:
+            return [session.execute(i) for i in statement_chunks]
+
+    # identifies the engine (and the settings that change what its outputs
+    # look like) in the render cache's keys
+    def _get_cache_key(self):
+        return [
+            type(self).__name__, getattr(self, 'max_output_lines', None),
+            getattr(self, 'max_total_output_lines', None)
+        ]
+
+
+# nbconvert engine ---------------------------
+
+
+# nbconvert (and the rest of the jupyter stack) is only imported once a reprex
+# is actually run, so that importing reprexpy stays cheap
+@functools.lru_cache(maxsize=None)
+def _get_preprocessor_class():
+    import nbconvert.preprocessors
+
+    class ExecutePreprocessorStoreHist(
+            nbconvert.preprocessors.ExecutePreprocessor):
+        # when set (to a _BoundedOutputs), a cell's outputs are collected
+        # there instead of in the notebook
+        bounded_outputs = None
+
+        def output(self, outs, msg, display_id, cell_index):
+            if self.bounded_outputs is None:
+                return super().output(outs, msg, display_id, cell_index)
+            if self.clear_before_next_output:
+                self.bounded_outputs.clear()
+            # outputs aren't kept in the notebook, so they can't be updated by
+            # display id
+            out = super().output([], msg, None, cell_index)
+            if out is not None:
+                self.bounded_outputs.add(out)
+            return out
+
+        def clear_output(self, outs, msg, cell_index):
+            if self.bounded_outputs is not None and \
+                    not msg['content'].get('wait'):
+                self.bounded_outputs.clear()
+            super().clear_output(outs, msg, cell_index)
+
+        def async_execute_cell(self, cell, cell_index, execution_count,
+                               store_history):
+            super().async_execute_cell(
+                cell=cell, cell_index=cell_index,
+                execution_count=execution_count, store_history=True
+            )
+
+    return ExecutePreprocessorStoreHist
+
+
+class _NbconvertSession(ExecutionSession):
+
+    def __init__(self, kernel_name, kernel_pool, timeout, output_limits):
+        import nbformat
+
+        kwargs = {} if kernel_name is None else {'kernel_name': kernel_name}
+        self._timeout = timeout
+        self._output_limits = output_limits
+        self._ep = _get_preprocessor_class()(
+            timeout=timeout, allow_errors=True, **kwargs
+        )
+        self._ep.nb = nbformat.v4.new_notebook()
+        self._exit_stack = contextlib.ExitStack()
+        try:
+            if kernel_pool is None:
+                self._ep.km = self._ep.create_kernel_manager()
+                self._ep.start_new_kernel()
+                self._exit_stack.callback(
+                    self._ep._cleanup_kernel  # pylint: disable=protected-access
+                )
+                self._ep.start_new_kernel_client()
+            else:
+                self._ep.km = self._exit_stack.enter_context(
+                    kernel_pool.acquire(kernel_name)
+                )
+                self._ep.start_new_kernel_client()
+                # the kernel goes back to the pool, but the client's channels
+                # need closing
+                self._exit_stack.callback(self._ep.kc.stop_channels)
+        except BaseException:
+            self._exit_stack.close()
+            raise
+
+    def close(self):
+        self._exit_stack.close()
+
+    def _execute(self, code, store_history, timeout=None):
+        import nbformat
+
+        # only the cell that's currently running is kept in the notebook, so
+        # the notebook doesn't grow over a long-lived session
+        cell = nbformat.v4.new_code_cell(code)
+        self._ep.nb.cells = [cell]
+        if timeout is None:
+            self._ep.timeout = self._timeout
+            self._ep.interrupt_on_timeout = False
+        else:
+            # nbclient only takes whole seconds
+            self._ep.timeout = max(1, math.ceil(timeout))
+            self._ep.interrupt_on_timeout = True
+        start = time.monotonic()
+        bounded_outputs = self._output_limits.new_cell()
+        self._ep.bounded_outputs = bounded_outputs
+        try:
+            self._ep.execute_cell(cell, 0, store_history=store_history)
+        finally:
+            self._ep.bounded_outputs = None
+        outputs = self._output_limits.finish_cell(bounded_outputs)
+        if timeout is not None and \
+                time.monotonic() - start >= self._ep.timeout and \
+                any(i.get('ename') == 'KeyboardInterrupt' for i in outputs):
+            outputs = _mark_timed_out(outputs, self._ep.timeout)
+        return outputs
+
+
+class NbconvertEngine(ExecutionEngine):
+    r"""Run reprexes in a Jupyter kernel, using nbconvert (the default engine).
+
+    Parameters
+    ----------
+    timeout : int, optional
+        Number of seconds a single cell can run for before the reprex is
+        aborted.
+    max_output_lines : int, optional
+        Number of lines of text output that are kept for a single cell. Longer
+        outputs are cut down to their first and last lines as they arrive.
+    max_total_output_lines : int, optional
+        Number of lines of text output that are kept for a whole reprex.
+    """
+
+    def __init__(self, timeout=600, max_output_lines=_MAX_OUTPUT_LINES,
+                 max_total_output_lines=_MAX_TOTAL_OUTPUT_LINES):
+        self.timeout = timeout
+        self.max_output_lines = max_output_lines
+        self.max_total_output_lines = max_total_output_lines
+
+    def session(self, kernel_name=None, kernel_pool=None):
+        return _NbconvertSession(
+            kernel_name, kernel_pool, self.timeout, _OutputLimits(
+                self.max_output_lines, self.max_total_output_lines
+            )
+        )
+
+
+# client engine ---------------------------
+
+
+# convert an iopub message into an output, or return None if the message isn't
+# an output
+def _output_from_msg(msg):
+    msg_type = msg['msg_type']
+    content = msg['content']
+    if msg_type == 'stream':
+        return {
+            'output_type': 'stream', 'name': content['name'],
+            'text': content['text']
+        }
+    if msg_type in ('display_data', 'execute_result'):
+        output = {
+            'output_type': msg_type, 'data': content['data'],
+            'metadata': content.get('metadata', {})
+        }
+        if msg_type == 'execute_result':
+            output['execution_count'] = content.get('execution_count')
+        return output
+    if msg_type == 'error':
+        return {
+            'output_type': 'error', 'ename': content['ename'],
+            'evalue': content['evalue'], 'traceback': content['traceback']
+        }
+    return None
+
+
+# add an iopub message's output (if it has one) to the outputs (a
+# _BoundedOutputs) of the request with id msg_id. returns True once the kernel
+# has finished the request.
+def _handle_iopub_msg(msg, msg_id, outputs):
+    if msg['parent_header'].get('msg_id') != msg_id:
+        return False
+    if msg['msg_type'] == 'status':
+        return msg['content']['execution_state'] == 'idle'
+    if msg['msg_type'] == 'clear_output':
+        outputs.clear()
+        return False
+    output = _output_from_msg(msg)
+    if output is not None:
+        outputs.add(output)
+    return False
+
+
+def _get_kernel_manager_kwargs(kernel_name, transport):
+    import jupyter_core.paths
+
+    kwargs = {
+        'transport': transport,
+        'kernel_spec_manager': _get_kernel_spec_manager()
+    }
+    if kernel_name is not None:
+        kwargs['kernel_name'] = kernel_name
+    if transport == 'ipc':
+        # jupyter_client puts ipc sockets in the working directory unless told
+        # otherwise
+        runtime_dir = jupyter_core.paths.jupyter_runtime_dir()
+        os.makedirs(runtime_dir, exist_ok=True)
+        kwargs['ip'] = os.path.join(
+            runtime_dir, 'reprexpy-{}-ipc'.format(uuid.uuid4().hex)
+        )
+    return kwargs
+
+
+def _get_dead_kernel_error(code):
+    return RuntimeError('The kernel died while running:\n' + code)
+
+
+def _get_timeout_error(timeout, code):
+    return TimeoutError(
+        'Cell execution timed out after {}s:\n{}'.format(timeout, code)
+    )
+
+
+# keeps track of a cell's deadline. engine_timeout aborts the reprex when it
+# passes, while a cell's own timeout interrupts the cell instead. after an
+# interrupt, the cell gets a grace period to stop in.
+class _Deadline:
+
+    def __init__(self, engine_timeout, timeout):
+        self.timeout = timeout
+        self.interrupted = False
+        limit = engine_timeout if timeout is None else timeout
+        self._deadline = time.monotonic() + limit
+
+    def poll_interval(self):
+        return min(1, max(0.01, self._deadline - time.monotonic()))
+
+    def passed(self):
+        return time.monotonic() >= self._deadline
+
+    def can_interrupt(self):
+        return self.timeout is not None and not self.interrupted
+
+    def start_grace_period(self):
+        self.interrupted = True
+        self._deadline = time.monotonic() + _INTERRUPT_GRACE
+
+    def mark_outputs(self, outputs):
+        if self.interrupted:
+            return _mark_timed_out(outputs, self.timeout)
+        return outputs
+
+
+class _ClientSession(ExecutionSession):
+
+    def __init__(self, kernel_name, kernel_pool, transport, timeout,
+                 startup_timeout, output_limits):
+        import jupyter_client
+
+        self._timeout = timeout
+        self._output_limits = output_limits
+        self._exit_stack = contextlib.ExitStack()
+        try:
+            if kernel_pool is None:
+                self._km = jupyter_client.KernelManager(
+                    **_get_kernel_manager_kwargs(kernel_name, transport)
+                )
+                self._km.start_kernel()
+                self._exit_stack.callback(self._km.shutdown_kernel, now=True)
+            else:
+                self._km = self._exit_stack.enter_context(
+                    kernel_pool.acquire(kernel_name)
+                )
+            self._kc = self._km.blocking_client()
+            self._kc.start_channels()
+            self._exit_stack.callback(self._kc.stop_channels)
+            self._kc.wait_for_ready(timeout=startup_timeout)
+        except BaseException:
+            self._exit_stack.close()
+            raise
+
+    def close(self):
+        self._exit_stack.close()
+
+    def _execute(self, code, store_history, timeout=None):
+        msg_id = self._kc.execute(
+            code, store_history=store_history, allow_stdin=False,
+            stop_on_error=False
+        )
+        deadline = _Deadline(self._timeout, timeout)
+        outputs = self._output_limits.new_cell()
+        while True:
+            try:
+                msg = self._kc.get_iopub_msg(timeout=deadline.poll_interval())
+            except queue.Empty:
+                if not self._km.is_alive():
+                    raise _get_dead_kernel_error(code)
+                if deadline.passed():
+                    if not deadline.can_interrupt():
+                        raise _get_timeout_error(self._timeout, code)
+                    self._km.interrupt_kernel()
+                    deadline.start_grace_period()
+                continue
+            if _handle_iopub_msg(msg, msg_id, outputs):
+                break
+
+        # the kernel sends its execute_reply on the shell channel. it has to be
+        # consumed so it isn't mistaken for the reply to the next request.
+        while True:
+            try:
+                reply = self._kc.get_shell_msg(timeout=self._timeout)
+            except queue.Empty:
+                if not self._km.is_alive():
+                    raise _get_dead_kernel_error(code)
+                raise
+            if reply['parent_header'].get('msg_id') == msg_id:
+                return deadline.mark_outputs(
+                    self._output_limits.finish_cell(outputs)
+                )
+
+
+# the asyncio counterpart of _ClientSession, which areprex() uses. the session
+# has to be started with `await session.start()` (or by using it as an async
+# context manager).
+class _AsyncClientSession:
+
+    def __init__(self, kernel_name=None, kernel_pool=None, transport=None,
+                 timeout=600, startup_timeout=60, output_limits=None):
+        if transport is None:
+            transport = 'tcp' if sys.platform == 'win32' else 'ipc'
+        self._kernel_name = kernel_name
+        self._kernel_pool = kernel_pool
+        self._transport = transport
+        self._timeout = timeout
+        self._startup_timeout = startup_timeout
+        self._output_limits = output_limits or _OutputLimits()
+        self._exit_stack = contextlib.AsyncExitStack()
+        self._km = None
+        self._kc = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def start(self):
+        import asyncio
+        import jupyter_client
+
+        try:
+            if self._kernel_pool is None:
+                self._km = jupyter_client.AsyncKernelManager(
+                    **_get_kernel_manager_kwargs(
+                        self._kernel_name, self._transport
+                    )
+                )
+                await self._km.start_kernel()
+                self._exit_stack.push_async_callback(
+                    self._km.shutdown_kernel, now=True
+                )
+            else:
+                # waiting for a free kernel blocks, and so does giving it back
+                # (which resets the kernel, and may start a replacement), so
+                # both are done in a thread
+                acquire = self._kernel_pool.acquire(self._kernel_name)
+                loop = asyncio.get_running_loop()
+                self._km = await loop.run_in_executor(None, acquire.__enter__)
+
+                async def release(*exc_info):
+                    return await loop.run_in_executor(
+                        None, acquire.__exit__, *exc_info
+                    )
+
+                self._exit_stack.push_async_exit(release)
+            # pooled kernel managers hand out async clients too
+            self._kc = self._km.client()
+            self._kc.start_channels()
+            self._exit_stack.callback(self._kc.stop_channels)
+            await self._kc.wait_for_ready(timeout=self._startup_timeout)
+        except BaseException:
+            await self._exit_stack.aclose()
+            raise
+
+    async def close(self):
+        await self._exit_stack.aclose()
+
+    async def execute(self, statement_chunk, timeout=None):
+        return await self._execute(
+            '\n'.join(statement_chunk), store_history=True, timeout=timeout
+        )
+
+    async def _execute(self, code, store_history, timeout=None):
+        msg_id = self._kc.execute(
+            code, store_history=store_history, allow_stdin=False,
+            stop_on_error=False
+        )
+        deadline = _Deadline(self._timeout, timeout)
+        outputs = self._output_limits.new_cell()
+        while True:
+            try:
+                msg = await self._kc.get_iopub_msg(
+                    timeout=deadline.poll_interval()
+                )
+            except queue.Empty:
+                if not await self._is_alive():
+                    raise _get_dead_kernel_error(code)
+                if deadline.passed():
+                    if not deadline.can_interrupt():
+                        raise _get_timeout_error(self._timeout, code)
+                    interrupted = self._km.interrupt_kernel()
+                    if inspect.isawaitable(interrupted):
+                        await interrupted
+                    deadline.start_grace_period()
+                continue
+            if _handle_iopub_msg(msg, msg_id, outputs):
+                break
+
+        while True:
+            try:
+                reply = await self._kc.get_shell_msg(timeout=self._timeout)
+            except queue.Empty:
+                if not await self._is_alive():
+                    raise _get_dead_kernel_error(code)
+                raise
+            if reply['parent_header'].get('msg_id') == msg_id:
+                return deadline.mark_outputs(
+                    self._output_limits.finish_cell(outputs)
+                )
+
+    async def _is_alive(self):
+        # pooled kernel managers are blocking, while the ones this session
+        # starts itself are async
+        alive = self._km.is_alive()
+        if inspect.isawaitable(alive):
+            alive = await alive
+        return alive
+
+
+class ClientEngine(ExecutionEngine):
+    r"""Run reprexes in a Jupyter kernel, talking to it with jupyter_client.
+
+    Like :py:class:`NbconvertEngine`, this engine runs code in a Jupyter
+    kernel. Instead of building a notebook and running it through nbconvert,
+    it sends each cell to the kernel as an ``execute_request`` and collects the
+    kernel's IOPub messages into outputs directly, which has less overhead.
+    Kernels started by this engine use ZeroMQ's ``ipc`` transport (Unix domain
+    sockets) by default, which is faster than TCP for local kernels.
+
+    Parameters
+    ----------
+    timeout : int, optional
+        Number of seconds a single cell can run for before the reprex is
+        aborted.
+    transport : {'ipc', 'tcp'}, optional
+        The transport used to talk to kernels that this engine starts (kernels
+        from a ``kernel_pool`` keep their own transport). Defaults to
+        ``'ipc'``, except on Windows, which only supports ``'tcp'``.
+    startup_timeout : int, optional
+        Number of seconds to wait for a kernel to start.
+    max_output_lines, max_total_output_lines : int, optional
+        See :py:class:`NbconvertEngine`. Long outputs are cut down as the
+        kernel's messages arrive.
+    """
+
+    def __init__(self, timeout=600, transport=None, startup_timeout=60,
+                 max_output_lines=_MAX_OUTPUT_LINES,
+                 max_total_output_lines=_MAX_TOTAL_OUTPUT_LINES):
+        self.timeout = timeout
+        if transport is None:
+            transport = 'tcp' if sys.platform == 'win32' else 'ipc'
+        self.transport = transport
+        self.startup_timeout = startup_timeout
+        self.max_output_lines = max_output_lines
+        self.max_total_output_lines = max_total_output_lines
+
+    def session(self, kernel_name=None, kernel_pool=None):
+        return _ClientSession(
+            kernel_name, kernel_pool, transport=self.transport,
+            timeout=self.timeout, startup_timeout=self.startup_timeout,
+            output_limits=_OutputLimits(
+                self.max_output_lines, self.max_total_output_lines
+            )
+        )
+
+
+# the shell engine lives in reprexpy.shell_engine (which builds on this
+# module), so it's only looked up when it's needed
+def _get_engine_classes():
+    from reprexpy.shell_engine import ShellEngine
+    return {
+        'nbconvert': NbconvertEngine, 'client': ClientEngine,
+        'shell': ShellEngine
+    }
+
+
+def _get_engine(engine):
+    if engine is None:
+        return NbconvertEngine()
+    if isinstance(engine, str):
+        engines = _get_engine_classes()
+        try:
+            return engines[engine]()
+        except KeyError:
+            raise ValueError(
+                'Unknown engine {!r}. Choose one of {}'.format(
+                    engine, ', '.join(sorted(engines))
+                )
+            )
+    return engine
+
+
+def __getattr__(name):
+    # kept for backwards compatibility, from before ShellEngine moved to
+    # reprexpy.shell_engine
+    if name == 'ShellEngine':
+        return _get_engine_classes()['shell']
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name)
+    )
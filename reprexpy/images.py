@@ -0,0 +1,542 @@
+import base64
+import binascii
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+from reprexpy.cache import ImageCache
+from reprexpy.profiling import _get_decoded_size
+
+CLIENT_ID = '14fb4fdc5c02a96'
+IMGUR_URL = 'https://api.imgur.com/3/image'
+
+
+# deterministic placeholder for images that couldn't be uploaded, so test
+# expectations still work
+def _get_upload_error_url(data):
+    digest = hashlib.sha1(data.encode()).hexdigest()[:10]
+    return f'https://imgur.com/upload-error-{digest}'
+
+
+def _get_image_digest(data):
+    try:
+        png = base64.b64decode(data)
+    except binascii.Error:
+        png = data.encode()
+    return hashlib.sha256(png).hexdigest()
+
+
+# a token bucket that lets through at most `rate` calls per second on average,
+# with bursts of up to `burst` calls
+class _RateLimiter:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    # take a token, returning how long the caller has to wait before using it
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class _RetryableError(Exception):
+
+    def __init__(self, retry_after=None):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+def _is_name_resolution_error(error):
+    import urllib3
+
+    # NameResolutionError is only in urllib3>=2
+    name_error = getattr(urllib3.exceptions, 'NameResolutionError', ())
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, name_error)
+
+
+class ImageSink:
+    r"""Base class for the places that a reprex's plots are sent to.
+
+    When a reprex makes plots, each plot is handed to an image sink, which
+    stores it somewhere and returns the URL that the rendered reprex should
+    link to. Subclasses must implement ``upload()``, and can override
+    ``upload_many()`` if they can store several images at once more efficiently
+    than one at a time.
+    """
+
+    def upload(self, data):
+        r"""Store one image.
+
+        Parameters
+        ----------
+        data : str
+            The base64-encoded PNG image.
+
+        Returns
+        -------
+        str
+            The image's URL.
+        """
+        raise NotImplementedError
+
+    def upload_many(self, images):
+        r"""Store several images.
+
+        Parameters
+        ----------
+        images : list of str
+            The base64-encoded PNG images.
+
+        Returns
+        -------
+        list of str
+            The images' URLs, in the same order as ``images``.
+        """
+        return [self.upload(i) for i in images]
+
+    # the parts of the sink's configuration that affect the urls it returns.
+    # these go into the render cache's keys.
+    def _get_cache_key(self):
+        return [type(self).__name__]
+
+    # stores the images, returning their urls along with the (decoded) number
+    # of bytes that were actually uploaded, for RenderProfile.bytes_uploaded.
+    # sinks are assumed to upload every image unless they override this.
+    def _upload_many_and_count(self, images):
+        return self.upload_many(images), \
+            sum(_get_decoded_size(i) for i in images)
+
+
+class HTTPSink(ImageSink):
+    r"""Upload plots to an HTTP endpoint.
+
+    Plots are uploaded concurrently by a small pool of threads that share one
+    keep-alive HTTP session, so a reprex with many plots doesn't pay for a TLS
+    handshake per plot. Uploads that fail because of a network error, a
+    server error, or rate limiting by the server are retried with exponential
+    backoff, and uploads can be rate limited on the client side. Plots that
+    still can't be uploaded get a placeholder URL
+    (``https://imgur.com/upload-error-<sha>``) instead of failing the reprex.
+
+    Parameters
+    ----------
+    url : str
+        The endpoint that images are POSTed to. Images are sent in an ``image``
+        form field, as base64-encoded PNG data. The endpoint has to respond
+        with either the image's URL (as plain text) or JSON that holds the URL
+        in a ``link`` or ``url`` field (or in ``data.link``, like imgur's API
+        does).
+    headers : dict, optional
+        Extra headers to send with each upload (e.g., for authentication).
+    max_workers : int, optional
+        The maximum number of uploads that can run at once.
+    connect_timeout, read_timeout : float, optional
+        Number of seconds to wait for a connection to the server to be made,
+        and for the server to respond once it has been.
+    max_retries : int, optional
+        The number of times to retry a failed upload.
+    backoff : float, optional
+        Number of seconds to wait before the first retry. The wait doubles with
+        each retry after that.
+    max_rate : float, optional
+        The maximum number of uploads to start per second (on average), or
+        ``None`` for no limit.
+    image_cache : reprexpy.cache.ImageCache, optional
+        A record of the URLs that images were uploaded to. Images that were
+        already uploaded to ``url`` aren't uploaded again. Byte-identical images
+        are only uploaded once per call to ``upload_many()`` either way.
+
+    Examples
+    --------
+
+    >>> import reprexpy
+    >>> from reprexpy.images import HTTPSink
+    >>> sink = HTTPSink('http://localhost:8000/images')
+    >>> code_file = reprexpy.reprex_ex('plotting.py')
+    >>> out = reprexpy.reprex(  # doctest: +SKIP
+    ...     code_file=code_file, image_sink=sink
+    ... )
+    """
+
+    def __init__(self, url, headers=None, max_workers=4, connect_timeout=5,
+                 read_timeout=30, max_retries=3, backoff=0.5, max_rate=None,
+                 image_cache=None):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.max_workers = max_workers
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_rate = max_rate
+        self.image_cache = image_cache
+        self._init_session()
+
+    # the session, its lock and the rate limiter can't be pickled (e.g., when a
+    # sink is sent to reprex_many()'s worker processes), so they're recreated
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for i in ['_session', '_session_lock', '_rate_limiter']:
+            del state[i]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_session()
+
+    def _init_session(self):
+        self._rate_limiter = None if self.max_rate is None \
+            else _RateLimiter(self.max_rate, burst=self.max_workers)
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def upload(self, data):
+        return self.upload_many([data])[0]
+
+    def upload_many(self, images):
+        return self._upload_many_and_count(images)[0]
+
+    def _upload_many_and_count(self, images):
+        digests = [_get_image_digest(i) for i in images]
+        urls = self._get_cached_urls(digests)
+        to_upload = _get_images_to_upload(digests, images, urls)
+
+        if len(to_upload) > 1:
+            workers = min(self.max_workers, len(to_upload))
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                new_urls = list(executor.map(self._upload, to_upload.values()))
+        else:
+            new_urls = [self._upload(i) for i in to_upload.values()]
+
+        n_bytes = self._add_new_urls(urls, to_upload, new_urls)
+        return [urls[i] for i in digests], n_bytes
+
+    async def aupload_many(self, images):
+        r"""The asyncio counterpart of ``upload_many()``.
+
+        Images are uploaded with tornado's async HTTP client instead of in
+        threads.
+
+        Parameters
+        ----------
+        images : list of str
+            The base64-encoded PNG images.
+
+        Returns
+        -------
+        list of str
+            The images' URLs, in the same order as ``images``.
+        """
+        return (await self._aupload_many_and_count(images))[0]
+
+    async def _aupload_many_and_count(self, images):
+        import asyncio
+
+        # the image cache is an sqlite database, so it's used in a thread
+        loop = asyncio.get_running_loop()
+        digests = [_get_image_digest(i) for i in images]
+        urls = await loop.run_in_executor(None, self._get_cached_urls, digests)
+        to_upload = _get_images_to_upload(digests, images, urls)
+
+        new_urls = await asyncio.gather(
+            *[self._aupload(i) for i in to_upload.values()]
+        )
+
+        n_bytes = await loop.run_in_executor(
+            None, self._add_new_urls, urls, to_upload, new_urls
+        )
+        return [urls[i] for i in digests], n_bytes
+
+    def _get_cached_urls(self, digests):
+        if self.image_cache is None:
+            return {}
+        return self.image_cache.get_many(self.url, digests)
+
+    # add the urls of newly uploaded images to `urls` (and the image cache),
+    # swapping in placeholders for the images that couldn't be uploaded.
+    # returns the (decoded) size of the images that were uploaded.
+    def _add_new_urls(self, urls, to_upload, new_urls):
+        n_bytes = 0
+        for (digest, data), url in zip(to_upload.items(), new_urls):
+            if url is None:
+                url = _get_upload_error_url(data)
+            else:
+                n_bytes += _get_decoded_size(data)
+                if self.image_cache is not None:
+                    self.image_cache.put(self.url, digest, url)
+            urls[digest] = url
+        return n_bytes
+
+    # returns None if the image couldn't be uploaded
+    def _upload(self, data):
+        import requests
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._post(data)
+            except _RetryableError as e:
+                delay = e.retry_after
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # retrying won't help if the server's name can't be resolved
+                # (e.g., because there's no network)
+                if _is_name_resolution_error(e):
+                    break
+                delay = None
+            except Exception:  # pylint: disable=broad-except
+                break
+            if attempt < self.max_retries:
+                time.sleep(
+                    delay if delay is not None else self.backoff * 2 ** attempt
+                )
+        return None
+
+    def _get_cache_key(self):
+        return [type(self).__name__, self.url]
+
+    def _get_session(self):
+        with self._session_lock:
+            if self._session is None:
+                import requests
+
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_maxsize=self.max_workers
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(self.headers)
+                self._session = session
+            return self._session
+
+    def _post(self, data):
+        if self._rate_limiter is not None:
+            self._rate_limiter.wait()
+        resp = self._get_session().post(
+            self.url, data={'image': data}, timeout=self.timeout
+        )
+        if resp.status_code == 429 or resp.status_code >= 500:
+            retry_after = resp.headers.get('Retry-After')
+            # don't let the server stall the reprex for too long
+            raise _RetryableError(
+                min(float(retry_after), 60)
+                if retry_after and retry_after.isdigit() else None
+            )
+        resp.raise_for_status()
+        return _get_link(resp.headers.get('Content-Type', ''), resp.text)
+
+    # the tornado version of _upload()
+    async def _aupload(self, data):
+        import asyncio
+        import socket
+        import urllib.parse
+        import tornado.httpclient
+
+        client = tornado.httpclient.AsyncHTTPClient()
+        for attempt in range(self.max_retries + 1):
+            if self._rate_limiter is not None:
+                await asyncio.sleep(self._rate_limiter.reserve())
+            try:
+                # http errors and timeouts (which tornado reports as 599s) are
+                # returned rather than raised
+                resp = await client.fetch(
+                    self.url, method='POST', headers=self.headers,
+                    body=urllib.parse.urlencode({'image': data}),
+                    connect_timeout=self.timeout[0],
+                    request_timeout=self.timeout[1], raise_error=False
+                )
+            except socket.gaierror:
+                # retrying won't help if the server's name can't be resolved
+                return None
+            except OSError:
+                resp = None
+            if resp is not None and 200 <= resp.code < 300:
+                try:
+                    return _get_link(
+                        resp.headers.get('Content-Type', ''),
+                        resp.body.decode()
+                    )
+                except (ValueError, KeyError):
+                    return None
+            if resp is not None and resp.code != 429 and resp.code < 500:
+                return None
+            retry_after = None if resp is None \
+                else resp.headers.get('Retry-After')
+            if attempt < self.max_retries:
+                await asyncio.sleep(
+                    min(float(retry_after), 60)
+                    if retry_after and retry_after.isdigit()
+                    else self.backoff * 2 ** attempt
+                )
+        return None
+
+
+# maps digests to the images that need uploading (i.e., that aren't in `urls`).
+# byte-identical images are only uploaded once.
+def _get_images_to_upload(digests, images, urls):
+    to_upload = {}
+    for digest, data in zip(digests, images):
+        if digest not in urls:
+            to_upload.setdefault(digest, data)
+    return to_upload
+
+
+def _get_link(content_type, body):
+    if 'json' not in content_type:
+        return body.strip()
+    payload = json.loads(body)
+    if isinstance(payload.get('data'), dict):
+        payload = payload['data']
+    return payload['link'] if 'link' in payload else payload['url']
+
+
+class ImgurSink(HTTPSink):
+    r"""Upload plots to imgur (the default image sink).
+
+    Parameters
+    ----------
+    client_id : str, optional
+        The imgur API client ID to upload with.
+    max_rate : float, optional
+        The maximum number of uploads to start per second (on average), so that
+        a batch of plots doesn't use up the imgur API quota.
+    image_cache : reprexpy.cache.ImageCache, optional
+        A record of the URLs that images were uploaded to, so that re-rendering
+        a reprex doesn't upload its plots again. Defaults to an ``ImageCache``
+        in reprexpy's cache directory. Use ``image_cache=None`` to always
+        upload.
+    **kwargs
+        Passed on to :py:class:`HTTPSink` (e.g., ``max_workers``,
+        ``read_timeout``, or ``max_retries``).
+    """
+
+    def __init__(self, client_id=CLIENT_ID, max_rate=2, **kwargs):
+        if 'image_cache' not in kwargs:
+            kwargs['image_cache'] = ImageCache()
+        kwargs.setdefault('url', IMGUR_URL)
+        kwargs.setdefault(
+            'headers', {'Authorization': 'Client-ID ' + client_id}
+        )
+        super().__init__(max_rate=max_rate, **kwargs)
+
+
+class DirectorySink(ImageSink):
+    r"""Write plots to PNG files in a directory.
+
+    Each plot is written to a file named after a hash of its contents, so
+    re-rendering a reprex overwrites its old plots instead of piling up new
+    copies of them. No network requests are made.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write the plots to. It's created if it doesn't exist.
+    link_prefix : str, optional
+        What to put in front of the plots' file names in the rendered reprex.
+        By default, plots are linked to by their paths relative to
+        ``link_base``.
+    link_base : str, optional
+        The directory that the rendered reprex will be saved in, which links to
+        the plots are relative to. Defaults to the current working directory
+        (at the time the reprex is rendered).
+
+    Examples
+    --------
+
+    >>> import reprexpy
+    >>> from reprexpy.images import DirectorySink
+    >>> code_file = reprexpy.reprex_ex('plotting.py')
+    >>> sink = DirectorySink('figures')
+    >>> out = reprexpy.reprex(  # doctest: +SKIP
+    ...     code_file=code_file, image_sink=sink
+    ... )
+    """
+
+    def __init__(self, directory, link_prefix=None, link_base=None):
+        self.directory = directory
+        self.link_prefix = link_prefix
+        self.link_base = link_base
+
+    def upload(self, data):
+        png = base64.b64decode(data)
+        name = hashlib.sha256(png).hexdigest()[:16] + '.png'
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as fo:
+            fo.write(png)
+        if self.link_prefix is not None:
+            prefix = self.link_prefix.replace(os.sep, '/').rstrip('/')
+            return prefix + '/' + name if prefix else name
+        try:
+            link = os.path.relpath(path, start=self._get_link_base())
+        except ValueError:
+            # the plot is on a different drive than link_base (on windows)
+            link = os.path.abspath(path)
+        return link.replace(os.sep, '/')
+
+    def _get_link_base(self):
+        return os.path.abspath(self.link_base or os.getcwd())
+
+    def _get_cache_key(self):
+        return [
+            type(self).__name__, os.path.abspath(self.directory),
+            self.link_prefix, self._get_link_base()
+        ]
+
+    def _upload_many_and_count(self, images):
+        # plots are written to disk rather than uploaded
+        return self.upload_many(images), 0
+
+
+class DataURISink(ImageSink):
+    r"""Embed plots in the rendered reprex as base64 data URIs.
+
+    No files are written and no network requests are made, but note that some
+    venues (including GitHub) don't display images that are embedded this way.
+    """
+
+    def upload(self, data):
+        return 'data:image/png;base64,' + ''.join(data.split())
+
+    def _upload_many_and_count(self, images):
+        return self.upload_many(images), 0
+
+
+_IMAGE_SINKS = {'imgur': ImgurSink, 'data-uri': DataURISink}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_default_sink():
+    return ImgurSink()
+
+
+def _get_image_sink(image_sink):
+    if image_sink is None or image_sink == 'imgur':
+        return _get_default_sink()
+    if isinstance(image_sink, str):
+        try:
+            return _IMAGE_SINKS[image_sink]()
+        except KeyError:
+            raise ValueError(
+                'Unknown image sink {!r}. Choose one of {}, or pass in an '
+                'ImageSink'.format(image_sink, ', '.join(sorted(_IMAGE_SINKS)))
+            )
+    return image_sink
@@ -0,0 +1,300 @@
+import contextlib
+import functools
+import queue
+import sys
+import threading
+import weakref
+
+
+# code that's run (silently, without touching the history) in a kernel after a
+# render finishes, so the next render sees a clean namespace and `In` history.
+# note, modules that the previous render imported stay in sys.modules.
+_RESET_CODE = '\n'.join([
+    'import os as _os, sys as _sys',
+    '_os.environ.pop("REPREX_RUNNING", None)',
+    'if "matplotlib.pyplot" in _sys.modules:',
+    '    _sys.modules["matplotlib.pyplot"].close("all")',
+    'get_ipython().reset(new_session=True)',
+])
+
+# peak resident set size of the kernel process. ru_maxrss is in kilobytes on
+# linux and bytes on macOS. this fails on windows, in which case the memory
+# ceiling is simply not enforced.
+_RSS_EXPRESSION = '__import__("resource").getrusage(0).ru_maxrss'
+
+
+# jupyter_client's KernelSpecManager rescans every kernelspec directory each
+# time a spec is looked up. specs are looked up each time a kernel is started
+# (and when building cache keys), so they're cached for the life of the process.
+@functools.lru_cache(maxsize=None)
+def _get_kernel_spec_manager():
+    import jupyter_client.kernelspec
+
+    class CachingKernelSpecManager(jupyter_client.kernelspec.KernelSpecManager):
+        _specs = {}
+
+        def get_kernel_spec(self, kernel_name):
+            if kernel_name not in self._specs:
+                self._specs[kernel_name] = super().get_kernel_spec(kernel_name)
+            return self._specs[kernel_name]
+
+    return CachingKernelSpecManager()
+
+
+# shuts down a pool's kernels when the pool is shut down, garbage collected or
+# when the interpreter exits (whichever comes first)
+def _shutdown_kernels(kernels, lock):
+    with lock:
+        to_shut_down = list(kernels)
+        kernels.clear()
+    for kernel in to_shut_down:
+        kernel.shutdown()
+
+
+class _PooledKernel:
+
+    def __init__(self, kernel_name, startup_timeout):
+        import jupyter_client
+
+        kwargs = {} if kernel_name is None else {'kernel_name': kernel_name}
+        # nbclient expects an async client, even though the pool manages the
+        # kernel's lifecycle synchronously
+        self.km = jupyter_client.KernelManager(
+            client_class='jupyter_client.asynchronous.AsyncKernelClient',
+            kernel_spec_manager=_get_kernel_spec_manager(), **kwargs
+        )
+        self.km.start_kernel()
+        self.runs = 0
+        self._startup_timeout = startup_timeout
+
+    def wait_for_ready(self):
+        kc = self._blocking_client()
+        try:
+            kc.wait_for_ready(timeout=self._startup_timeout)
+        finally:
+            kc.stop_channels()
+
+    def reset(self):
+        # returns the kernel's peak memory use in bytes (or None if it couldn't
+        # be determined)
+        kc = self._blocking_client()
+        try:
+            reply = kc.execute_interactive(
+                _RESET_CODE, silent=True, store_history=False,
+                user_expressions={'rss': _RSS_EXPRESSION},
+                output_hook=lambda msg: None, timeout=self._startup_timeout
+            )
+        finally:
+            kc.stop_channels()
+        rss = reply['content'].get('user_expressions', {}).get('rss', {})
+        if rss.get('status') != 'ok':
+            return None
+        rss = int(rss['data']['text/plain'])
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+    def shutdown(self):
+        try:
+            self.km.shutdown_kernel(now=True)
+        except RuntimeError:
+            pass
+
+    def _blocking_client(self):
+        # a blocking client whose parent is the kernel manager, so liveness is
+        # checked against the kernel process rather than its heartbeat
+        kc = self.km.blocking_client()
+        kc.start_channels()
+        return kc
+
+
+class KernelPool:
+    r"""A pool of warm IPython kernels that can be shared across reprexes.
+
+    Starting a kernel accounts for most of the time that ``reprex()`` spends
+    rendering a small reprex. A ``KernelPool`` keeps ``size`` kernels running
+    for each kernel name it's asked for, and hands them out to ``reprex()``
+    calls (including calls made concurrently from several threads). After each
+    render, the kernel's namespace and input history are reset so that the
+    next reprex starts from a clean slate. Note, modules imported by an
+    earlier reprex remain loaded in the kernel.
+
+    Parameters
+    ----------
+    size : int, optional
+        The number of kernels to keep running for each kernel name.
+    max_runs : int, optional
+        The number of renders a kernel is used for before it's shut down and
+        replaced by a fresh one. Use ``None`` to reuse kernels indefinitely.
+    max_memory : int, optional
+        Peak memory use (in bytes) of a kernel above which the kernel is
+        replaced by a fresh one. Use ``None`` (the default) for no ceiling.
+        This parameter is ignored on Windows.
+    startup_timeout : int, optional
+        Number of seconds to wait for a kernel to start (or be reset).
+
+    Examples
+    --------
+
+    >>> import reprexpy
+    >>> pool = reprexpy.KernelPool(size=2)
+    >>> pool.start()
+    >>> out = reprexpy.reprex('x = 1\nx', kernel_pool=pool)
+    >>> pool.shutdown()
+    """
+
+    def __init__(self, size=1, max_runs=50, max_memory=None,
+                 startup_timeout=60):
+        if size < 1:
+            raise ValueError('`size` must be at least 1')
+        self.size = size
+        self.max_runs = max_runs
+        self.max_memory = max_memory
+        self.startup_timeout = startup_timeout
+        self._idle = {}
+        self._all = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # a finalizer (rather than an atexit hook) so the pool isn't kept alive
+        # for the life of the process
+        self._finalizer = weakref.finalize(
+            self, _shutdown_kernels, self._all, self._lock
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def start(self, kernel_name=None):
+        r"""Pre-start the kernels for a given kernel name.
+
+        Kernels are otherwise started the first time they're needed.
+
+        Parameters
+        ----------
+        kernel_name : str, optional
+            The name of the kernel to start. ``None`` means the default kernel.
+        """
+        self._get_idle_queue(kernel_name)
+
+    @contextlib.contextmanager
+    def acquire(self, kernel_name=None, timeout=None):
+        r"""Check a kernel out of the pool.
+
+        Blocks until a kernel is free. The kernel is reset (or recycled) and
+        returned to the pool when the context manager exits.
+
+        Parameters
+        ----------
+        kernel_name : str, optional
+            The name of the kernel you want. ``None`` means the default kernel.
+        timeout : float, optional
+            Number of seconds to wait for a free kernel before raising
+            ``queue.Empty``. ``None`` means wait forever.
+
+        Yields
+        ------
+        jupyter_client.KernelManager
+            The manager of a running kernel.
+        """
+        idle = self._get_idle_queue(kernel_name)
+        kernel = idle.get(timeout=timeout)
+        if kernel is None:
+            # an empty slot, left by a kernel that died and couldn't be
+            # replaced
+            try:
+                kernel = self._start_kernels(kernel_name, 1)[0]
+            except BaseException:
+                idle.put(None)
+                raise
+        try:
+            yield kernel.km
+        finally:
+            kernel.runs += 1
+            idle.put(self._release(kernel, kernel_name))
+
+    def shutdown(self):
+        r"""Shut down all of the kernels in the pool."""
+        with self._lock:
+            self._closed = True
+            self._idle = {}
+        self._finalizer()
+
+    def _get_idle_queue(self, kernel_name):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('This KernelPool has been shut down')
+            if kernel_name in self._idle:
+                return self._idle[kernel_name]
+            idle = queue.Queue()
+            self._idle[kernel_name] = idle
+        # the kernels are started outside of the lock, so callers that want
+        # other kernels aren't held up. callers that want these kernels wait
+        # on the queue until the kernels are ready. if they can't be started,
+        # empty slots are queued instead.
+        kernels = []
+        try:
+            kernels = self._start_kernels(kernel_name, self.size)
+        finally:
+            for kernel in kernels:
+                idle.put(kernel)
+            for _ in range(self.size - len(kernels)):
+                idle.put(None)
+        return idle
+
+    # starts n kernels and waits for them to be ready. all kernels are launched
+    # before we wait on any of them, so they start up in parallel.
+    def _start_kernels(self, kernel_name, n):
+        kernels = []
+        try:
+            for _ in range(n):
+                kernel = _PooledKernel(kernel_name, self.startup_timeout)
+                kernels.append(kernel)
+                with self._lock:
+                    if self._closed:
+                        raise RuntimeError('This KernelPool has been shut down')
+                    self._all.append(kernel)
+            for kernel in kernels:
+                kernel.wait_for_ready()
+        except BaseException:
+            for kernel in kernels:
+                self._discard(kernel)
+            raise
+        return kernels
+
+    def _discard(self, kernel):
+        kernel.shutdown()
+        with self._lock:
+            if kernel in self._all:
+                self._all.remove(kernel)
+
+    # returns the kernel (or its replacement) to put back in the pool, or None
+    # (an empty slot) if the kernel is broken and couldn't be replaced, so the
+    # pool never shrinks
+    def _release(self, kernel, kernel_name):
+        try:
+            return self._recycle(kernel, kernel_name)
+        except Exception:  # pylint: disable=broad-except
+            self._discard(kernel)
+            return None
+
+    def _recycle(self, kernel, kernel_name):
+        rss = None
+        if kernel.km.is_alive():
+            try:
+                rss = kernel.reset()
+            except (RuntimeError, TimeoutError):
+                kernel.km.shutdown_kernel(now=True)
+        worn_out = (
+            self._closed or not kernel.km.is_alive() or
+            (self.max_runs is not None and kernel.runs >= self.max_runs) or
+            (self.max_memory is not None and rss is not None and
+             rss > self.max_memory)
+        )
+        if not worn_out:
+            return kernel
+
+        self._discard(kernel)
+        if self._closed:
+            return kernel
+        return self._start_kernels(kernel_name, 1)[0]
@@ -0,0 +1,175 @@
+import collections
+import contextlib
+import time
+
+
+CellProfile = collections.namedtuple(
+    'CellProfile', ['index', 'code', 'seconds', 'output_bytes']
+)
+CellProfile.__doc__ = r"""How long one of a reprex's statements took to run.
+
+Attributes
+----------
+index : int
+    The position of the statement in the reprex.
+code : str
+    The statement's code.
+seconds : float
+    The wall time that running the statement took.
+output_bytes : int
+    The size of the statement's outputs (text, plus any base64-encoded plots).
+"""
+
+
+def _get_output_bytes(one_out):
+    size = 0
+    for output in one_out:
+        if output['output_type'] == 'stream':
+            size += len(output['text'].encode('utf-8'))
+        elif output['output_type'] == 'error':
+            size += sum(len(i.encode('utf-8')) for i in output['traceback'])
+        else:
+            size += sum(
+                len(v.encode('utf-8')) for v in output.get('data', {}).values()
+                if isinstance(v, str)
+            )
+    return size
+
+
+def _get_decoded_size(b64_data):
+    # jupyter wraps base64 data over several lines, and the line breaks don't
+    # encode anything
+    b64_data = ''.join(b64_data.split())
+    return len(b64_data) * 3 // 4 - b64_data[-2:].count('=')
+
+
+class RenderProfile:
+    r"""Where the time went while a reprex was rendering.
+
+    Pass a ``RenderProfile`` to ``reprex()`` (or ``areprex()``) as its
+    ``profile`` and it's filled in as the reprex renders: with the wall time of
+    each phase of the render (e.g., starting the kernel, running each
+    statement, or uploading plots), the size of each statement's outputs, and
+    the number of bytes of plots that the image sink actually uploaded.
+    Printing a ``RenderProfile`` gives a report of these numbers.
+
+    Parameters
+    ----------
+    callback : callable, optional
+        A function that's called with each measurement as soon as it's taken,
+        e.g., to export it to a metrics pipeline. It's passed a dict with an
+        ``'event'`` item (``'phase'``, ``'cell'`` or ``'images'``) plus the
+        measurement's fields (``'name'`` and ``'seconds'`` for phases, the
+        fields of :py:class:`CellProfile` for cells, and ``'n_images'`` and
+        ``'bytes'`` for images). Errors in the callback aren't caught.
+
+    Attributes
+    ----------
+    phases : dict
+        Maps the name of each phase (``'cache lookup'``, ``'kernel startup'``,
+        ``'setup code'``, ``'cells'``, ``'images'``, ``'formatting'``,
+        ``'cache write'`` and ``'clipboard'``) to the number of seconds it
+        took. Phases that the render skipped (e.g., everything after
+        ``'cache lookup'`` on a cache hit) are left out.
+    cells : list of CellProfile
+        The statements that were run, in order.
+    n_images : int
+        The number of plots that were sent to the image sink.
+    bytes_uploaded : int
+        The (decoded) size of the plots that the image sink uploaded. Plots
+        that it found in its image cache, or that it didn't send anywhere
+        (e.g., plots embedded by a ``DataURISink``), don't count.
+    cache_hit : bool
+        Was the reprex found in the render cache?
+
+    Examples
+    --------
+
+    >>> import reprexpy
+    >>> from reprexpy.profiling import RenderProfile
+    >>> profile = RenderProfile()
+    >>> out = reprexpy.reprex('import time\ntime.sleep(1)', profile=profile)
+    >>> print(profile)  # doctest: +SKIP
+    cache lookup      0.000s
+    kernel startup    1.152s
+    setup code        0.051s
+    cells             1.004s
+      [0]             0.002s  (0 B)  import time
+      [1]             1.002s  (0 B)  time.sleep(1)
+    images            0.000s  (0 plots, 0 B)
+    formatting        0.000s
+    clipboard         0.003s
+    total             2.210s
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.phases = {}
+        self.cells = []
+        self.n_images = 0
+        self.bytes_uploaded = 0
+        self.cache_hit = False
+
+    @property
+    def total(self):
+        r"""float: The total wall time of the render's phases."""
+        return sum(self.phases.values())
+
+    @property
+    def output_bytes(self):
+        r"""int: The total size of the outputs of the statements that ran."""
+        return sum(i.output_bytes for i in self.cells)
+
+    def __str__(self):
+        lines = []
+        for name, seconds in self.phases.items():
+            line = '{:<16}{:7.3f}s'.format(name, seconds)
+            if name == 'images':
+                line += '  ({} plots, {} B)'.format(
+                    self.n_images, self.bytes_uploaded
+                )
+            lines.append(line)
+            if name == 'cells':
+                lines.extend(
+                    '  {:<14}{:7.3f}s  ({} B)  {}'.format(
+                        '[{}]'.format(i.index), i.seconds, i.output_bytes,
+                        i.code.split('\n')[-1]
+                    )
+                    for i in self.cells
+                )
+        lines.append('{:<16}{:7.3f}s'.format('total', self.total))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<RenderProfile: {:.3f}s, {} cells>'.format(
+            self.total, len(self.cells)
+        )
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add_phase(name, time.perf_counter() - start)
+
+    def _add_phase(self, name, seconds):
+        # phases that happen more than once add up
+        self.phases[name] = self.phases.get(name, 0) + seconds
+        self._emit('phase', name=name, seconds=seconds)
+
+    def _add_cell(self, code, seconds, one_out):
+        cell = CellProfile(
+            len(self.cells), code, seconds, _get_output_bytes(one_out)
+        )
+        self.cells.append(cell)
+        self._emit('cell', **cell._asdict())
+
+    def _add_images(self, n_images, bytes_uploaded):
+        self.n_images += n_images
+        self.bytes_uploaded += bytes_uploaded
+        self._emit('images', n_images=n_images, bytes=bytes_uploaded)
+
+    def _emit(self, event, **data):
+        if self.callback is not None:
+            self.callback(dict(data, event=event))
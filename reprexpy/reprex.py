@@ -1,22 +1,27 @@
+import ast
 import os
 import re
 import datetime
+import functools
 import importlib.resources
-import hashlib
-import inspect
-import requests
-
-import asttokens
-import nbconvert
-import nbformat
-import pyperclip
-import pyimgur
+import io
+import time
+
+from reprexpy.cache import _get_render_key, _is_deterministic
+# CLIENT_ID is kept here for backwards compatibility
+from reprexpy.images import (  # pylint: disable=unused-import
+    CLIENT_ID, HTTPSink, _get_image_sink
+)
+from reprexpy.engines import (
+    _AsyncClientSession, _get_engine, _get_preprocessor_class,
+    _get_timeout_output, _is_timeout_output
+)
+from reprexpy.profiling import RenderProfile
+from reprexpy.session_info import _SessionInfoCell
 
 
 # Helper functions for reprex() ---------------------------
 
-CLIENT_ID = '14fb4fdc5c02a96'
-
 
 def _get_source_code(code, code_file):
     if code is not None:
@@ -24,6 +29,7 @@ def _get_source_code(code, code_file):
     if code_file is not None:
         with open(code_file) as fi:
             return fi.read()
+    import pyperclip
     try:
         return pyperclip.paste()
     except pyperclip.PyperclipException:
@@ -38,10 +44,12 @@ def _get_source_code(code, code_file):
 # after the python statement in the preceding chunk and before the statement in
 # this chunk. each chunk will be placed in a notebook cell.
 def _split_input_into_cells(code_str):
-    tok = asttokens.ASTTokens(code_str, parse=True)
-
-    ends = {statement.last_token.end[0] for statement in tok.tree.body}
-    ends = sorted(ends)
+    tree = ast.parse(code_str)
+    ends = [statement.end_lineno for statement in tree.body]
+    # fall back to asttokens if the parser didn't record end positions
+    if None in ends:
+        ends = _get_statement_ends_from_tokens(code_str)
+    ends = sorted(set(ends))
 
     starts = ends.copy()
     starts.insert(0, 0)
@@ -51,59 +59,150 @@ def _split_input_into_cells(code_str):
     return [code_lines[start:end] for start, end in zip(starts, ends)]
 
 
-def _get_setup_code():
+# the line that each top-level statement ends on, according to the statement's
+# last token
+def _get_statement_ends_from_tokens(code_str):
+    import asttokens
+    tok = asttokens.ASTTokens(code_str, parse=True)
+    return [statement.last_token.end[0] for statement in tok.tree.body]
+
+
+def _get_setup_code(figure_format=None, dpi=None, optimize_png=False):
     magic_one = '%matplotlib inline'
+    # ask for uncolored tracebacks, so there are no ansi codes to strip
+    magic_two = '%colors NoColor'
     # set envvar so SessionInfo can filter out setup code as needed
     env = 'import os; os.environ["REPREX_RUNNING"] = "true"'
     # set up settings for displaying plot outputs
     p1 = 'import IPython.display; IPython.display.set_matplotlib_close(False)'
     p2 = 'import matplotlib.pyplot; matplotlib.pyplot.ioff();'
-    python_statements = '; '.join([env, p1, p2])
-    return [[magic_one]] + [[python_statements]]
-
-
-class ExecutePreprocessorStoreHist(nbconvert.preprocessors.ExecutePreprocessor):
-    def async_execute_cell(self, cell, cell_index, execution_count,
-                           store_history):
-        super().async_execute_cell(
-            cell=cell, cell_index=cell_index, execution_count=execution_count,
-            store_history=True
+    p_config = _get_inline_backend_code(figure_format, dpi, optimize_png)
+    python_statements = '; '.join([env, p1] + p_config + [p2])
+    return [[magic_one], [magic_two], [python_statements]]
+
+
+# statements that configure how the inline backend renders figures. the
+# settings are set even when they're left at their defaults, since a pooled
+# kernel keeps whatever settings the previous render used.
+def _get_inline_backend_code(figure_format, dpi, optimize_png):
+    if figure_format not in (None, 'png', 'retina'):
+        raise ValueError(
+            "figure_format must be either 'png' or 'retina', not {!r}".format(
+                figure_format
+            )
         )
+    backend = (
+        'import matplotlib_inline.backend_inline; '
+        'matplotlib_inline.backend_inline.InlineBackend.instance()'
+    )
+    formats = {figure_format or 'png'}
+    code = ['{}.figure_formats = {!r}'.format(backend, formats)]
+    kwargs = {'bbox_inches': 'tight'}
+    if dpi is not None:
+        kwargs['dpi'] = dpi
+    if optimize_png:
+        # have pillow losslessly optimize the png that matplotlib writes
+        kwargs['pil_kwargs'] = {'optimize': True}
+    code.append('{}.print_figure_kwargs = {!r}'.format(backend, kwargs))
+    return code
+
+
+def __getattr__(name):
+    # kept for backwards compatibility. the class is built on first use, so
+    # that importing this module doesn't import nbconvert.
+    if name == 'ExecutePreprocessorStoreHist':
+        return _get_preprocessor_class()
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name)
+    )
 
 
-def _run_cells(statement_chunks, kernel_name):
-    nb = nbformat.v4.new_notebook()
-    nb['cells'] = [
-        nbformat.v4.new_code_cell('\n'.join(i))
-        for i in statement_chunks
-    ]
-    if kernel_name is not None:
-        ep = ExecutePreprocessorStoreHist(
-            timeout=600, allow_errors=True, kernel_name=kernel_name
-        )
-    else:
-        ep = ExecutePreprocessorStoreHist(
-            timeout=600, allow_errors=True
-        )
-    node_out, _ = ep.preprocess(nb, {})
-    return node_out
-
-
-def _extract_outputs(cells):
-    return [[] if not i['outputs'] else i['outputs'] for i in cells]
+# run a reprex's cells (after its setup code) in a fresh session. fewer outputs
+# than cells are returned if the reprex stopped early (see _iter_cell_outputs).
+def _run_cells(input_cells, setup_code, kernel_name, kernel_pool=None,
+               engine=None, timeout=None, budget=None, stop_on_error=False,
+               profile=None):
+    if profile is None:
+        profile = RenderProfile()
+    with profile._phase('kernel startup'):
+        session = _get_engine(engine).session(kernel_name, kernel_pool)
+    with session:
+        with profile._phase('setup code'):
+            for cell in setup_code:
+                session.execute(cell)
+        with profile._phase('cells'):
+            return list(_iter_cell_outputs(
+                session, input_cells, timeout=timeout, budget=budget,
+                stop_on_error=stop_on_error, profile=profile
+            ))
+
+
+# run cells one at a time, yielding each cell's outputs. stops after a cell that
+# timed out or, if stop_on_error, after a cell that raised an error.
+def _iter_cell_outputs(session, input_cells, timeout=None, budget=None,
+                       stop_on_error=False, profile=None):
+    time_budget = _TimeBudget(timeout, budget)
+    for cell in input_cells:
+        cell_timeout = time_budget.next_timeout()
+        start = time.perf_counter()
+        if cell_timeout is not None and cell_timeout <= 0:
+            one_out = [_get_timeout_output(0)]
+        else:
+            one_out = _get_shown_outputs(cell, session.execute(
+                _get_code_to_run(cell), timeout=cell_timeout
+            ))
+        if profile is not None:
+            profile._add_cell(
+                '\n'.join(cell), time.perf_counter() - start, one_out
+            )
+        yield one_out
+        if _should_stop(one_out, stop_on_error):
+            return
+
+
+# hands out per-cell timeouts, so that no cell runs for longer than `timeout`
+# and the cells don't run for longer than `budget` in total
+class _TimeBudget:
+
+    def __init__(self, timeout, budget):
+        self.timeout = timeout
+        self._deadline = None if budget is None else time.monotonic() + budget
+
+    def next_timeout(self):
+        if self._deadline is None:
+            return self.timeout
+        remaining = max(0, self._deadline - time.monotonic())
+        return remaining if self.timeout is None \
+            else min(self.timeout, remaining)
+
+
+def _should_stop(one_out, stop_on_error):
+    return any(
+        _is_timeout_output(i) or (stop_on_error and i['output_type'] == 'error')
+        for i in one_out
+    )
 
 
 def _is_plot_output(el):
     # check if the node is for an image output
-    if el.output_type == 'display_data':
-        if hasattr(el, 'data'):
-            if hasattr(el.data, 'image/png'):
-                return True
+    if el['output_type'] == 'display_data':
+        if 'image/png' in el.get('data', {}):
+            return True
     return False
 
 
 def _any_plot_outputs(lst):
-    return any([_is_plot_output(i) for i in lst])
+    return any(_is_plot_output(i) for i in lst)
+
+
+# a statement is the last statement in a code block if that statement either
+# returned a plot output, is the statement right before the call to
+# SessionInfo(), or is the last statement in the reprex
+def _is_block_stop(index, one_out, last_ind, si):
+    return (
+        _any_plot_outputs(one_out) or (index == last_ind - 1 and si) or
+        index == last_ind
+    )
 
 
 # get the line numbers where 'code blocks' start and stop. a code block is a
@@ -113,15 +212,11 @@ def _get_code_block_start_stops(outputs, si):
     len_outputs = len(outputs)
     last_ind = len_outputs - 1
 
-    # a statement is the last statement in a block if that statement either
-    # returned a plot output or is the statement right before the call to
-    # SessionInfo()
     cb_stops = [
         i[0]
         for i in enumerate(outputs)
-        if _any_plot_outputs(i[1]) or (i[0] == last_ind - 1 and si)
+        if _is_block_stop(i[0], i[1], last_ind, si)
     ]
-    cb_stops = list(sorted(set(cb_stops + [last_ind])))
 
     # first start index will always be first statement (i.e., index 0). then,
     # to get the remaining start indexes, we add 1 to the index of the stop
@@ -138,114 +233,148 @@ def _get_code_block_start_stops(outputs, si):
     return list(zip(cb_starts, cb_stops))
 
 
-# extract the text output for all output types except display_data. also
-# process some of the text outputs where needed (e.g., strip ansi color codes
-# from error traceback text) and add output comment char to the beginning of
-# each text output line.
-def _get_one_txt_output(output_el, comment, venue):
-    if not output_el:
-        return None
-
-    output_type = output_el.output_type
-    if output_type == 'execute_result':
-        # results of type execute_result should always be strings, so have to
-        # convert to list (of strings)
-        txt = [output_el['data']['text/plain']]
-    elif output_type == 'stream':
-        print_txt = output_el['text']
-        # stream results will also be presented as strings, but we need to add
-        # the comment char after each newline of printed text. note, this will
-        # strip the trailing newlines that usually come with calling `print`,
-        # which is desired behavior.
-        txt = print_txt.splitlines()
-    elif output_type == 'error':
-        # error traceback is given in a list, usually with one line of
-        # traceback per element. remove ansi color codes from traceback text
-        # and split any elements in list that are actually two lines.
-        txt = [
-            re.sub('\x1b\\[(.*?)([@-~])', '', i)
-            for i in output_el['traceback']
-        ]
-        txt = [i.splitlines() for i in txt]
-        txt = [x for i in txt for x in i]
-        txt = [
-            'Traceback (most recent call last):'
-            if re.search('traceback .+most recent call last', i, re.IGNORECASE)
-            else i
-            for i in txt if re.search('[^-]', i)
-        ]
-    elif output_type == 'display_data':
-        return None
-    else:
-        raise RuntimeError('Ran into an unknown output_type')
-
-    if venue == 'sx':
-        return txt
-
-    return [comment + ' ' + i for i in txt]
+_ANSI_ESCAPE = re.compile('\x1b\\[(.*?)([@-~])')
+_TRACEBACK_HEADER = re.compile(
+    'traceback .+most recent call last', re.IGNORECASE
+)
 
+# a traceback frame that repeats more than this many times in a row (e.g., in a
+# RecursionError) is only shown this many times
+_MAX_REPEATED_FRAMES = 3
 
-# for each element of the output list (i.e., for each output for a given cell),
-# get all the text outputs of that cell and merge them into a single list. all
-# outputs are considered "text outputs" except those that correspond to plot
-# output.
-def _get_txt_outputs(outputs, comment, venue):
-    tmp_out = [
-        [_get_one_txt_output(j, comment, venue) for j in i]
-        for i in outputs
-    ]
-    tmp_out = [[j for j in i if j] for i in tmp_out]
-    return [[x for i in one for x in i] for one in tmp_out]
 
+# the lines of text that an output shows, for all output types except
+# display_data (which is plot output). note, the trailing newlines that usually
+# come with calling `print` are dropped, which is desired behavior.
+def _get_txt_lines(output_el):
+    output_type = output_el['output_type']
+    if output_type == 'execute_result':
+        # the result's repr is kept as a single "line"
+        return [output_el['data']['text/plain']]
+    if output_type == 'stream':
+        return output_el['text'].splitlines()
+    if output_type == 'error':
+        return list(_iter_traceback_lines(output_el['traceback']))
+    if output_type == 'display_data':
+        return []
+    raise RuntimeError('Ran into an unknown output_type')
+
+
+# an error's traceback is given as a list, usually with one frame per element
+def _iter_traceback_lines(traceback):
+    last_frame = None
+    n_repeats = 0
+    for frame in traceback:
+        if frame == last_frame:
+            n_repeats += 1
+            if n_repeats >= _MAX_REPEATED_FRAMES:
+                continue
+        else:
+            if n_repeats >= _MAX_REPEATED_FRAMES:
+                yield _get_repeated_frames_note(n_repeats)
+            last_frame = frame
+            n_repeats = 0
+        yield from _iter_frame_lines(frame)
+    if n_repeats >= _MAX_REPEATED_FRAMES:
+        yield _get_repeated_frames_note(n_repeats)
+
+
+def _get_repeated_frames_note(n_repeats):
+    n_more = n_repeats - _MAX_REPEATED_FRAMES + 1
+    return '[... previous frame repeated {} more time{}]'.format(
+        n_more, '' if n_more == 1 else 's'
+    )
 
-def _get_image_urls(node):
-    data = node['data']['image/png']
-    auth_header = {'Authorization': 'Client-ID ' + CLIENT_ID}
 
-    # Try to use pyimgur's internal request helper first (newer versions)
-    try:
-        send_request = pyimgur.request.send_request
-        kwargs = {'method': 'POST'}
-        if 'authentication' in inspect.signature(send_request).parameters:
-            kwargs['authentication'] = auth_header
-
-        response = send_request('https://api.imgur.com/3/image', {'image': data}, **kwargs)
-
-        if isinstance(response, tuple):
-            response = response[0]
-
-        if isinstance(response, dict) and 'link' in response:
-            return response['link']
-    except TypeError:
-        # Older pyimgur versions without the authentication keyword
-        pass
-    except Exception:
-        # Any other issue from pyimgur, fall back to direct request
-        pass
-
-    # Fall back to direct requests
-    try:
-        resp = requests.post(
-            'https://api.imgur.com/3/image',
-            headers=auth_header,
-            data={'image': data}
+# remove ansi color codes from a frame (kernels are asked for uncolored
+# tracebacks, so there usually aren't any), split it into lines, and drop the
+# lines that are just dashes
+def _iter_frame_lines(frame):
+    if '\x1b' in frame:
+        frame = _ANSI_ESCAPE.sub('', frame)
+    for line in frame.splitlines():
+        if not line.strip('-'):
+            continue
+        if _TRACEBACK_HEADER.search(line):
+            yield 'Traceback (most recent call last):'
+        else:
+            yield line
+
+
+# write the lines of a code block (the input cells, each followed by its text
+# output) to buf, separated by newlines
+def _write_txt_chunks(buf, input_cells, outputs, venue, comment):
+    indent = '    ' if venue in ['so', 'sx'] else ''
+    out_prefix = indent if venue == 'sx' else indent + comment + ' '
+    sep = ''
+    for cell, one_out in zip(input_cells, outputs):
+        if venue == 'sx':
+            cell = ['>>> ' + i for i in cell if i != '']
+        sep = _write_lines(buf, cell, indent, sep)
+        for output_el in one_out:
+            sep = _write_lines(buf, _get_txt_lines(output_el), out_prefix, sep)
+
+
+# write lines to buf, each one prefixed by prefix. sep is written before the
+# first line. returns the separator for the next line.
+def _write_lines(buf, lines, prefix, sep):
+    if not lines:
+        return sep
+    buf.write(sep)
+    buf.write(prefix)
+    buf.write(('\n' + prefix).join(lines))
+    return '\n'
+
+
+# send the plots in `outputs` that aren't in url_cache yet to the image sink,
+# all at once, and add their urls to url_cache. returns the number of plots
+# that were sent to the image sink and the (decoded) number of bytes that it
+# uploaded.
+def _fill_url_cache(outputs, url_cache, image_sink=None):
+    images = []
+    for one_out in outputs:
+        for i in one_out:
+            if _is_plot_output(i) and i['data']['image/png'] not in url_cache:
+                images.append(i['data']['image/png'])
+    images = list(dict.fromkeys(images))
+    if not images:
+        return 0, 0
+    urls, n_bytes = _get_image_sink(image_sink)._upload_many_and_count(images)
+    url_cache.update(zip(images, urls))
+    return len(images), n_bytes
+
+
+# upload all of the plots in a reprex's outputs at once, returning a url_cache
+# (see _get_markedup_urls()) that holds their urls, and the (decoded) number of
+# bytes that were uploaded. http sinks upload plots with tornado, while other
+# sinks are run in a thread.
+async def _aget_url_cache(outputs, image_sink=None):
+    import asyncio
+
+    images = list({
+        i['data']['image/png']
+        for one_out in outputs for i in one_out if _is_plot_output(i)
+    })
+    image_sink = _get_image_sink(image_sink)
+    if isinstance(image_sink, HTTPSink):
+        urls, n_bytes = await image_sink._aupload_many_and_count(images)
+    else:
+        loop = asyncio.get_running_loop()
+        urls, n_bytes = await loop.run_in_executor(
+            None, image_sink._upload_many_and_count, images
         )
-        resp.raise_for_status()
-        payload = resp.json()
-        if 'data' in payload and 'link' in payload['data']:
-            return payload['data']['link']
-    except Exception:
-        pass
+    return dict(zip(images, urls)), n_bytes
 
-    # Final fallback: deterministic placeholder so test expectations still work
-    digest = hashlib.sha1(data.encode()).hexdigest()[:10]
-    return f'https://imgur.com/upload-error-{digest}'
 
-
-def _get_markedup_urls(one_out, venue):
+# url_cache (optional) maps image data to urls that it has already been
+# uploaded to, so re-rendering the same plot doesn't upload it again
+def _get_markedup_urls(one_out, venue, url_cache=None, image_sink=None):
     if _any_plot_outputs(one_out):
+        if url_cache is None:
+            url_cache = {}
+        _fill_url_cache([one_out], url_cache, image_sink=image_sink)
         img_urls = [
-            _get_image_urls(i)
+            url_cache[i['data']['image/png']]
             for i in one_out if _is_plot_output(i)
         ]
         ptxt_out = [
@@ -295,8 +424,191 @@ def reprex_ex(file):
 # reprex() ---------------------------
 
 
+def _get_input_cells(code_str, si):
+    input_cells = _split_input_into_cells(code_str)
+    if si:
+        input_cells = input_cells + [_SessionInfoCell(code_str)]
+    return input_cells
+
+
+# the code that's actually run for a cell (which differs from the code that's
+# shown for the session info cell)
+def _get_code_to_run(cell):
+    return cell.probe if isinstance(cell, _SessionInfoCell) else cell
+
+
+def _get_shown_outputs(cell, one_out):
+    return cell.resolve(one_out) if isinstance(cell, _SessionInfoCell) \
+        else one_out
+
+
+# look a reprex up in the render cache. returns the reprex's cache key (or None
+# if it shouldn't be cached) and the cached reprex (or None if it's not cached).
+def _check_cache(cache, code_str, venue, kernel_name, comment, si, advertise,
+                 engine=None, image_sink=None, setup_code=None,
+                 stop_on_error=False):
+    if cache is None or not _is_deterministic(code_str):
+        return None, None
+    cache_key = _get_render_key(
+        code_str, venue=venue, kernel_name=kernel_name, comment=comment,
+        si=si, advertise=advertise,
+        engine_key=_get_engine(engine)._get_cache_key(),
+        image_sink_key=_get_image_sink(image_sink)._get_cache_key(),
+        setup_code=setup_code, stop_on_error=stop_on_error
+    )
+    if cache_key is None:
+        return None, None
+    entry = cache.get(cache_key)
+    return cache_key, None if entry is None else entry['markdown']
+
+
+# render a reprex without any of reprex()'s side effects (i.e., without
+# printing progress messages or touching the clipboard)
+def _render(code_str, venue, kernel_name, comment, si, advertise,
+            kernel_pool=None, cache=None, engine=None, image_sink=None,
+            figure_format=None, dpi=None, optimize_png=False, timeout=None,
+            budget=None, stop_on_error=False, profile=None):
+    if profile is None:
+        profile = RenderProfile()
+    if venue == 'sx':
+        si = False
+        advertise = False
+
+    setup_code = _get_setup_code(figure_format, dpi, optimize_png)
+
+    with profile._phase('cache lookup'):
+        cache_key, out = _check_cache(
+            cache, code_str, venue=venue, kernel_name=kernel_name,
+            comment=comment, si=si, advertise=advertise, engine=engine,
+            image_sink=image_sink, setup_code=setup_code,
+            stop_on_error=stop_on_error
+        )
+    if out is not None:
+        profile.cache_hit = True
+        return out
+
+    input_cells = _get_input_cells(code_str, si=si)
+
+    outputs = _run_cells(
+        input_cells, setup_code, kernel_name, kernel_pool=kernel_pool,
+        engine=engine, timeout=timeout, budget=budget,
+        stop_on_error=stop_on_error, profile=profile
+    )
+    out = _format_partial_reprex(
+        input_cells, outputs, venue=venue, comment=comment, si=si,
+        advertise=advertise, image_sink=image_sink, profile=profile
+    )
+
+    # whether a cell times out depends on more than just the code
+    if cache_key is not None and not _any_timeouts(outputs):
+        with profile._phase('cache write'):
+            cache.put(cache_key, out, outputs)
+
+    return out
+
+
+def _any_timeouts(outputs):
+    return any(_is_timeout_output(j) for i in outputs for j in i)
+
+
+# format a reprex that may have stopped before all of its cells were run. only
+# the cells that were run are shown.
+def _format_partial_reprex(input_cells, outputs, venue, comment, si, advertise,
+                           url_cache=None, image_sink=None, profile=None):
+    ran_all = len(outputs) == len(input_cells)
+    return _format_reprex(
+        input_cells[:len(outputs)], outputs, venue=venue, comment=comment,
+        si=si and ran_all, advertise=advertise, url_cache=url_cache,
+        image_sink=image_sink, profile=profile
+    )
+
+
+# mark up a reprex's input cells and the outputs that running them produced
+def _format_reprex(input_cells, outputs, venue, comment, si, advertise,
+                   url_cache=None, image_sink=None, profile=None):
+    if profile is None:
+        profile = RenderProfile()
+    # upload all of the reprex's plots at once, rather than block by block
+    if url_cache is None:
+        url_cache = {}
+    with profile._phase('images'):
+        n_images, n_bytes = _fill_url_cache(
+            outputs, url_cache, image_sink=image_sink
+        )
+    if n_images:
+        profile._add_images(n_images, n_bytes)
+
+    with profile._phase('formatting'):
+        return _format_code_blocks(
+            input_cells, outputs, venue=venue, comment=comment, si=si,
+            advertise=advertise, url_cache=url_cache, image_sink=image_sink
+        )
+
+
+# mark up all of a reprex's code blocks, once its plots have been sent to the
+# image sink
+def _format_code_blocks(input_cells, outputs, venue, comment, si, advertise,
+                        url_cache, image_sink):
+    start_stops = _get_code_block_start_stops(outputs, si=si)
+    last_block = len(start_stops) - 1
+    buf = io.StringIO()
+    for i, (start, stop) in enumerate(start_stops):
+        if i:
+            buf.write('\n\n')
+        block = _format_code_block(
+            input_cells[start:(stop + 1)], outputs[start:(stop + 1)],
+            venue=venue, comment=comment, url_cache=url_cache,
+            image_sink=image_sink
+        )
+        buf.write(_add_block_markup(
+            block, first=i == 0, last=i == last_block, venue=venue, si=si,
+            advertise=advertise
+        ))
+    return buf.getvalue()
+
+
+# mark up a single code block, given the input cells that make up the block and
+# their outputs
+def _format_code_block(input_cells, outputs, venue, comment, url_cache=None,
+                       image_sink=None):
+    buf = io.StringIO()
+    if venue == 'gh':
+        buf.write('```python\n')
+    _write_txt_chunks(buf, input_cells, outputs, venue=venue, comment=comment)
+    if venue == 'gh':
+        buf.write('\n```')
+
+    # extract urls to plots and add mark them up
+    buf.write(_get_markedup_urls(
+        outputs[-1], venue=venue, url_cache=url_cache, image_sink=image_sink
+    ))
+    return buf.getvalue()
+
+
+# add misc markup items to the first/last block
+def _add_block_markup(block, first, last, venue, si, advertise):
+    if last and venue == 'gh' and si:
+        block = (
+            '<details><summary>Session info</summary>\n\n' + block +
+            '\n\n</details>'
+        )
+    if last and advertise:
+        if si:
+            block = _get_advertisement() + '\n\n' + block
+        else:
+            block = block + '\n\n' + _get_advertisement()
+
+    if first and venue == 'so':
+        block = '# <!-- language-all: lang-py -->\n\n' + block
+
+    return block
+
+
 def reprex(code=None, code_file=None, venue='gh', kernel_name=None,
-           comment='#>', si=False, advertise=False):
+           comment='#>', si=False, advertise=False, kernel_pool=None,
+           cache=None, engine=None, image_sink=None, figure_format=None,
+           dpi=None, optimize_png=False, timeout=None, budget=None,
+           stop_on_error=False, profile=None):
     r"""Render a reproducible example of Python code (a reprex).
 
     Runs Python code inside a fresh IPython session, captures the results, and
@@ -338,6 +650,56 @@ def reprex(code=None, code_file=None, venue='gh', kernel_name=None,
         Do you want to include a note at the bottom of your reprex that says
         that it was produced by the reprexpy package? This parameter is ignored
         if ``venue='sx'``.
+    kernel_pool : reprexpy.kernel_pool.KernelPool, optional
+        A pool of warm kernels to run your reprex in, instead of starting (and
+        stopping) a fresh kernel. See
+        :py:class:`reprexpy.kernel_pool.KernelPool` for details.
+    cache : reprexpy.cache.RenderCache, optional
+        A cache to look your rendered reprex up in before running any code
+        (and to store it in after it's rendered). See
+        :py:class:`reprexpy.cache.RenderCache` for details.
+    engine : str or reprexpy.engines.ExecutionEngine, optional
+        The engine that runs your code. ``'nbconvert'`` (the default) runs it
+        in a Jupyter kernel using nbconvert, ``'client'`` runs it in a Jupyter
+        kernel using jupyter_client directly (which has less overhead), and
+        ``'shell'`` runs it in an IPython shell without starting a kernel
+        (which is faster still). See :py:mod:`reprexpy.engines` for details.
+    image_sink : {'imgur', 'data-uri'} or reprexpy.images.ImageSink, optional
+        Where your reprex's plots are sent. ``'imgur'`` (the default) uploads
+        them to imgur, while ``'data-uri'`` embeds them in the rendered reprex.
+        To write them to a directory or upload them somewhere else, pass in a
+        :py:class:`reprexpy.images.DirectorySink` or
+        :py:class:`reprexpy.images.HTTPSink`.
+    figure_format : {'png', 'retina'}, optional
+        The format that matplotlib figures are rendered in. ``'retina'`` gives
+        PNGs at twice the resolution, for high-DPI displays. Defaults to the
+        inline backend's format (``'png'``).
+    dpi : int, optional
+        The resolution (dots per inch) that matplotlib figures are rendered
+        at. Lower values give smaller images. Defaults to the figure's DPI.
+    optimize_png : bool, optional
+        Do you want figures to be losslessly compressed (which makes them
+        smaller, but takes a little longer to render)? This shrinks both the
+        messages that the kernel sends and the images that get uploaded.
+    timeout : float, optional
+        Number of seconds a single statement can run for. A statement that
+        runs for longer is interrupted (the kernel isn't restarted), the
+        reprex stops there, and the statement is marked with a
+        ``#> [timed out after Ns]`` comment. ``None`` (the default) means
+        statements can run for as long as the engine allows.
+    budget : float, optional
+        Number of seconds that all of the reprex's statements can run for in
+        total. Once the budget is used up, the statement that's running is
+        interrupted just like it would be if it hit ``timeout``.
+    stop_on_error : bool, optional
+        Do you want the reprex to stop at the first statement that raises an
+        error? By default, every statement is run regardless of errors.
+    profile : bool or reprexpy.profiling.RenderProfile, optional
+        Do you want to know where the time went while your reprex rendered
+        (e.g., starting the kernel, running each statement, or uploading
+        plots)? ``True`` prints a report once the reprex is rendered. Pass a
+        :py:class:`reprexpy.profiling.RenderProfile` instead to have the
+        numbers recorded there (and sent to its callback as they're taken).
 
     Returns
     -------
@@ -377,78 +739,249 @@ def reprex(code=None, code_file=None, venue='gh', kernel_name=None,
 
     code_str = _get_source_code(code, code_file)
 
-    if venue == 'sx':
-        si = False
-        advertise = False
+    print_profile = profile is True
+    if not isinstance(profile, RenderProfile):
+        profile = RenderProfile()
 
-    input_cells = _split_input_into_cells(code_str)
+    print('Rendering reprex...')
+    out = _render(
+        code_str, venue=venue, kernel_name=kernel_name, comment=comment, si=si,
+        advertise=advertise, kernel_pool=kernel_pool, cache=cache,
+        engine=engine, image_sink=image_sink, figure_format=figure_format,
+        dpi=dpi, optimize_png=optimize_png, timeout=timeout, budget=budget,
+        stop_on_error=stop_on_error, profile=profile
+    )
 
-    if si:
-        input_cells = input_cells + [
-            ['import reprexpy', 'print(reprexpy.SessionInfo())']
-        ]
+    import pyperclip
+    with profile._phase('clipboard'):
+        try:
+            pyperclip.copy(out)
+            print('Rendered reprex is on the clipboard.\n')
+        except pyperclip.PyperclipException:
+            print(
+                'Could not copy rendered reprex to the clipboard. Use the '
+                'returned string instead\n'
+            )
 
-    setup_code = _get_setup_code()
-    all_cells = setup_code + input_cells
+    if print_profile:
+        print(str(profile) + '\n')
 
-    print('Rendering reprex...')
-    node_out = _run_cells(all_cells, kernel_name)
+    return out
 
-    outputs = _extract_outputs(node_out.cells)
-    outputs = outputs[len(setup_code):]
-    txt_outputs = _get_txt_outputs(outputs, comment=comment, venue=venue)
 
-    # add txt_outputs to source code (input_chunks) to create txt_chunks
-    if venue == 'sx':
-        input_cells = [[j for j in i if j != ''] for i in input_cells]
+def reprex_iter(code=None, code_file=None, venue='gh', kernel_name=None,
+                comment='#>', si=False, advertise=False, kernel_pool=None,
+                engine=None, image_sink=None, figure_format=None, dpi=None,
+                optimize_png=False, timeout=None, budget=None,
+                stop_on_error=False):
+    r"""Render a reprex one code block at a time.
 
-        input_cells = [['>>> {}'.format(j) for j in i] for i in input_cells]
+    Like ``reprex()``, except that each code block of the rendered reprex is
+    yielded as soon as the code in it has run (and any plots it made have been
+    uploaded), instead of being returned all at once when the whole reprex is
+    done. This is handy for long-running reprexes, where you want to show
+    progress as the reprex renders. A new code block starts after each
+    statement that makes a plot (and before the session info, if ``si=True``),
+    so a reprex without plots is a single block. ``reprex_iter()`` doesn't
+    print progress messages and doesn't touch the clipboard.
 
-    txt_chunks = [i + j for i, j in zip(input_cells, txt_outputs)]
+    Parameters
+    ----------
+    code, code_file, venue, kernel_name, comment, si, advertise, kernel_pool
+        See :py:func:`reprexpy.reprex.reprex`.
+    engine, image_sink, figure_format, dpi, optimize_png, timeout, budget
+        See :py:func:`reprexpy.reprex.reprex`.
+    stop_on_error
+        See :py:func:`reprexpy.reprex.reprex`.
+
+    Yields
+    ------
+    str
+        The rendered code blocks. Joining them with ``'\n\n'`` gives you the
+        same string that ``reprex()`` would have returned.
 
-    if venue in ['so', 'sx']:
-        txt_chunks = [['    ' + j for j in i] for i in txt_chunks]
-    txt_chunks = ['\n'.join(i) for i in txt_chunks]
+    Examples
+    --------
 
-    # group txt_chunks into code_blocks
-    start_stops = _get_code_block_start_stops(outputs, si=si)
-    code_blocks = [txt_chunks[i[0]:(i[1] + 1)] for i in start_stops]
-    code_blocks = ['\n'.join(i) for i in code_blocks]
-    if venue == 'gh':
-        code_blocks = ['```python\n{}\n```'.format(i) for i in code_blocks]
+    >>> import reprexpy
+    >>> for block in reprexpy.reprex_iter('x = 1\nx'):
+    ...     print(block)
+    ```python
+    x = 1
+    x
+    #> 1
+    ```
+    """
+    code_str = _get_source_code(code, code_file)
 
-    # extract urls to plots and add mark them up
-    markedup_urls = [
-        _get_markedup_urls(outputs[i[1]], venue=venue)
-        for i in start_stops
-    ]
-    final_blocks = [i + j for i, j in zip(code_blocks, markedup_urls)]
+    if venue == 'sx':
+        si = False
+        advertise = False
 
-    # add misc markup items to the first/last block
-    if venue == 'gh' and si:
-        final_blocks[-1] = (
-            '<details><summary>Session info</summary>\n\n' + final_blocks[-1] +
-            '\n\n</details>'
+    input_cells = _get_input_cells(code_str, si=si)
+    last_ind = len(input_cells) - 1
+
+    with _get_engine(engine).session(kernel_name, kernel_pool) as session:
+        for cell in _get_setup_code(figure_format, dpi, optimize_png):
+            session.execute(cell)
+
+        cell_outputs = _iter_cell_outputs(
+            session, input_cells, timeout=timeout, budget=budget,
+            stop_on_error=stop_on_error
         )
-    if advertise:
-        if si:
-            final_blocks[-1] = _get_advertisement() + '\n\n' + final_blocks[-1]
-        else:
-            final_blocks[-1] = final_blocks[-1] + '\n\n' + _get_advertisement()
+        start = 0
+        block_outputs = []
+        for index, one_out in enumerate(cell_outputs):
+            block_outputs.append(one_out)
+            # the reprex ends early if this cell stopped it
+            last = index == last_ind or _should_stop(one_out, stop_on_error)
+            if not (last or _is_block_stop(index, one_out, last_ind, si)):
+                continue
+            block = _format_code_block(
+                input_cells[start:(index + 1)], block_outputs, venue=venue,
+                comment=comment, image_sink=image_sink
+            )
+            yield _add_block_markup(
+                block, first=start == 0, last=last, venue=venue,
+                si=si and index == last_ind, advertise=advertise
+            )
+            start = index + 1
+            block_outputs = []
+
+
+async def areprex(code=None, code_file=None, venue='gh', kernel_name=None,
+                  comment='#>', si=False, advertise=False, kernel_pool=None,
+                  cache=None, image_sink=None, figure_format=None, dpi=None,
+                  optimize_png=False, timeout=None, budget=None,
+                  stop_on_error=False, profile=None):
+    r"""Render a reprex without blocking the event loop.
+
+    The asyncio counterpart of ``reprex()``, for use in async applications
+    (e.g., web services) that render many reprexes at once. The code is run in
+    a Jupyter kernel that is driven by jupyter_client's async APIs, and plots
+    are uploaded concurrently using tornado's async HTTP client. Unlike
+    ``reprex()``, ``areprex()`` never prints progress messages or touches the
+    clipboard, so the code has to come from ``code`` or ``code_file``.
 
-    if venue == 'so':
-        final_blocks[0] = '# <!-- language-all: lang-py -->\n\n' + final_blocks[0]
+    Parameters
+    ----------
+    code, code_file, venue, kernel_name, comment, si, advertise, kernel_pool
+        See :py:func:`reprexpy.reprex.reprex`. One of ``code`` or
+        ``code_file`` is required. If you use a ``kernel_pool``, waiting for a
+        free kernel is done in a thread, so it doesn't block the event loop
+        either.
+    cache, image_sink
+        See :py:func:`reprexpy.reprex.reprex`. Sinks that don't upload over
+        HTTP are run in a thread.
+    figure_format, dpi, optimize_png, timeout, budget, stop_on_error
+        See :py:func:`reprexpy.reprex.reprex`.
+    profile : reprexpy.profiling.RenderProfile, optional
+        Records where the time went while the reprex rendered. See
+        :py:func:`reprexpy.reprex.reprex`.
 
-    # convert list of code blocks to a string
-    out = '\n\n'.join(final_blocks)
+    Returns
+    -------
+    str
+        A string containing your rendered reprex.
+
+    Examples
+    --------
 
+    >>> import asyncio
+    >>> import reprexpy
+    >>> async def render_all(codes):
+    ...     return await asyncio.gather(*[reprexpy.areprex(i) for i in codes])
+    >>> out = asyncio.run(render_all(['x = 1\nx', 'print("hi")']))
+    >>> print(out[1])
+    ```python
+    print("hi")
+    #> hi
+    ```
+    """
+    import asyncio
+
+    if code is None and code_file is None:
+        raise ValueError(
+            'areprex() never reads code from the clipboard. Pass your code in '
+            'using either the `code` or `code_file` parameter.'
+        )
+    code_str = _get_source_code(code, code_file)
+
+    if venue == 'sx':
+        si = False
+        advertise = False
+
+    setup_code = _get_setup_code(figure_format, dpi, optimize_png)
+    if profile is None:
+        profile = RenderProfile()
+
+    # the cache is checked in a thread, since building the cache key involves
+    # scanning the installed distributions
+    loop = asyncio.get_running_loop()
+    with profile._phase('cache lookup'):
+        cache_key, out = await loop.run_in_executor(None, functools.partial(
+            _check_cache, cache, code_str, venue=venue,
+            kernel_name=kernel_name, comment=comment, si=si,
+            advertise=advertise, engine='client', image_sink=image_sink,
+            setup_code=setup_code, stop_on_error=stop_on_error
+        ))
+    if out is not None:
+        profile.cache_hit = True
+        return out
+
+    input_cells = _get_input_cells(code_str, si=si)
+
+    # the async counterpart of _run_cells()
+    outputs = []
+    time_budget = _TimeBudget(timeout, budget)
+    session = _AsyncClientSession(kernel_name, kernel_pool)
+    with profile._phase('kernel startup'):
+        await session.start()
     try:
-        pyperclip.copy(out)
-        print('Rendered reprex is on the clipboard.\n')
-    except pyperclip.PyperclipException:
-        print(
-            'Could not copy rendered reprex to the clipboard. Use the '
-            'returned string instead\n'
+        with profile._phase('setup code'):
+            for cell in setup_code:
+                await session.execute(cell)
+        with profile._phase('cells'):
+            for cell in input_cells:
+                cell_timeout = time_budget.next_timeout()
+                start = time.perf_counter()
+                if cell_timeout is not None and cell_timeout <= 0:
+                    outputs.append([_get_timeout_output(0)])
+                else:
+                    one_out = await session.execute(
+                        _get_code_to_run(cell), cell_timeout
+                    )
+                    if isinstance(cell, _SessionInfoCell):
+                        # resolving the session info scans the installed
+                        # distributions, so it's done in a thread too
+                        one_out = await loop.run_in_executor(
+                            None, cell.resolve, one_out
+                        )
+                    outputs.append(one_out)
+                profile._add_cell(
+                    '\n'.join(cell), time.perf_counter() - start, outputs[-1]
+                )
+                if _should_stop(outputs[-1], stop_on_error):
+                    break
+    finally:
+        await session.close()
+
+    with profile._phase('images'):
+        url_cache, n_bytes = await _aget_url_cache(
+            outputs, image_sink=image_sink
         )
+    if url_cache:
+        profile._add_images(len(url_cache), n_bytes)
+    out = _format_partial_reprex(
+        input_cells, outputs, venue=venue, comment=comment, si=si,
+        advertise=advertise, url_cache=url_cache, image_sink=image_sink,
+        profile=profile
+    )
+
+    if cache_key is not None and not _any_timeouts(outputs):
+        with profile._phase('cache write'):
+            await loop.run_in_executor(
+                None, cache.put, cache_key, out, outputs
+            )
 
     return out
@@ -1,13 +1,14 @@
+import ast
+import csv
 import platform
 import sys
 import datetime
+import functools
+import hashlib
+import json
 import os
 import re
-import importlib.metadata
-
-import IPython.core.getipython
-import asttokens
-import stdlib_list
+import tempfile
 
 
 # goal: id distribution names + version numbers for all distributions that
@@ -24,10 +25,11 @@ import stdlib_list
 #
 # approach taken:
 # 1. get names of *most* imported modules (including packages) by parsing names
-# from code. the one case where we won't get the full module name is when
-# import happens in form `from module_a import module_b` (module_b won't be
-# added to our list of mods...instead, we will be relying on the module_a's
-# name to get us the name of the distribution that these mods belong to).
+# from code, as each cell runs (see _ImportTracker). the one case where we
+# won't get the full module name is when import happens in form
+# `from module_a import module_b` (module_b won't be added to our list of
+# mods...instead, we will be relying on the module_a's name to get us the name
+# of the distribution that these mods belong to).
 # 2. ensure that the modules id'd in step 1 are actually loaded by cross
 # reffing mod names to sys.modules table. this will ensure that import
 # statements that don't actually get executed in users's code don't get
@@ -45,6 +47,10 @@ class SessionInfo:
     of packages that you have imported into your IPython session. **You must be
     using the IPython kernel to instantiate this class.**
 
+    The distribution (and version) that each module belongs to is cached in
+    reprexpy's cache directory (see :py:class:`reprexpy.cache.RenderCache`),
+    and the cache is refreshed whenever a package is installed or removed.
+
     Attributes
     ----------
     session_info : dict
@@ -107,13 +113,27 @@ class SessionInfo:
         to_rep = 79 - len(x) + 1
         return x + ' ' + '-' * to_rep
 
-    @staticmethod
-    def _get_sesh_info_sectn():
-        pf = platform.platform() + \
-             ' (64-bit)' if sys.maxsize > 2 ** 32 else ' (32-bit)'
+    # a SessionInfo for the python that ran the session info probe (see
+    # _SessionInfoCell), instead of for this one
+    @classmethod
+    def _from_probe(cls, probe):
+        si = cls.__new__(cls)
+        si.session_info = si._get_sesh_info_sectn(probe)
+        si.pkg_info = si._get_pkg_info_sectn(probe)
+        return si
 
-        major, minor, _ = platform.python_version_tuple()
-        python_v = major + '.' + minor
+    @staticmethod
+    def _get_sesh_info_sectn(probe=None):
+        if probe is None:
+            probe = {
+                'platform': platform.platform(),
+                '64bit': sys.maxsize > 2 ** 32,
+                'python': '{}.{}'.format(*sys.version_info)
+            }
+        pf = probe['platform'] + \
+             ' (64-bit)' if probe['64bit'] else ' (32-bit)'
+
+        python_v = probe['python']
 
         now = datetime.datetime.now()
         date = now.strftime('%Y-%m-%d')
@@ -126,101 +146,18 @@ class SessionInfo:
 
     @staticmethod
     def _get_potential_mods():
+        import IPython.core.getipython
+
         ip_inst = IPython.core.getipython.get_ipython()
         if not ip_inst:
             raise RuntimeError("SessionInfo() doesn't work outside of IPython")
-        code = ip_inst.user_ns['In']
-        # drop setup code if a reprex is running
-        if os.environ.get('REPREX_RUNNING'):
-            x = [
-                i
-                for i, j in enumerate(code) if re.search('REPREX_RUNNING', j)
-            ]
-            if x:
-                code = code[(x[0] + 1):]
-        scode = '\n'.join(code)
-        tokes = asttokens.ASTTokens(scode, parse=True)
-
-        def _get_one_mod(node):
-            tnode = type(node).__name__
-            if tnode == 'Import':
-                return [i.name for i in node.names]
-            if tnode == 'ImportFrom':
-                return [node.module]
-
-        mlist = [_get_one_mod(i) for i in asttokens.util.walk(tokes.tree)]
-        return {j for i in mlist if i is not None for j in i}
-
-    @staticmethod
-    def _get_dist_info(dist):
-        mods = []
-        try:
-            # Try to get top_level.txt metadata
-            md = dist.read_text('top_level.txt')
-            if md:
-                mods = md.splitlines()
-        except (FileNotFoundError, AttributeError, TypeError):
-            pass
-
-        # If top_level.txt is not available, try to infer modules from files
-        if not mods:
-            file_mods = set()
-            files = getattr(dist, 'files', None)
-            if files:
-                for file in files:
-                    if file is None:
-                        continue
-
-                    try:
-                        parts = file.parts
-                    except AttributeError:
-                        parts = tuple(str(file).split('/'))
-
-                    if not parts:
-                        continue
-
-                    top_part = parts[0]
-
-                    # Skip metadata / binary directories
-                    if not top_part or top_part in ('.', '__pycache__'):
-                        continue
-                    if top_part.endswith(('.dist-info', '.data')):
-                        continue
-
-                    # Only consider python packages/modules
-                    name = None
-                    file_name = getattr(file, 'name', None) or os.path.basename(str(file))
-                    suffix = getattr(file, 'suffix', '')
-
-                    if file_name == '__init__.py':
-                        name = top_part
-                    elif suffix == '.py' and len(parts) == 1:
-                        name = file_name[:-3]
-                    elif suffix in ('.py', '.pyi') and len(parts) > 1:
-                        name = top_part
-
-                    if name:
-                        file_mods.add(name)
-
-            mods = sorted(file_mods)
-
-        # Get project name from metadata
-        # All distributions should have 'Name' in metadata
-        project_name = dist.metadata.get('Name', '')
-        if not project_name:
-            # Fallback: try to get from distribution lookup
-            # This shouldn't normally happen, but handle it gracefully
-            project_name = ''
+        return set(_get_import_tracker(ip_inst).mods)
 
-        return {
-            'project_name': project_name,
-            'version': dist.version,
-            'mods': mods
-        }
+    def _get_version_info(self, modname, dist_index, path=None):
+        import importlib.metadata
 
-    def _get_version_info(self, modname, all_dist_info):
         try:
-            dist_info = importlib.metadata.distribution(modname)
+            dist_info = _get_distribution(modname, path)
             # Get project name from metadata
             # All distributions should have 'Name' in metadata
             project_name = dist_info.metadata.get('Name', '')
@@ -233,41 +170,582 @@ class SessionInfo:
             ml = modname.split('.')
             if len(ml) > 1:
                 modname = '.'.join(ml[:-1])
-                return self._get_version_info(modname, all_dist_info)
+                return self._get_version_info(modname, dist_index, path)
             else:
-                tmod = modname.split('.')[0]
-                x = [
-                    (i['project_name'], i['version'])
-                    for i in all_dist_info if tmod in i['mods']
-                ]
-                if x:
-                    return x[0]
-                else:
-                    return None, None
+                return dist_index.lookup(modname)
 
     def _get_stdlib_list(self):
-        this_py = self.session_info['Python']
-        if this_py not in stdlib_list.short_versions:
-            tpf = float(this_py)
-            x = [float(i) for i in stdlib_list.short_versions]
-            # if we don't have a lib list for this version of python, use the
-            # list that corresponds to the highest version that is below this
-            # version (if there is one), or lowest version that is above this
-            # version (if there is one)
-            next_lowest = [i for i in x if i < tpf]
-            if next_lowest:
-                this_py = str(max(next_lowest))
-            else:
-                this_py = str(min([i for i in x if i > tpf]))
-        return stdlib_list.stdlib_list(this_py)
-
-    def _get_pkg_info_sectn(self):
-        pmods = self._get_potential_mods()
-        all_dist_info = [
-            self._get_dist_info(i) for i in importlib.metadata.distributions()
-        ]
+        return _get_stdlib_names(self.session_info['Python'])
+
+    # distributions are looked up on this python's sys.path, or on the sys.path
+    # of the python that ran the probe (whose loaded modules' __file__ and
+    # __path__ are in the probe's locations)
+    def _get_pkg_info_sectn(self, probe=None):
+        import importlib.metadata
+
+        if probe is None:
+            pmods = [i for i in self._get_potential_mods() if i in sys.modules]
+            executable, path, locations = None, None, None
+        else:
+            pmods = probe['mods']
+            executable, path = probe['executable'], probe['path']
+            locations = probe['locations']
         libs = self._get_stdlib_list()
-        return {
-            i: self._get_version_info(i, all_dist_info)
-            for i in pmods if i in sys.modules and i not in libs
+        mods = [i for i in pmods if i.split('.')[0] not in libs]
+        cache = _MetadataCache.load(executable, sys_path=path)
+        missing = [i for i in mods if i not in cache.versions]
+        if missing:
+            dist_index = _DistributionIndex(
+                importlib.metadata.distributions(
+                    **({} if path is None else {'path': path})
+                ),
+                locations
+            )
+            for i in missing:
+                cache.versions[i] = self._get_version_info(i, dist_index, path)
+            cache.save()
+        return {i: cache.versions[i] for i in mods}
+
+
+def environment_fingerprint(source=None):
+    r"""A digest of the Python environment that code runs in.
+
+    The digest covers the Python version, the platform, and the names and
+    versions of the installed distributions. It's cheap to compute, since the
+    distributions' names and versions are read off the names of their
+    metadata directories (e.g., ``numpy-1.26.4.dist-info``) instead of out of
+    their metadata files. Unlike :py:class:`SessionInfo`, it doesn't need
+    IPython. Use it, e.g., to tell whether a stored reprex was rendered in the
+    environment that you're in now.
+
+    Parameters
+    ----------
+    source : str, optional
+        Python code (e.g., a reprex). If given, only the distributions that
+        provide the modules that the code imports (other than those in the
+        standard library) go into the digest, so installing or upgrading
+        unrelated packages doesn't change it. Note, the distributions that
+        those distributions depend on aren't included.
+
+    Returns
+    -------
+    str
+        The digest, as a hex string.
+
+    Examples
+    --------
+    >>> from reprexpy.session_info import environment_fingerprint
+    >>> environment_fingerprint()  # doctest: +SKIP
+    '9c1fd3b0c6f3e2b4...'
+    >>> environment_fingerprint('import numpy as np')  # doctest: +SKIP
+    'e07a5d1d93c1b2e8...'
+    """
+    key = {'python': sys.version, 'platform': platform.platform()}
+    if source is None:
+        key['dists'] = sorted(_iter_installed_dists())
+    else:
+        key['imports'] = _get_imported_dists(source)
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# the version, platform and sys.path of another python interpreter (e.g., the
+# one that a kernelspec runs), or None if it can't be run. these don't change
+# while the interpreter is installed, so they're only looked up once.
+_INTERPRETER_INFO_CODE = (
+    'import json, platform, sys; '
+    'print(json.dumps([sys.version, platform.platform(), sys.path]))'
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_interpreter_info(executable):
+    import subprocess
+
+    try:
+        out = subprocess.run(
+            [executable, '-c', _INTERPRETER_INFO_CODE],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+            timeout=60
+        ).stdout
+        return json.loads(out.decode('utf-8').splitlines()[-1])
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+
+# environment_fingerprint() of another python interpreter's environment, or
+# None if the interpreter can't be run. the interpreter's distributions are
+# listed each time, so installing or upgrading packages changes the digest.
+def _get_interpreter_fingerprint(executable):
+    info = _get_interpreter_info(executable)
+    if info is None:
+        return None
+    version, platform_name, path = info
+    key = {
+        'python': version, 'platform': platform_name,
+        'dists': sorted(_iter_installed_dists(path))
+    }
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# like importlib.metadata.distribution(), but optionally on another sys.path
+def _get_distribution(name, path=None):
+    import importlib.metadata
+
+    kwargs = {'name': name}
+    if path is not None:
+        kwargs['path'] = path
+    for dist in importlib.metadata.distributions(**kwargs):
+        return dist
+    raise importlib.metadata.PackageNotFoundError(name)
+
+
+# the names of the stdlib modules of a version of python (this one, by default)
+def _get_stdlib_names(this_py=None):
+    this_version = '{}.{}'.format(*sys.version_info)
+    if this_py is None:
+        this_py = this_version
+    # python 3.10+ knows the names of its own top-level stdlib modules
+    if this_py == this_version and hasattr(sys, 'stdlib_module_names'):
+        return sys.stdlib_module_names
+
+    import stdlib_list
+
+    if this_py not in stdlib_list.short_versions:
+        tpf = float(this_py)
+        x = [float(i) for i in stdlib_list.short_versions]
+        # if we don't have a lib list for this version of python, use the
+        # list that corresponds to the highest version that is below this
+        # version (if there is one), or lowest version that is above this
+        # version (if there is one)
+        next_lowest = [i for i in x if i < tpf]
+        if next_lowest:
+            this_py = str(max(next_lowest))
+        else:
+            this_py = str(min([i for i in x if i > tpf]))
+    return frozenset(stdlib_list.stdlib_list(this_py))
+
+
+def _get_imported_mods(code):
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+    mods = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            mods.update(i.name for i in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            mods.add(node.module)
+    return mods
+
+
+# records the modules that the user's code imports. it's installed once per
+# shell, as a post_run_cell hook, and parses each cell as it runs, so
+# SessionInfo() doesn't have to re-parse the shell's whole input history each
+# time it's called. if a reprex is running, the imports made by its setup code
+# (everything up to and including the cell that sets REPREX_RUNNING) are
+# dropped. the shell's history starting over (e.g., when a pooled kernel is
+# reset) is noticed by its execution count going backwards.
+class _ImportTracker:
+
+    def __init__(self, ip_inst):
+        self.ip_inst = ip_inst
+        self.mods = set()
+        self._past_setup = False
+        self._last_count = 0
+
+    def __call__(self, result):
+        count = getattr(result, 'execution_count', None)
+        # cells that aren't stored in the history don't count
+        if count is None or count == self._last_count:
+            return
+        if count < self._last_count:
+            self.mods = set()
+            self._past_setup = False
+        self._last_count = count
+        self._add_cell(self.ip_inst.transform_cell(result.info.raw_cell))
+
+    def _add_history(self, code):
+        for cell in code:
+            self._add_cell(cell)
+        # In[n] holds the cell whose execution count is n
+        self._last_count = len(code) - 1
+
+    def _add_cell(self, code):
+        if not self._past_setup and os.environ.get('REPREX_RUNNING') and \
+                'REPREX_RUNNING' in code:
+            self.mods = set()
+            self._past_setup = True
+        else:
+            self.mods.update(_get_imported_mods(code))
+
+
+# the shell's import tracker. the first time this is called for a shell, the
+# tracker is installed and caught up on the cells that have already run.
+def _get_import_tracker(ip_inst):
+    callbacks = ip_inst.events.callbacks['post_run_cell']
+    for callback in callbacks:
+        if isinstance(callback, _ImportTracker):
+            return callback
+    tracker = _ImportTracker(ip_inst)
+    # if a cell is running, `In` already holds it, so the tracker skips it when
+    # it finishes
+    tracker._add_history(ip_inst.user_ns['In'])
+    ip_inst.events.register('post_run_cell', tracker)
+    return tracker
+
+
+# the top-level modules that a distribution says it provides (in its
+# top_level.txt), if it says
+def _get_declared_mods(dist):
+    try:
+        md = dist.read_text('top_level.txt')
+    except (FileNotFoundError, AttributeError, TypeError):
+        return []
+    return md.splitlines() if md else []
+
+
+# infer the top-level modules that a distribution provides from the python
+# files it installed. the paths in its RECORD are parsed as strings, since
+# building a PackagePath for each of them (via dist.files) is much slower.
+def _get_inferred_mods(dist):
+    try:
+        record = dist.read_text('RECORD')
+    except (FileNotFoundError, AttributeError, TypeError):
+        record = None
+    if record:
+        paths = [i[0] for i in csv.reader(record.splitlines()) if i]
+    else:
+        paths = [str(i) for i in getattr(dist, 'files', None) or []]
+
+    file_mods = set()
+    for path in paths:
+        parts = path.split('/')
+        top_part = parts[0]
+
+        # Skip metadata / binary directories
+        if not top_part or top_part in ('.', '..', '__pycache__'):
+            continue
+        if top_part.endswith(('.dist-info', '.data')):
+            continue
+
+        # Only consider python packages/modules
+        if len(parts) == 1:
+            if top_part.endswith('.py'):
+                file_mods.add(top_part[:-3])
+        elif parts[-1].endswith(('.py', '.pyi')):
+            file_mods.add(top_part)
+
+    return sorted(file_mods)
+
+
+# the directories that a top-level module could have been installed into (i.e.,
+# the sys.path entries it was, or would be, imported from), or None if they
+# can't be worked out
+def _get_mod_install_dirs(modname, locations=None):
+    if locations is not None:
+        if modname not in locations:
+            return None
+        file, paths = locations[modname]
+    elif modname in sys.modules:
+        mod = sys.modules[modname]
+        file = getattr(mod, '__file__', None)
+        paths = list(getattr(mod, '__path__', []))
+    else:
+        # find modules that haven't been imported without importing them
+        import importlib.util
+        try:
+            spec = importlib.util.find_spec(modname)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is None:
+            # a module that can't be imported can't have been installed
+            return set()
+        file = spec.origin if spec.has_location else None
+        paths = list(spec.submodule_search_locations or [])
+    if file:
+        mod_dir = os.path.dirname(os.path.abspath(file))
+        if os.path.basename(file).startswith('__init__.'):
+            mod_dir = os.path.dirname(mod_dir)
+        return {mod_dir}
+    # namespace packages don't have a file, but they do have a path
+    if paths:
+        return {os.path.dirname(os.path.abspath(i)) for i in paths}
+    return None
+
+
+def _get_dist_install_dir(dist):
+    try:
+        return os.path.abspath(str(dist.locate_file('')))
+    except (AttributeError, NotImplementedError, TypeError):
+        return None
+
+
+# maps top-level module names to the (name, version) of the distribution that
+# provides them. the index is built lazily, as modules are looked up: the
+# cheap top_level.txt files of all distributions are read on the first lookup,
+# but distributions without one (whose modules have to be inferred from their
+# RECORD files) are only scanned until the module is found, and only if they're
+# installed in the directory that the module was imported from (according to
+# locations, which maps module names to their __file__ and __path__, if it's
+# given).
+# importlib.metadata.packages_distributions() isn't used, since it reads every
+# distribution's RECORD up front.
+class _DistributionIndex:
+
+    def __init__(self, dists, locations=None):
+        self._dists = dists
+        self._locations = locations
+        self._declared = None
+        self._undeclared = []
+        self._inferred = {}
+
+    def lookup(self, modname):
+        if self._declared is None:
+            self._index_declared()
+        dist = self._declared.get(modname) or self._inferred.get(modname)
+        if dist is None:
+            dist = self._scan_undeclared(modname)
+        if dist is None:
+            return None, None
+        return dist.metadata.get('Name', ''), dist.version
+
+    def _index_declared(self):
+        self._declared = {}
+        for dist in self._dists:
+            mods = _get_declared_mods(dist)
+            if not mods:
+                self._undeclared.append(dist)
+            for mod in mods:
+                # the first distribution that provides a module wins
+                self._declared.setdefault(mod, dist)
+
+    def _scan_undeclared(self, modname):
+        install_dirs = _get_mod_install_dirs(modname, self._locations)
+        remaining = []
+        found = None
+        for dist in self._undeclared:
+            if found is not None or (
+                    install_dirs is not None and
+                    _get_dist_install_dir(dist) not in install_dirs):
+                remaining.append(dist)
+                continue
+            mods = _get_inferred_mods(dist)
+            for mod in mods:
+                self._inferred.setdefault(mod, dist)
+            if modname in mods:
+                found = dist
+        self._undeclared = remaining
+        return found
+
+
+# the directories on sys.path (or on another python's sys.path), along with
+# their mtimes. installing, upgrading or removing a distribution adds or
+# removes a metadata directory in one of them, which changes that directory's
+# mtime. the directory of the script that's running (sys.path[0]) and the
+# working directory are left out, since their contents change all the time.
+def _get_site_dirs_stamp(sys_path=None):
+    if sys_path is None:
+        sys_path = sys.path
+    skip = {'', os.getcwd(), sys_path[0] if sys_path else ''}
+    stamp = []
+    for path in sys_path:
+        if path in skip:
+            continue
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        stamp.append([path, mtime])
+    return stamp
+
+
+# the (name, version) of the distribution that provides each module that
+# SessionInfo has looked up, persisted across sessions in reprexpy's cache
+# directory (one file per interpreter and sys.path). the cache is thrown out
+# when the stamp of the site directories changes.
+class _MetadataCache:
+
+    # the cache that was last loaded in this process, so repeated calls don't
+    # have to re-read it from disk
+    _last = None
+
+    def __init__(self, path, stamp, versions=None):
+        self.path = path
+        self.stamp = stamp
+        self.versions = versions or {}
+
+    # the cache for a python (this one, by default) and its sys.path
+    @classmethod
+    def load(cls, executable=None, sys_path=None):
+        from reprexpy.cache import _get_default_cache_dir
+
+        stamp = _get_site_dirs_stamp(sys_path)
+        env = json.dumps([executable or sys.executable, [i[0] for i in stamp]])
+        path = _get_default_cache_dir(
+            'environments',
+            hashlib.sha256(env.encode()).hexdigest() + '.json'
+        )
+        last = cls._last
+        if last is not None and last.path == path and last.stamp == stamp:
+            return last
+        try:
+            with open(path, encoding='utf-8') as fi:
+                entry = json.load(fi)
+            if entry['stamp'] != stamp:
+                entry = {}
+        except (OSError, ValueError, KeyError, TypeError):
+            entry = {}
+        versions = {
+            i: tuple(j) for i, j in entry.get('versions', {}).items()
         }
+        cls._last = cls(path, stamp, versions)
+        return cls._last
+
+    def save(self):
+        # a cache that can't be written (e.g., to a read-only home directory)
+        # just isn't persisted
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # write to a temp file first so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path), suffix='.tmp'
+            )
+            with os.fdopen(fd, 'w', encoding='utf-8') as fo:
+                json.dump({'stamp': self.stamp, 'versions': self.versions}, fo)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+def _normalize_dist_name(name):
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+# the (normalized name, version) of the distribution that a metadata directory
+# (or, for old distutils installs, file) belongs to, or None if name isn't the
+# name of a metadata directory
+def _parse_metadata_dir_name(path, name):
+    stem, ext = os.path.splitext(name)
+    if ext not in ('.dist-info', '.egg-info'):
+        return None
+    parts = stem.split('-')
+    if len(parts) > 1:
+        return _normalize_dist_name(parts[0]), parts[1]
+    # egg-info directories made by `setup.py develop` don't have the version
+    # in their name
+    import importlib.metadata
+    import pathlib
+
+    dist = importlib.metadata.PathDistribution(pathlib.Path(path, name))
+    return _normalize_dist_name(parts[0]), dist.version
+
+
+def _iter_installed_dists(paths=None):
+    for path in sys.path if paths is None else paths:
+        try:
+            names = os.listdir(path or '.')
+        except OSError:
+            # e.g., zip files and directories that don't exist
+            continue
+        for name in names:
+            dist = _parse_metadata_dir_name(path or '.', name)
+            if dist is not None:
+                yield dist
+
+
+# the (module, distribution name, version) of each top-level module that code
+# imports, other than stdlib modules. a module is matched to the distribution
+# of the same name that's installed where the module would be imported from,
+# if there is one, and is otherwise looked up in a _DistributionIndex.
+def _get_imported_dists(source):
+    import importlib.metadata
+
+    libs = _get_stdlib_names()
+    mods = {i.split('.')[0] for i in _get_imported_mods(source)}
+    dist_index = None
+    # the distributions installed in each directory, by name
+    installed = {}
+    imported = []
+    for mod in sorted(mods - libs):
+        install_dirs = _get_mod_install_dirs(mod)
+        dist = None
+        if install_dirs is not None:
+            for path in sorted(install_dirs):
+                if path not in installed:
+                    installed[path] = {}
+                    for name, version in _iter_installed_dists([path]):
+                        installed[path].setdefault(name, version)
+                version = installed[path].get(_normalize_dist_name(mod))
+                if version is not None:
+                    dist = (_normalize_dist_name(mod), version)
+                    break
+            if dist is None and not install_dirs:
+                dist = (None, None)
+        if dist is None:
+            if dist_index is None:
+                dist_index = _DistributionIndex(
+                    importlib.metadata.distributions()
+                )
+            dist = dist_index.lookup(mod)
+        imported.append([mod, dist[0], dist[1]])
+    return imported
+
+
+# the code that's run in the kernel instead of `print(SessionInfo())` when a
+# reprex has session info. it only reports which of the modules that the reprex
+# imports were loaded (and where from), along with the interpreter's details,
+# so reprexpy (and its dependencies) don't have to be imported into the kernel.
+# the distributions are looked up by the python that's rendering the reprex.
+_PROBE_CODE = [
+    'def _reprexpy_probe(mods):',
+    '    import json, platform, sys',
+    '    mods = [i for i in mods if i in sys.modules]',
+    '    locations = {}',
+    '    for top in {i.split(".")[0] for i in mods}:',
+    '        mod = sys.modules.get(top)',
+    '        locations[top] = [',
+    '            getattr(mod, "__file__", None),',
+    '            list(getattr(mod, "__path__", []))',
+    '        ]',
+    '    print(json.dumps({',
+    '        "platform": platform.platform(), "64bit": sys.maxsize > 2 ** 32,',
+    '        "python": "{}.{}".format(*sys.version_info),',
+    '        "executable": sys.executable, "path": sys.path, "mods": mods,',
+    '        "locations": locations',
+    '    }, default=str))',
+]
+
+
+# the cell that reprex(si=True) adds to the end of a reprex. it shows the code
+# that prints the session info, but the session info probe is what's run in the
+# kernel (see _PROBE_CODE), and the probe's report is resolved into the
+# session info that SessionInfo() would have printed.
+class _SessionInfoCell(list):
+
+    def __init__(self, code_str):
+        super().__init__(['import reprexpy', 'print(reprexpy.SessionInfo())'])
+        mods = sorted(_get_imported_mods(code_str))
+        self.probe = _PROBE_CODE + [
+            '_reprexpy_probe({!r})'.format(mods), 'del _reprexpy_probe'
+        ]
+
+    def resolve(self, one_out):
+        text = ''.join(
+            i['text'] for i in one_out
+            if i['output_type'] == 'stream' and i['name'] == 'stdout'
+        )
+        try:
+            probe = json.loads(text.splitlines()[-1])
+        except (IndexError, ValueError):
+            # e.g., the probe timed out
+            return one_out
+        # the code that's shown imports reprexpy, so reprexpy is listed (as it
+        # would have been if that code had been run)
+        probe['mods'] = sorted(set(probe['mods']) | {'reprexpy'})
+        si = SessionInfo._from_probe(probe)
+        return [{
+            'output_type': 'stream', 'name': 'stdout', 'text': str(si) + '\n'
+        }]
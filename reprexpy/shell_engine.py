@@ -0,0 +1,262 @@
+import _thread
+import base64
+import functools
+import io
+import multiprocessing
+import os
+import signal
+import sys
+
+from reprexpy.engines import (
+    ExecutionEngine, ExecutionSession, _INTERRUPT_GRACE, _MAX_OUTPUT_LINES,
+    _MAX_TOTAL_OUTPUT_LINES, _OutputLimits, _get_timeout_error,
+    _mark_timed_out
+)
+
+
+def _encode_data(data):
+    # binary outputs (e.g., PNGs) are base64-encoded, like they are in a
+    # notebook
+    return {
+        k: base64.b64encode(v).decode('ascii') if isinstance(v, bytes) else v
+        for k, v in data.items()
+    }
+
+
+# an InteractiveShell that records the outputs of the code it runs in the same
+# format that a kernel reports them in, instead of writing them to the terminal
+@functools.lru_cache(maxsize=None)
+def _get_capturing_shell_class():
+    import IPython.core.displayhook
+    import IPython.core.displaypub
+    import IPython.core.interactiveshell
+    import traitlets
+
+    class _DisplayHook(IPython.core.displayhook.DisplayHook):
+        def start_displayhook(self):
+            pass
+
+        def write_output_prompt(self):
+            pass
+
+        def write_format_data(self, format_dict, md_dict=None):
+            self.shell.add_output({
+                'output_type': 'execute_result',
+                'data': _encode_data(format_dict),
+                'metadata': md_dict or {},
+                'execution_count': self.prompt_count,
+            })
+
+        def finish_displayhook(self):
+            pass
+
+    class _DisplayPublisher(IPython.core.displaypub.DisplayPublisher):
+        def publish(self, data, metadata=None, source=None, *, transient=None,
+                    update=False, **kwargs):
+            self.shell.add_output({
+                'output_type': 'display_data',
+                'data': _encode_data(data),
+                'metadata': metadata or {},
+            })
+
+        def clear_output(self, wait=False):
+            self.shell.outputs.clear()
+
+    class _Stream(io.TextIOBase):
+        def __init__(self, shell, name):
+            super().__init__()
+            self._shell = shell
+            self.name = name
+
+        def writable(self):
+            return True
+
+        def write(self, s):
+            if s:
+                self._shell.add_output(
+                    {'output_type': 'stream', 'name': self.name, 'text': s}
+                )
+            return len(s)
+
+    class CapturingShell(IPython.core.interactiveshell.InteractiveShell):
+        displayhook_class = traitlets.Type(_DisplayHook)
+        display_pub_class = traitlets.Type(_DisplayPublisher)
+
+        def __init__(self, **kwargs):
+            self.output_limits = _OutputLimits()
+            self.outputs = self.output_limits.new_cell()
+            super().__init__(**kwargs)
+
+        def add_output(self, output):
+            self.outputs.add(output)
+
+        # there's no GUI event loop to hook into, but `%matplotlib inline`
+        # still calls this (after it has set up inline plotting)
+        def enable_gui(self, gui=None):
+            pass
+
+        def run_capturing(self, code, store_history):
+            self.outputs = self.output_limits.new_cell()
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = _Stream(self, 'stdout')
+            sys.stderr = _Stream(self, 'stderr')
+            try:
+                self.run_cell(code, store_history=store_history)
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+            return self.output_limits.finish_cell(self.outputs)
+
+        def _showtraceback(self, etype, evalue, stb):
+            self.add_output({
+                'output_type': 'error',
+                'ename': getattr(etype, '__name__', str(etype)),
+                'evalue': str(evalue),
+                'traceback': stb,
+            })
+
+    return CapturingShell
+
+
+# interrupts the worker's main thread each time the session sets the interrupt
+# event. sending SIGINT with os.kill() would terminate the worker on windows.
+def _watch_for_interrupts(interrupt):
+    while True:
+        interrupt.wait()
+        interrupt.clear()
+        _thread.interrupt_main()
+
+
+def _run_shell_worker(conn, output_limits, interrupt):
+    # cells that time out are interrupted with SIGINT (or, on windows, with the
+    # interrupt event)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if sys.platform == 'win32':
+        import threading
+        threading.Thread(
+            target=_watch_for_interrupts, args=(interrupt,), daemon=True
+        ).start()
+    # a forked worker inherits the parent's shell if the parent is running in
+    # IPython (e.g., in a notebook)
+    import IPython.core.interactiveshell
+    IPython.core.interactiveshell.InteractiveShell.clear_instance()
+    shell = _get_capturing_shell_class().instance()
+    # outputs are capped in the worker, so huge outputs are never sent back
+    shell.output_limits = output_limits
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        except KeyboardInterrupt:
+            # the cell finished just as it was interrupted
+            continue
+        if msg is None:
+            break
+        conn.send(shell.run_capturing(*msg))
+    conn.close()
+
+
+class _ShellSession(ExecutionSession):
+
+    def __init__(self, start_method, timeout, output_limits):
+        # import IPython before starting the child, so a forked child inherits
+        # it rather than having to import it itself
+        import IPython.core.interactiveshell  # pylint: disable=unused-import
+
+        self._timeout = timeout
+        ctx = multiprocessing.get_context(start_method)
+        self._conn, child_conn = ctx.Pipe()
+        self._interrupt = ctx.Event()
+        self._process = ctx.Process(
+            target=_run_shell_worker,
+            args=(child_conn, output_limits, self._interrupt), daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+
+    def close(self):
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._conn.close()
+
+    def _execute(self, code, store_history, timeout=None):
+        self._conn.send((code, store_history))
+        interrupted = False
+        try:
+            if timeout is None:
+                if not self._conn.poll(self._timeout):
+                    raise _get_timeout_error(self._timeout, code)
+            elif not self._conn.poll(timeout):
+                self._interrupt_worker()
+                interrupted = True
+                if not self._conn.poll(_INTERRUPT_GRACE):
+                    raise _get_timeout_error(timeout, code)
+            outputs = self._conn.recv()
+        except EOFError:
+            raise RuntimeError(
+                'The process running the reprex died while running:\n' + code
+            )
+        return _mark_timed_out(outputs, timeout) if interrupted else outputs
+
+    def _interrupt_worker(self):
+        if sys.platform == 'win32':
+            self._interrupt.set()
+        else:
+            os.kill(self._process.pid, signal.SIGINT)
+
+
+class ShellEngine(ExecutionEngine):
+    r"""Run reprexes in an IPython shell, without a Jupyter kernel.
+
+    Each session is an ``IPython.core.interactiveshell.InteractiveShell``
+    running in a child process of the current process. Starting the child
+    (which is forked on Linux) is much cheaper than starting a Jupyter kernel
+    and talking to it over ZeroMQ, which makes this engine a good fit for
+    text-only reprexes and docstring (``venue='sx'``) examples. Plots are still
+    captured if you use matplotlib.
+
+    The child runs the same Python interpreter as the current process, so this
+    engine can't be used with a ``kernel_name``. It also ignores
+    ``kernel_pool``.
+
+    Parameters
+    ----------
+    start_method : {'fork', 'spawn', 'forkserver'}, optional
+        The ``multiprocessing`` start method used to create the child process.
+        Defaults to ``'fork'`` on Linux and ``'spawn'`` elsewhere.
+    timeout : int, optional
+        Number of seconds a single cell can run for before the reprex is
+        aborted.
+    max_output_lines, max_total_output_lines : int, optional
+        See :py:class:`reprexpy.engines.NbconvertEngine`.
+    """
+
+    def __init__(self, start_method=None, timeout=600,
+                 max_output_lines=_MAX_OUTPUT_LINES,
+                 max_total_output_lines=_MAX_TOTAL_OUTPUT_LINES):
+        if start_method is None:
+            start_method = 'fork' if sys.platform.startswith('linux') \
+                else 'spawn'
+        self.start_method = start_method
+        self.timeout = timeout
+        self.max_output_lines = max_output_lines
+        self.max_total_output_lines = max_total_output_lines
+
+    def session(self, kernel_name=None, kernel_pool=None):
+        if kernel_name is not None:
+            raise ValueError(
+                "ShellEngine runs code in the current Python interpreter, so "
+                "it can't be used with a `kernel_name`"
+            )
+        return _ShellSession(self.start_method, self.timeout, _OutputLimits(
+            self.max_output_lines, self.max_total_output_lines
+        ))
+
+    def _get_cache_key(self):
+        # the code runs in this interpreter rather than in a kernel
+        return super()._get_cache_key() + [sys.executable]
@@ -0,0 +1,159 @@
+import os
+import time
+import traceback
+
+from reprexpy.engines import _get_engine
+from reprexpy.reprex import (
+    _format_reprex, _get_setup_code, _get_source_code, _iter_cell_outputs,
+    _split_input_into_cells
+)
+
+
+# renders successive versions of a reprex in a single kernel. if the cells that
+# were run for the previous version are an unchanged prefix of the new
+# version's cells, only the new trailing cells are run. otherwise the kernel's
+# namespace is reset and every cell is re-run (in the same kernel, so there's
+# still no kernel startup cost).
+class _WatchSession:
+
+    def __init__(self, kernel_name, venue, comment, advertise, engine=None,
+                 image_sink=None, figure_format=None, dpi=None,
+                 optimize_png=False, timeout=None, budget=None,
+                 stop_on_error=False):
+        self.kernel_name = kernel_name
+        self.engine = _get_engine(engine)
+        self.venue = venue
+        self.comment = comment
+        self.advertise = False if venue == 'sx' else advertise
+        self.image_sink = image_sink
+        self._setup_code = _get_setup_code(figure_format, dpi, optimize_png)
+        self.timeout = timeout
+        self.budget = budget
+        self.stop_on_error = stop_on_error
+        self._session = None
+        self._cells = []
+        self._outputs = []
+        self._stopped = False
+        self._url_cache = {}
+
+    def render(self, code_str):
+        input_cells = _split_input_into_cells(code_str)
+
+        n_run = len(self._cells)
+        if self._session is None:
+            self._session = self.engine.session(self.kernel_name)
+            self._start_over()
+        elif self._stopped or input_cells[:n_run] != self._cells:
+            # a reprex that stopped early (e.g., because a statement timed out)
+            # is re-run from the start, since the statement that stopped it
+            # may have left the namespace half-updated
+            self._session.reset()
+            self._start_over()
+
+        new_cells = input_cells[len(self._cells):]
+        cell_outputs = _iter_cell_outputs(
+            self._session, new_cells, timeout=self.timeout, budget=self.budget,
+            stop_on_error=self.stop_on_error
+        )
+        for cell, one_out in zip(new_cells, cell_outputs):
+            self._outputs.append(one_out)
+            self._cells.append(cell)
+        self._stopped = len(self._cells) < len(input_cells)
+
+        return _format_reprex(
+            self._cells, self._outputs, venue=self.venue, comment=self.comment,
+            si=False, advertise=self.advertise, url_cache=self._url_cache,
+            image_sink=self.image_sink
+        )
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    # drops the session after a render failed (e.g., because the kernel died),
+    # so the next render starts over in a fresh one
+    def abandon(self):
+        session, self._session = self._session, None
+        self._cells = []
+        self._outputs = []
+        if session is not None:
+            try:
+                session.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+    def _start_over(self):
+        for cell in self._setup_code:
+            self._session.execute(cell)
+        self._cells = []
+        self._outputs = []
+
+
+def watch(code_file, venue='gh', kernel_name=None, comment='#>',
+          advertise=False, engine=None, image_sink=None, figure_format=None,
+          dpi=None, optimize_png=False, timeout=None, budget=None,
+          stop_on_error=False, interval=0.5):
+    r"""Re-render a reprex every time its file is saved.
+
+    Keeps a single IPython kernel alive while you edit your reprex, and prints
+    the rendered reprex each time the file changes. When all you've done is
+    add code to the end of the reprex, only the new code is run (on top of the
+    kernel's existing state). Any other change means the kernel's namespace is
+    reset and the whole reprex is re-run. An error that stops the reprex from
+    rendering (e.g., the kernel dying) is printed, and the next save is
+    rendered in a fresh kernel. Stop watching with Ctrl-C.
+
+    Parameters
+    ----------
+    code_file : str
+        Path to the file that contains your reprex.
+    venue, kernel_name, comment, advertise, engine, image_sink
+        See :py:func:`reprexpy.reprex.reprex`.
+    figure_format, dpi, optimize_png, timeout, stop_on_error
+        See :py:func:`reprexpy.reprex.reprex`.
+    budget : float, optional
+        See :py:func:`reprexpy.reprex.reprex`. The budget applies to the
+        statements that are run for each save.
+    interval : float, optional
+        How often (in seconds) to check the file for changes.
+
+    Examples
+    --------
+
+    >>> import reprexpy
+    >>> from reprexpy.watch import watch
+    >>> watch('my-reprex.py')  # doctest: +SKIP
+    """
+    session = _WatchSession(
+        kernel_name=kernel_name, venue=venue, comment=comment,
+        advertise=advertise, engine=engine, image_sink=image_sink,
+        figure_format=figure_format, dpi=dpi, optimize_png=optimize_png,
+        timeout=timeout, budget=budget, stop_on_error=stop_on_error
+    )
+    last_mtime = None
+    try:
+        while True:
+            try:
+                mtime = os.stat(code_file).st_mtime_ns
+            except FileNotFoundError:
+                # some editors save by deleting and re-creating the file
+                mtime = None
+            if mtime is not None and mtime != last_mtime:
+                last_mtime = mtime
+                try:
+                    out = session.render(_get_source_code(None, code_file))
+                except SyntaxError as e:
+                    out = 'Could not parse {}: {}'.format(code_file, e)
+                except Exception:  # pylint: disable=broad-except
+                    # keep watching: the next save may well render fine
+                    out = 'Could not render {}:\n{}'.format(
+                        code_file, traceback.format_exc()
+                    )
+                    session.abandon()
+                print(out + '\n')
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()
@@ -5,7 +5,8 @@ from setuptools import setup
 
 install_requires = [
     'pyperclip', 'asttokens', 'nbconvert', 'nbformat', 'matplotlib',
-    'ipython', 'pyimgur', 'stdlib-list', 'ipykernel', 'tornado'
+    'matplotlib-inline', 'ipython', 'stdlib-list', 'ipykernel', 'tornado',
+    'requests', 'jupyter_client', 'jupyter_core', 'traitlets'
 ]
 
 this_directory = os.path.abspath(os.path.dirname(__file__))
@@ -33,5 +34,6 @@ setup(
     tests_require=['pytest', 'pyzmq', 'pickledb'],
     setup_requires=setup_requires,
     python_requires='>=3.8',
-    package_data={'reprexpy': ['examples/*.py']}
+    package_data={'reprexpy': ['examples/*.py']},
+    entry_points={'console_scripts': ['reprexpy = reprexpy.cli:main']}
 )
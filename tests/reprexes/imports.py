@@ -3,7 +3,7 @@ from nbconvert import *
 # import standard lib mod
 import re
 # imports on single line
-import asttokens, pyimgur
+import asttokens, requests
 # use alias
 import stdlib_list as slib
 # import package
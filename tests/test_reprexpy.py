@@ -1,11 +1,44 @@
+import asyncio
+import base64
+import concurrent.futures
+import http.server
+import importlib.metadata
+import json
+import multiprocessing
 import os
+import pathlib
 import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 import textwrap
+import threading
+import time
+import types
+import urllib.parse
+import weakref
 
 import pyperclip
 import pytest
 
-from reprexpy import reprex
+from reprexpy import areprex, reprex, reprex_iter, reprex_many
+from reprexpy.cache import (
+    ImageCache, RenderCache, _get_render_key, _is_deterministic
+)
+from reprexpy.images import DirectorySink, HTTPSink
+from reprexpy.kernel_pool import KernelPool, _PooledKernel
+from reprexpy.profiling import RenderProfile, _get_decoded_size
+from reprexpy.reprex import (
+    _format_reprex, _get_statement_ends_from_tokens, _split_input_into_cells
+)
+from reprexpy.session_info import (
+    _DistributionIndex, _MetadataCache, _SessionInfoCell,
+    environment_fingerprint
+)
+from reprexpy.shell_engine import ShellEngine
+from reprexpy.watch import _WatchSession, watch
 
 skip_on_github = pytest.mark.skipif(
     'CI' in os.environ,
@@ -13,6 +46,13 @@ skip_on_github = pytest.mark.skipif(
 )
 
 
+# keep the caches that reprexpy writes by default (e.g., SessionInfo's metadata
+# cache and ImgurSink's image cache) out of the real cache directory
+@pytest.fixture(autouse=True)
+def _cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('REPREXPY_CACHE_DIR', str(tmp_path / 'reprexpy-cache'))
+
+
 def _read_reprex_file(file):
     with open(file) as fi:
         lns = fi.read()
@@ -118,7 +158,7 @@ def test_si_imports():
     code = _read_reprex_file('tests/reprexes/imports.py')
     out = reprex(code, si=True)
     imports = [
-        'nbconvert', 'asttokens', 'pyimgur', 'stdlib-list', 'ipython', 'pyzmq'
+        'nbconvert', 'asttokens', 'requests', 'stdlib-list', 'ipython', 'pyzmq'
     ]
     for distribution in imports:
         distribution_regex = distribution + '=='
@@ -132,3 +172,922 @@ def test_si_non_imports():
     for distribution in non_imports:
         distribution_regex = distribution + '=='
         assert not re.search(distribution_regex, out)
+
+
+def test_kernel_pool_matches_fresh_kernel():
+    src, expected_output = _read_reprex_file_pair('debug-example')
+    with KernelPool(size=1) as pool:
+        assert reprex(src, kernel_pool=pool) == expected_output
+        assert reprex(src, kernel_pool=pool) == expected_output
+
+
+def test_kernel_pool_resets_namespace():
+    with KernelPool(size=1) as pool:
+        reprex('x = 1', kernel_pool=pool)
+        out = reprex('x', kernel_pool=pool)
+    assert re.search('NameError', out)
+
+
+def test_kernel_pool_resets_figure_settings():
+    code = 'import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()'
+
+    def _get_image_size(pool, **kargs):
+        out = reprex(code, kernel_pool=pool, image_sink='data-uri', **kargs)
+        return len(re.search(r'base64,(.+)\)', out).group(1))
+
+    with KernelPool(size=1) as pool:
+        default_size = _get_image_size(pool)
+        assert _get_image_size(pool, dpi=20) < default_size
+        assert _get_image_size(pool) == default_size
+
+
+def test_kernel_pool_recycles_kernels():
+    with KernelPool(size=1, max_runs=1) as pool:
+        with pool.acquire() as km:
+            first_id = km.connection_file
+        with pool.acquire() as km:
+            second_id = km.connection_file
+    assert first_id != second_id
+
+
+def test_kernel_pool_survives_failed_recycle(monkeypatch):
+    def _fail(self):
+        raise TimeoutError('kernel never became ready')
+
+    with KernelPool(size=1, max_runs=1) as pool:
+        pool.start()
+        # the kernel is worn out after one run, and its replacement never
+        # becomes ready
+        with monkeypatch.context() as m:
+            m.setattr(_PooledKernel, 'wait_for_ready', _fail)
+            with pool.acquire():
+                pass
+        assert pool._all == []
+        with pool.acquire(timeout=30) as km:
+            assert km.is_alive()
+        assert len(pool._all) == 1
+
+
+def test_kernel_pool_can_be_garbage_collected():
+    pool = KernelPool(size=1)
+    ref = weakref.ref(pool)
+    del pool
+    assert ref() is None
+
+
+def test_kernel_pool_concurrent_renders():
+    with KernelPool(size=2) as pool:
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            outs = list(executor.map(
+                lambda i: reprex('print({})'.format(i), kernel_pool=pool),
+                range(4)
+            ))
+    for i, out in enumerate(outs):
+        assert '#> {}'.format(i) in out
+
+
+def test_reprex_many_returns_results_in_order():
+    src, expected_output = _read_reprex_file_pair('debug-example')
+    sources = [
+        src,
+        pathlib.Path('tests', 'reprexes', 'txt-outputs.py'),
+        pathlib.Path('tests', 'reprexes', 'no-such-file.py'),
+    ]
+    results = reprex_many(sources, workers=2)
+    assert [i.index for i in results] == [0, 1, 2]
+    assert results[0].output == expected_output
+    assert results[1].output == _read_reprex_file_pair('txt-outputs')[1]
+    assert results[2].output is None
+    assert re.search('FileNotFoundError', results[2].error)
+
+
+def test_reprex_many_as_completed():
+    sources = ['print({})'.format(i) for i in range(3)]
+    results = reprex_many(sources, workers=2, as_completed=True)
+    # no worker processes are started until results are consumed
+    assert multiprocessing.active_children() == []
+    results = list(results)
+    assert multiprocessing.active_children() == []
+    assert sorted(i.index for i in results) == [0, 1, 2]
+    for result in results:
+        assert '#> {}'.format(result.index) in result.output
+
+
+def test_render_cache_skips_kernel_on_hit(tmp_path, monkeypatch):
+    cache = RenderCache(str(tmp_path))
+    first = reprex('x = 1\nx', cache=cache)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('cache miss')
+
+    # the reprexpy.reprex module is shadowed by the reprex() function
+    monkeypatch.setattr(sys.modules['reprexpy.reprex'], '_run_cells', _fail)
+    assert reprex('x = 1\nx', cache=cache) == first
+    with pytest.raises(AssertionError):
+        reprex('x = 1\nx', venue='so', cache=cache)
+
+
+def test_render_cache_is_keyed_on_engine(tmp_path, monkeypatch):
+    cache = RenderCache(str(tmp_path))
+    first = reprex('x = 1\nx', cache=cache, engine='shell')
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('cache miss')
+
+    monkeypatch.setattr(sys.modules['reprexpy.reprex'], '_run_cells', _fail)
+    assert reprex('x = 1\nx', cache=cache, engine='shell') == first
+    with pytest.raises(AssertionError):
+        reprex('x = 1\nx', cache=cache, engine='nbconvert')
+    with pytest.raises(AssertionError):
+        reprex('x = 1\nx', cache=cache, engine=ShellEngine(max_output_lines=5))
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='Uses a shell script.')
+def test_render_cache_is_keyed_on_kernel_environment(tmp_path, monkeypatch):
+    # a kernel whose interpreter sees an extra site directory
+    site_dir = tmp_path / 'site'
+    site_dir.mkdir()
+    python = tmp_path / 'python'
+    python.write_text('#!/bin/sh\nPYTHONPATH={} exec {} "$@"\n'.format(
+        site_dir, sys.executable
+    ))
+    python.chmod(0o755)
+    kernelspec = {
+        'name': 'other', 'argv': [str(python), '-m', 'ipykernel_launcher'],
+        'language': 'python', 'env': {}
+    }
+    monkeypatch.setattr(
+        sys.modules['reprexpy.cache'], '_get_kernelspec_info',
+        lambda kernel_name: kernelspec
+    )
+
+    def _get_key(kernel_name='other'):
+        return _get_render_key(
+            'x = 1\nx', venue='gh', kernel_name=kernel_name, comment='#>',
+            si=False, advertise=False
+        )
+
+    first = _get_key()
+    assert first == _get_key()
+    # installing a package in the kernel's environment changes the key
+    (site_dir / 'foo-1.0.dist-info').mkdir()
+    assert _get_key() != first
+    kernelspec['argv'] = [str(tmp_path / 'missing-python')]
+    assert _get_key() is None
+
+
+def test_render_cache_eviction_and_expiry(tmp_path):
+    cache = RenderCache(str(tmp_path), max_size=500)
+    for i in range(10):
+        cache.put('key{}'.format(i), 'x' * 100, [])
+    assert cache.get('key0') is None
+    assert cache.get('key9')['markdown'] == 'x' * 100
+
+    cache = RenderCache(str(tmp_path), max_age=-1)
+    assert cache.get('key9') is None
+
+
+def test_nondeterministic_code_is_not_cached():
+    assert _is_deterministic('import os\nos.path.join("a", "b")')
+    assert not _is_deterministic('import time\ntime.time()')
+    assert not _is_deterministic('import datetime\ndatetime.datetime.now()')
+    assert not _is_deterministic('import numpy as np\nnp.random.rand(3)')
+    assert not _is_deterministic('from random import choice\nchoice([1, 2])')
+
+
+@pytest.mark.parametrize('code', [
+    'from time import time\ntime()',
+    'import random as r\nr.random()',
+    'import time as t\nt.time()',
+    'from datetime import datetime as dt\ndt.now()',
+    'import os.path as p, uuid as u\nu.uuid4()',
+])
+def test_nondeterministic_code_is_not_cached_under_aliases(code):
+    assert not _is_deterministic(code)
+
+
+def test_render_cache_cleans_up_failed_puts(tmp_path, monkeypatch):
+    cache = RenderCache(str(tmp_path))
+    with pytest.raises(TypeError):
+        cache.put('key', 'x', [object()])
+    assert os.listdir(str(tmp_path)) == []
+
+    # the directory is only rescanned when the cache might be full
+    scans = []
+    list_entries = cache._list_entries
+
+    def _count_scans():
+        scans.append(1)
+        return list_entries()
+
+    monkeypatch.setattr(cache, '_list_entries', _count_scans)
+    for i in range(10):
+        cache.put('key{}'.format(i), 'x', [])
+    assert len(scans) == 1
+
+
+def test_watch_session_reruns_only_what_changed():
+    # builtins survive a namespace reset, so `builtins.n` counts how many times
+    # the first cell has been run
+    code = (
+        'import builtins\n'
+        'builtins.n = getattr(builtins, "n", 0) + 1\n'
+        'print(builtins.n)'
+    )
+    session = _WatchSession(None, venue='gh', comment='#>', advertise=False)
+    try:
+        assert '#> 1' in session.render(code)
+
+        # appended cells run on top of the existing state
+        out = session.render(code + '\nprint(builtins.n + 10)')
+        assert re.search('#> 1\n.*#> 11', out, flags=re.DOTALL)
+
+        # an edit to an earlier cell means starting over
+        out = session.render(code.replace('+ 1', '+ 100'))
+        assert '#> 101' in out
+        assert '#> 11' not in out
+    finally:
+        session.close()
+
+
+def test_watch_keeps_going_after_failed_render(tmp_path, monkeypatch, capsys):
+    code_file = tmp_path / 'reprex.py'
+    code_file.write_text('x = 1\nx')
+    render = _WatchSession.render
+
+    def _render(self, code_str):
+        if code_str == 'x = 1\nx':
+            raise RuntimeError('Kernel died')
+        return render(self, code_str)
+
+    # each sleep between checks of the file is a chance to save it again
+    saves = ['x = 2\nx']
+
+    def _sleep(interval):
+        if not saves:
+            raise KeyboardInterrupt
+        code_file.write_text(saves.pop())
+        os.utime(str(code_file), ns=(0, 1))
+
+    monkeypatch.setattr(_WatchSession, 'render', _render)
+    monkeypatch.setattr(
+        sys.modules['reprexpy.watch'], 'time', types.SimpleNamespace(
+            sleep=_sleep
+        )
+    )
+    watch(str(code_file), engine='shell')
+    out = capsys.readouterr().out
+    assert re.search('Could not render .*RuntimeError: Kernel died', out,
+                     flags=re.DOTALL)
+    assert '#> 2' in out
+
+
+def test_import_does_not_load_heavy_dependencies():
+    heavy = ['nbconvert', 'jupyter_client', 'requests', 'pyperclip', 'IPython']
+    code = 'import sys, reprexpy; print([i for i in {!r} if i in sys.modules])'
+    out = subprocess.run(
+        [sys.executable, '-c', code.format(heavy)], stdout=subprocess.PIPE,
+        universal_newlines=True, check=True
+    ).stdout
+    assert out.strip() == '[]'
+
+
+@pytest.mark.parametrize('file_name,venue', [
+    ('txt-outputs', 'gh'), ('debug-example', 'gh'),
+    ('two-statements-per-line', 'gh'), ('docstring-venue', 'sx'),
+    ('unicode', 'gh'),
+])
+def test_shell_engine_matches_kernel(file_name, venue):
+    _assert_reprex_exact_match(file_name, venue=venue, engine='shell')
+
+
+def test_shell_engine_plot_and_error_outputs():
+    assert _count_mismatching_lines('plot-output', engine='shell') == 3
+    out = reprex('10 / 0', engine='shell')
+    assert re.search('ZeroDivisionError', out)
+
+
+def test_shell_engine_enables_inline_plots():
+    with ShellEngine().session() as session:
+        assert session.execute(['%matplotlib inline']) == []
+
+
+def test_shell_engine_rejects_kernel_name():
+    with pytest.raises(ValueError):
+        reprex('x = 1', engine='shell', kernel_name='python3')
+
+
+@pytest.mark.parametrize('file_name,venue', [
+    ('txt-outputs', 'gh'), ('debug-example', 'gh'), ('docstring-venue', 'sx'),
+])
+def test_client_engine_matches_kernel(file_name, venue):
+    _assert_reprex_exact_match(file_name, venue=venue, engine='client')
+
+
+def test_client_engine_with_kernel_pool():
+    with KernelPool(size=1) as pool:
+        out = reprex('x = 1\nx\n10 / 0', engine='client', kernel_pool=pool)
+        assert re.search('#> 1', out)
+        assert re.search('ZeroDivisionError', out)
+
+
+@pytest.mark.parametrize('file_name,kargs', [
+    ('plot-and-txt-output', {}), ('so-venue', {'venue': 'so'}),
+    ('txt-outputs', {'si': True, 'advertise': True}),
+])
+def test_reprex_iter_matches_reprex(file_name, kargs):
+    src, _ = _read_reprex_file_pair(file_name)
+    blocks = list(reprex_iter(src, engine='shell', **kargs))
+    assert '\n\n'.join(blocks) == reprex(src, engine='shell', **kargs)
+
+
+def test_reprex_iter_yields_blocks_as_they_finish():
+    code = (
+        'import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()\n'
+        'raise RuntimeError("not run yet")'
+    )
+    blocks = reprex_iter(code, engine='shell')
+    assert re.search(r'!\[\]\(', next(blocks))
+    assert re.search('not run yet', next(blocks))
+    assert next(blocks, None) is None
+
+
+def test_areprex_renders_concurrently():
+    srcs = [_read_reprex_file_pair(i) for i in ['txt-outputs', 'unicode']]
+
+    async def render_all():
+        return await asyncio.gather(*[areprex(src) for src, _ in srcs])
+
+    outs = asyncio.run(render_all())
+    assert outs == [expected_output for _, expected_output in srcs]
+
+
+def test_areprex_with_kernel_pool():
+    async def render_twice(pool):
+        return [
+            await areprex('x = 1\nx', kernel_pool=pool),
+            await areprex('x', kernel_pool=pool)
+        ]
+
+    with KernelPool(size=1) as pool:
+        first, second = asyncio.run(render_twice(pool))
+    assert re.search('#> 1', first)
+    assert re.search('NameError', second)
+
+
+def test_areprex_with_kernel_pool_doesnt_block_event_loop():
+    async def tick(gaps, done):
+        last = time.monotonic()
+        while not done.is_set():
+            await asyncio.sleep(0.05)
+            now = time.monotonic()
+            gaps.append(now - last)
+            last = now
+
+    async def render(pool):
+        gaps = []
+        done = asyncio.Event()
+        ticker = asyncio.ensure_future(tick(gaps, done))
+        await areprex('x = 1\nx', kernel_pool=pool)
+        done.set()
+        await ticker
+        return max(gaps)
+
+    # the kernel is worn out after one render, so giving it back to the pool
+    # means starting a replacement
+    with KernelPool(size=1, max_runs=1) as pool:
+        pool.start()
+        assert asyncio.run(render(pool)) < 0.5
+
+
+def test_areprex_resolves_session_info_in_a_thread(monkeypatch):
+    threads = []
+    resolve = _SessionInfoCell.resolve
+
+    def _resolve(self, one_out):
+        threads.append(threading.current_thread())
+        return resolve(self, one_out)
+
+    monkeypatch.setattr(_SessionInfoCell, 'resolve', _resolve)
+    out = asyncio.run(areprex('import os', si=True))
+    assert 'Session info' in out
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_areprex_never_uses_clipboard():
+    with pytest.raises(ValueError):
+        asyncio.run(areprex())
+
+
+# a stand-in for imgur's upload endpoint. `statuses` holds the status codes to
+# reply with (in order) before it starts replying with 200s.
+class _FakeImgurHandler(http.server.BaseHTTPRequestHandler):
+    statuses = []
+    delay = 0
+    n_requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        image = urllib.parse.parse_qs(body.decode())['image'][0]
+        with self.lock:
+            type(self).n_requests += 1
+            status = self.statuses.pop(0) if self.statuses else 200
+        time.sleep(self.delay)
+        payload = json.dumps({'data': {'link': 'http://img/' + image}})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_imgur():
+    _FakeImgurHandler.statuses = []
+    _FakeImgurHandler.delay = 0
+    _FakeImgurHandler.n_requests = 0
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), _FakeImgurHandler
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/3/image'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_sink_uploads_concurrently(fake_imgur):
+    _FakeImgurHandler.delay = 0.5
+    sink = HTTPSink(fake_imgur, max_workers=4)
+    start = time.monotonic()
+    urls = sink.upload_many(['a', 'b', 'c', 'd'])
+    assert urls == ['http://img/a', 'http://img/b', 'http://img/c', 'http://img/d']
+    assert time.monotonic() - start < 1.5
+
+
+def test_http_sink_retries(fake_imgur):
+    _FakeImgurHandler.statuses = [500, 429]
+    sink = HTTPSink(fake_imgur, backoff=0.01)
+    assert sink.upload('a') == 'http://img/a'
+    assert _FakeImgurHandler.n_requests == 3
+
+    _FakeImgurHandler.statuses = [503, 503]
+    sink = HTTPSink(fake_imgur, backoff=0.01, max_retries=1)
+    assert re.search('upload-error', sink.upload('a'))
+
+
+def test_http_sink_accepts_any_2xx(fake_imgur):
+    _FakeImgurHandler.statuses = [201, 201]
+    sink = HTTPSink(fake_imgur, max_retries=0)
+    assert sink.upload('a') == 'http://img/a'
+    assert asyncio.run(sink.aupload_many(['b'])) == ['http://img/b']
+
+
+def test_http_sink_times_out(fake_imgur):
+    _FakeImgurHandler.delay = 2
+    sink = HTTPSink(fake_imgur, read_timeout=0.2, max_retries=0)
+    start = time.monotonic()
+    assert re.search('upload-error', sink.upload('a'))
+    assert time.monotonic() - start < 1.5
+
+
+def test_local_image_sinks(tmp_path):
+    src, _ = _read_reprex_file_pair('plot-output')
+    out = reprex(src, engine='shell', image_sink=DirectorySink(str(tmp_path)))
+    links = re.findall(r'!\[\]\((.+)\)', out)
+    assert len(links) == 3
+    assert all(os.path.isfile(i) for i in links)
+
+    out = reprex(src, engine='shell', image_sink='data-uri')
+    assert len(re.findall(r'!\[\]\(data:image/png;base64,', out)) == 3
+
+
+def test_directory_sink_links_are_relative(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    code = 'import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()'
+    sink = DirectorySink(str(tmp_path / 'figures'))
+    out = reprex(code, engine='shell', image_sink=sink)
+    assert re.search(r'!\[\]\(figures/\w+\.png\)', out)
+
+    sink = DirectorySink(
+        str(tmp_path / 'figures'), link_base=str(tmp_path / 'docs')
+    )
+    out = reprex(code, engine='shell', image_sink=sink)
+    assert re.search(r'!\[\]\(\.\./figures/\w+\.png\)', out)
+
+
+def test_http_sink_in_reprex(fake_imgur):
+    out = reprex(
+        'import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()',
+        engine='shell', image_sink=HTTPSink(fake_imgur)
+    )
+    assert re.search(r'!\[\]\(http://img/', out)
+
+
+def test_http_sink_deduplicates_uploads(fake_imgur, tmp_path):
+    sink = HTTPSink(
+        fake_imgur, image_cache=ImageCache(str(tmp_path / 'images.sqlite3'))
+    )
+    assert sink.upload_many(['YQ==', 'YQ==', 'Yg==']) == \
+        ['http://img/YQ==', 'http://img/YQ==', 'http://img/Yg==']
+    assert _FakeImgurHandler.n_requests == 2
+    # same image bytes, different base64 line wrapping
+    assert sink.upload('Y\nQ==') == 'http://img/YQ=='
+    assert asyncio.run(sink.aupload_many(['Yg==', 'Yw=='])) == \
+        ['http://img/Yg==', 'http://img/Yw==']
+    assert _FakeImgurHandler.n_requests == 3
+
+
+def test_image_cache_eviction(tmp_path):
+    cache = ImageCache(str(tmp_path / 'images.sqlite3'), max_entries=2)
+    for i in ['a', 'b', 'c']:
+        cache.put('sink', i, 'url-' + i)
+        time.sleep(0.01)
+    assert cache.get_many('sink', ['a', 'b', 'c']) == \
+        {'b': 'url-b', 'c': 'url-c'}
+    assert cache.get_many('other-sink', ['b']) == {}
+
+    cache = ImageCache(str(tmp_path / 'images.sqlite3'), max_age=0)
+    assert cache.get_many('sink', ['c']) == {}
+
+
+def test_figure_settings_shrink_plots():
+    code = 'import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()'
+
+    def _get_image_size(**kargs):
+        out = reprex(code, engine='shell', image_sink='data-uri', **kargs)
+        return len(re.search(r'base64,(.+)\)', out).group(1))
+
+    default_size = _get_image_size()
+    assert _get_image_size(dpi=36) < default_size
+    assert _get_image_size(optimize_png=True) < default_size
+    assert _get_image_size(figure_format='retina') > default_size
+    with pytest.raises(ValueError):
+        reprex(code, engine='shell', figure_format='svg')
+
+
+@pytest.mark.parametrize('engine', ['shell', 'client', 'nbconvert'])
+def test_timeout_interrupts_cell(engine):
+    code = 'print(1)\nimport time; time.sleep(30)\nprint(2)'
+    start = time.monotonic()
+    out = reprex(code, engine=engine, timeout=1)
+    assert time.monotonic() - start < 20
+    assert '#> [timed out after 1s]' in out
+    assert 'KeyboardInterrupt' not in out
+    assert 'print(2)' not in out
+
+
+# this is how cells are interrupted on windows, where sending SIGINT would
+# terminate the worker. (on linux, the forked worker inherits the patched
+# sys.platform.)
+@pytest.mark.skipif(
+    sys.platform == 'darwin', reason="The spawned worker isn't patched."
+)
+def test_shell_engine_interrupts_without_signals(monkeypatch):
+    engine = ShellEngine()
+    monkeypatch.setattr(sys, 'platform', 'win32')
+    with engine.session() as session:
+        out = session.execute(['print(1)\nwhile True: pass'], timeout=1)
+        assert out[0]['text'] == '1\n'
+        assert out[-1]['ename'] == 'CellTimeout'
+        assert session.execute(['print(2)']) == [
+            {'output_type': 'stream', 'name': 'stdout', 'text': '2\n'}
+        ]
+
+
+def test_shell_engine_timeout_aborts_reprex():
+    with pytest.raises(TimeoutError):
+        reprex('import time\ntime.sleep(30)', engine=ShellEngine(timeout=1))
+
+
+def test_budget_and_stop_on_error():
+    code = 'import time\ntime.sleep(0.5)\ntime.sleep(0.5)\ntime.sleep(30)'
+    out = reprex(code, engine='shell', budget=2)
+    assert re.search(r'#> \[timed out after [01]\.?\d*s\]', out)
+
+    code = 'x = 1\n10 / 0\nprint("not run")'
+    out = reprex(code, engine='shell', stop_on_error=True)
+    assert 'ZeroDivisionError' in out
+    assert 'not run' not in out
+
+
+@pytest.mark.parametrize('engine', ['shell', 'client'])
+def test_huge_outputs_are_elided(engine):
+    out = reprex('for i in range(100000): print(i)', engine=engine)
+    assert '#> ... 99000 lines omitted ...' in out
+    assert re.search('#> 499\n#> ... 99000 lines omitted ...\n#> 99500\n', out)
+    assert out.endswith('#> 99999\n```')
+
+
+def test_interleaved_streams_are_elided():
+    code = (
+        'import sys\n'
+        'for i in range(5000): print(i); print(i, file=sys.stderr)'
+    )
+    with ShellEngine().session() as session:
+        outputs = session.execute(code.splitlines())
+    assert len(outputs) == 1001
+    assert outputs[-1]['text'] == '... 9000 lines omitted ...\n'
+    out = reprex(code, engine='shell')
+    assert out.count('lines omitted') == 1
+    assert len(out.splitlines()) < 1100
+
+
+def test_huge_array_reprs_are_elided():
+    code = (
+        'import sys\nimport numpy as np\n'
+        'np.set_printoptions(threshold=sys.maxsize)\nnp.arange(100000)'
+    )
+    capped = reprex(code, engine='shell')
+    uncapped = reprex(code, engine=ShellEngine(
+        max_output_lines=10 ** 6, max_total_output_lines=10 ** 6
+    ))
+    assert 'lines omitted' in capped
+    assert 'lines omitted' not in uncapped
+    assert len(capped.splitlines()) < 1100 < len(uncapped.splitlines())
+
+
+def test_output_caps_apply_per_cell_and_in_total():
+    engine = ShellEngine(max_output_lines=4, max_total_output_lines=7)
+    code = 'print("a\\n" * 3, end="")\nprint("b\\n" * 10, end="")\n"c\\n" * 10'
+    out = reprex(code, engine=engine)
+    assert out.count('#> a') == 3
+    assert '#> b\n#> b\n#> ... 6 lines omitted ...\n#> b\n#> b\n' in out
+    assert "#> ... 1 line omitted ..." in out
+
+
+def test_formatter_strips_colors_and_collapses_repeated_frames():
+    frame = '\x1b[0;32mCell In[4], line 1\x1b[0m, in f(n)\n----> 1 f(n + 1)'
+    error = {
+        'output_type': 'error', 'ename': 'RecursionError', 'evalue': '',
+        'traceback': [
+            '-' * 75, 'RecursionError    Traceback (most recent call last)'
+        ] + [frame] * 100 + ['RecursionError: maximum recursion depth']
+    }
+    out = _format_reprex(
+        [['f(0)']], [[error]], venue='gh', comment='#>', si=False,
+        advertise=False
+    )
+    frame_lines = '#> Cell In[4], line 1, in f(n)\n#> ----> 1 f(n + 1)\n'
+    assert out == (
+        '```python\nf(0)\n#> Traceback (most recent call last):\n' +
+        frame_lines * 3 + '#> [... previous frame repeated 97 more times]\n'
+        '#> RecursionError: maximum recursion depth\n```'
+    )
+
+
+@pytest.mark.parametrize('file_name', sorted(
+    i for i in os.listdir(os.path.join('tests', 'reprexes'))
+    if i.endswith('.py')
+))
+def test_cell_splitter_matches_asttokens(file_name):
+    code = _read_reprex_file(os.path.join('tests', 'reprexes', file_name))
+    ends = sorted(set(_get_statement_ends_from_tokens(code)))
+    cells = _split_input_into_cells(code)
+    assert [len(i) for i in cells] == [j - i for i, j in zip([0] + ends, ends)]
+    assert [x for i in cells for x in i] == code.splitlines()[:ends[-1]]
+
+
+def test_shell_engine_inside_ipython():
+    code = (
+        'import IPython.core.interactiveshell, reprexpy\n'
+        'IPython.core.interactiveshell.InteractiveShell.instance()\n'
+        'print(reprexpy.reprex("x = 1\\nx", engine="shell"))'
+    )
+    out = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.PIPE,
+        universal_newlines=True, check=True
+    ).stdout
+    assert '#> 1' in out
+
+
+def test_render_profile():
+    events = []
+    profile = RenderProfile(callback=events.append)
+    code = 'import time\ntime.sleep(0.5)\nprint("hi")'
+    reprex(code, engine='shell', image_sink='data-uri', profile=profile)
+    assert list(profile.phases)[:4] == [
+        'cache lookup', 'kernel startup', 'setup code', 'cells'
+    ]
+    assert [i.code for i in profile.cells] == code.splitlines()
+    assert profile.cells[1].seconds >= 0.5
+    assert profile.cells[2].output_bytes == 3
+    assert profile.total >= sum(i.seconds for i in profile.cells)
+    assert len([i for i in events if i['event'] == 'cell']) == 3
+    assert 'time.sleep(0.5)' in str(profile)
+
+
+def test_render_profile_only_counts_uploaded_bytes(fake_imgur, tmp_path):
+    code = 'import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()'
+
+    def _profile(image_sink):
+        profile = RenderProfile()
+        out = reprex(code, engine='shell', image_sink=image_sink,
+                     profile=profile)
+        return out, profile
+
+    out, profile = _profile('data-uri')
+    png = base64.b64decode(re.search(r'base64,(.+)\)', out).group(1))
+    assert (profile.n_images, profile.bytes_uploaded) == (1, 0)
+
+    sink = HTTPSink(
+        fake_imgur, image_cache=ImageCache(str(tmp_path / 'images.sqlite3'))
+    )
+    assert _profile(sink)[1].bytes_uploaded == len(png)
+    # the plot is in the image cache the second time around
+    assert _profile(sink)[1].bytes_uploaded == 0
+
+    # jupyter wraps base64 data over several lines
+    wrapped = base64.encodebytes(png).decode()
+    assert _get_decoded_size(wrapped) == len(png)
+
+
+# a made-up distribution (with the given RECORD) in site_dir, along with the
+# files listed in its RECORD
+def _make_dist(site_dir, name, record, top_level=None, version='1.0'):
+    info_dir = site_dir / '{}-{}.dist-info'.format(name, version)
+    info_dir.mkdir()
+    (info_dir / 'METADATA').write_text(
+        'Metadata-Version: 2.1\nName: {}\nVersion: {}\n'.format(name, version)
+    )
+    (info_dir / 'RECORD').write_text(record)
+    if top_level:
+        (info_dir / 'top_level.txt').write_text(top_level)
+    for line in record.splitlines():
+        path = site_dir / line.split(',')[0]
+        path.parent.mkdir(exist_ok=True)
+        path.touch()
+    return info_dir
+
+
+def test_distribution_index(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    _make_dist(tmp_path, 'PyYAML', 'yaml/__init__.py,,\n', 'yaml\n_yaml\n')
+    _make_dist(
+        tmp_path, 'foo-bar', 'foo_bar/__init__.py,,\nfoo_bar/x.pyi,,\nbaz.py,,\n'
+    )
+    index = _DistributionIndex(
+        importlib.metadata.distributions(path=[str(tmp_path)])
+    )
+    assert index.lookup('_yaml') == ('PyYAML', '1.0')
+    assert index.lookup('baz') == ('foo-bar', '1.0')
+    assert index.lookup('foo_bar') == ('foo-bar', '1.0')
+    assert index.lookup('not_installed') == (None, None)
+
+
+def test_environment_fingerprint(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    info_dir = _make_dist(tmp_path, 'foo', 'foo/__init__.py,,\n')
+    _make_dist(tmp_path, 'bar', 'baz.py,,\n', 'baz\n')
+    full = environment_fingerprint()
+    scoped = environment_fingerprint('import foo.x\nfrom baz import y')
+    assert environment_fingerprint() == full
+    assert scoped not in (full, environment_fingerprint('import foo'))
+
+    # installing a package that the code doesn't import only changes the
+    # fingerprint of the whole environment
+    _make_dist(tmp_path, 'qux', 'qux.py,,\n')
+    assert environment_fingerprint() != full
+    assert environment_fingerprint('import foo.x\nfrom baz import y') == scoped
+
+    # upgrading one that it does import changes both
+    full = environment_fingerprint()
+    info_dir.rename(tmp_path / 'foo-2.0.dist-info')
+    assert environment_fingerprint() != full
+    assert environment_fingerprint('import foo.x\nfrom baz import y') != scoped
+
+
+def test_si_tracks_imports_as_cells_run():
+    code = textwrap.dedent('''
+        import contextlib, io, IPython.core.interactiveshell, reprexpy
+        shell = IPython.core.interactiveshell.InteractiveShell.instance()
+        def run(cell):
+            with contextlib.redirect_stdout(io.StringIO()):
+                shell.run_cell(cell, store_history=True)
+        run('import asttokens')
+        print(sorted(reprexpy.SessionInfo().pkg_info))
+        run('if False:\\n    import nbformat')
+        print(sorted(reprexpy.SessionInfo().pkg_info))
+        shell.reset(new_session=True)
+        run('import yaml')
+        print(sorted(reprexpy.SessionInfo().pkg_info))
+    ''')
+    out = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.PIPE,
+        universal_newlines=True, check=True
+    ).stdout
+    assert out.splitlines() == [
+        "['asttokens']", "['asttokens']", "['yaml']"
+    ]
+
+
+def test_metadata_cache_is_invalidated_by_site_dirs(tmp_path, monkeypatch):
+    site_dir = tmp_path / 'site-packages'
+    site_dir.mkdir()
+    monkeypatch.setattr(sys, 'path', ['', str(site_dir)])
+    monkeypatch.setattr(_MetadataCache, '_last', None)
+    cache = _MetadataCache.load()
+    cache.versions['foo'] = ('foo-dist', '1.0')
+    cache.save()
+
+    # a new process reads the cache from disk
+    monkeypatch.setattr(_MetadataCache, '_last', None)
+    assert _MetadataCache.load().versions == {'foo': ('foo-dist', '1.0')}
+
+    # installing a distribution changes the site directory's mtime
+    (site_dir / 'bar-1.0.dist-info').mkdir()
+    os.utime(site_dir, ns=(0, 0))
+    assert _MetadataCache.load().versions == {}
+    monkeypatch.setattr(_MetadataCache, '_last', None)
+    assert _MetadataCache.load().versions == {}
+
+
+def test_si_probe_doesnt_need_reprexpy():
+    cell = _SessionInfoCell('import yaml\nimport os.path\nimport not_installed')
+    code = '\n'.join(
+        ['import yaml'] + cell.probe +
+        ['import sys', 'assert "reprexpy" not in sys.modules']
+    )
+    out = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.PIPE,
+        universal_newlines=True, check=True
+    ).stdout
+    one_out = cell.resolve(
+        [{'output_type': 'stream', 'name': 'stdout', 'text': out}]
+    )
+    assert cell == ['import reprexpy', 'print(reprexpy.SessionInfo())']
+    packages = one_out[0]['text'].split('Packages')[1].splitlines()[1:]
+    assert [i.split('==')[0] for i in packages] == ['PyYAML', 'reprexpy']
+
+
+def _wait_for_socket(socket_path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+        time.sleep(0.05)
+
+
+@pytest.mark.skipif(
+    not hasattr(socket, 'AF_UNIX'), reason='Needs unix domain sockets.'
+)
+def test_cli_renders_with_server(tmp_path, capsys):
+    from reprexpy.cli import _get_render_server_class, main
+
+    # unix socket paths can't be much longer than 100 bytes (on macOS)
+    socket_dir = tempfile.mkdtemp(dir='/tmp')
+    socket_path = os.path.join(socket_dir, 'reprexpy.sock')
+    code_file = tmp_path / 'reprex.py'
+    code_file.write_text('x = 1\nx')
+    args = ['--socket', socket_path, 'render', str(code_file)]
+    assert main(args) == 1
+    assert 'No reprexpy server' in capsys.readouterr().err
+    assert main(['--socket', socket_path, 'render', 'no-such-file.py']) == 1
+    assert 'Could not read no-such-file.py' in capsys.readouterr().err
+
+    try:
+        with KernelPool(size=1) as pool:
+            server = _get_render_server_class()(socket_path, pool, max_queue=1)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                _wait_for_socket(socket_path)
+                expected = reprex('x = 1\nx', kernel_pool=pool)
+                capsys.readouterr()
+                assert main(args) == 0
+                assert capsys.readouterr().out == expected + '\n'
+
+                # a render that can't be queued is turned away
+                rendering = threading.Event()
+                render = server.render
+
+                def _render(*render_args):
+                    rendering.set()
+                    return render(*render_args)
+
+                server.render = _render
+                slow_file = tmp_path / 'slow.py'
+                slow_file.write_text('import time\ntime.sleep(3)')
+                slow = threading.Thread(target=main, args=(
+                    ['--socket', socket_path, 'render', str(slow_file)],
+                ))
+                slow.start()
+                assert rendering.wait(30)
+                assert main(args) == 75
+                assert 'busy' in capsys.readouterr().err
+                slow.join()
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+    finally:
+        shutil.rmtree(socket_dir)